@@ -33,6 +33,16 @@ def make_new_settings(rebuilding=False, clean=False, old_channel_names=False):
             'N_CORES': psutil.cpu_count(),
             'UBID_OFFSET': 5,
             'CHUNK_SIZE': 1000000,
+            'N_IO_THREADS': 4,
+            'DAQ_READER': 'auto',
+            'AUTO_TUNE': False,
+            'MEMORY_FRACTION': 0.5,
+            'PARQUET_ENGINE': 'auto',
+            'PARQUET_CODEC': 'snappy',
+            'PARQUET_INT_CODEC': 'zstd',
+            'PARQUET_COMPRESSION_LEVEL': 0,
+            'PARQUET_ROW_GROUP_SIZE': 1000000,
+            'BINNING_ENGINE': 'auto',
             # new detector uses 0.006858710665255785
             # old detector used 0.0205761316872428
             'TOF_STEP_TO_NS': 0.006858710665255785,
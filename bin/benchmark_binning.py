@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+""" The purpose of this script is to compare the binning engines of
+computeBinnedData (NumPy and, if numba is installed, the compiled kernel) with
+np.histogramdd, on the 4D binning of binningTest (delayStage, dldTime, dldPosX,
+dldPosY), checking that they give the same histogram."""
+
+import argparse
+import time
+
+import numpy as np
+
+from processor import DldFlashDataframeCreator as DldFlashProcessor
+from processor import binning
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the binning engine against np.histogramdd')
+    parser.add_argument('-events', dest='events', type=int, default=5000000,
+                        help='number of electrons binned')
+    parser.add_argument('-repeat', dest='repeat', type=int, default=3,
+                        help='number of repetitions, the fastest is reported')
+    parser.add_argument('-nonuniform', dest='nonuniform', action='store_true',
+                        help='use unevenly spaced dldTime bins, binned with searchsorted')
+    args = parser.parse_args()
+
+    prc = DldFlashProcessor.DldFlashProcessor()
+    edges = [prc.genBins(-57, -42, 0.5),  # delayStage
+             prc.genBins(620, 670, 1),  # dldTime
+             prc.genBins(480, 980, 5),  # dldPosX
+             prc.genBins(480, 980, 5)]  # dldPosY
+    if args.nonuniform:
+        edges[1] = np.geomspace(620, 670, len(edges[1]))
+
+    rng = np.random.RandomState(0)
+    columns = [rng.normal((e[0] + e[-1]) / 2, (e[-1] - e[0]) / 3, args.events) for e in edges]
+    print('{:,} events in {} bins, uniform axes: {}'.format(
+        args.events, 'x'.join(str(len(e) - 1) for e in edges),
+        [binning.uniformAxis(e) is not None for e in edges]))
+
+    def timeIt(function):
+        times = []
+        for i in range(args.repeat):
+            t0 = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - t0)
+        return result, min(times)
+
+    reference, referenceTime = timeIt(lambda: np.histogramdd(columns, bins=edges)[0])
+    print('np.histogramdd    : {:6.3f} s, {:6.1f} M events/s'.format(referenceTime, args.events / referenceTime / 1e6))
+    engines = ['numpy', 'numba'] if binning.NUMBA_AVAILABLE else ['numpy']
+    for engine in engines:
+        binning.histogram([c[:10] for c in columns], edges, engine)  # compiles the kernel
+        result, resultTime = timeIt(lambda: binning.histogram(columns, edges, engine))
+        print('binning ({:5})   : {:6.3f} s, {:6.1f} M events/s, speedup {:.1f}x, identical result: {}'.format(
+            engine, resultTime, args.events / resultTime / 1e6, referenceTime / resultTime,
+            np.array_equal(reference, result)))
+    if not binning.NUMBA_AVAILABLE:
+        print('numba is not installed, the compiled kernel was not tested')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+""" The purpose of this script is to compare the output and the timing of the
+implementations of assignToMircobunch: vectorized numpy, Cython and pure python."""
+
+import argparse
+import time
+
+import numpy as np
+
+import processor.cscripts.DldFlashProcessorNotCy as DldFlashProcessorNotCy
+import processor.cscripts.DldFlashProcessorVectorized as DldFlashProcessorVectorized
+
+try:
+    import processor.cscripts.DldFlashProcessorCy as DldFlashProcessorCy
+except ImportError as e:
+    print('Cython module not available, skipping it. Error msg: {}'.format(e))
+    DldFlashProcessorCy = None
+
+
+def make_test_arrays(numOfMacrobunches, numOfElectrons, numOfMicrobunches, seed=0):
+    """ Create (macrobunch, electron) microbunch IDs and (macrobunch, microbunch) values
+    which look like the DAQ arrays, including NaN padding and out of range IDs."""
+    rng = np.random.RandomState(seed)
+    microbunchIds = rng.uniform(-5, numOfMicrobunches + 5, (numOfMacrobunches, numOfElectrons))
+    microbunchIds = np.floor(microbunchIds)
+    hits = rng.randint(0, numOfElectrons, numOfMacrobunches)
+    microbunchIds[np.arange(numOfElectrons)[None, :] >= hits[:, None]] = np.nan
+    toConvert = rng.normal(0, 1, (numOfMacrobunches, numOfMicrobunches))
+    toConvert[rng.uniform(size=toConvert.shape) < 0.01] = np.nan
+    return microbunchIds, toConvert
+
+
+def time_implementation(function, microbunchIds, toConvert, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = function(microbunchIds, toConvert)
+        times.append(time.perf_counter() - t0)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the microbunch assignment implementations')
+    parser.add_argument('-macrobunches', dest='macrobunches', type=int, default=2000,
+                        help='number of macrobunches (rows) in the test arrays')
+    parser.add_argument('-electrons', dest='electrons', type=int, default=500,
+                        help='number of electron slots per macrobunch')
+    parser.add_argument('-microbunches', dest='microbunches', type=int, default=500,
+                        help='number of microbunches per macrobunch')
+    parser.add_argument('-repeat', dest='repeat', type=int, default=3,
+                        help='number of repetitions, the fastest one is reported')
+    args = parser.parse_args()
+
+    microbunchIds, toConvert = make_test_arrays(args.macrobunches, args.electrons, args.microbunches)
+    print('Assigning {:,} microbunch values to {:,} electron slots'.format(toConvert.size, microbunchIds.size))
+
+    implementations = [('vectorized', DldFlashProcessorVectorized.assignToMircobunch)]
+    if DldFlashProcessorCy is not None:
+        implementations.append(('cython', DldFlashProcessorCy.assignToMircobunch))
+    implementations.append(('python', DldFlashProcessorNotCy.assignToMircobunch))
+
+    reference, referenceTime = time_implementation(
+        DldFlashProcessorNotCy.assignToMircobunch, microbunchIds, toConvert, 1)
+
+    for name, function in implementations:
+        result, bestTime = time_implementation(function, microbunchIds, toConvert, args.repeat)
+        identical = np.array_equal(result.view(np.uint64), reference.view(np.uint64))
+        print('{}: {:.4f} s, {:.1f}x faster than python, bitwise identical: {}'.format(
+            name.ljust(10), bestTime, referenceTime / bestTime, identical))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+""" The purpose of this script is to compare the parquet codecs used by
+storeDataframes: for each codec, a synthetic run is written with storeDataframes
+and read back with readDataframes, reporting write throughput, size on disk and
+read throughput."""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from processor import DldFlashDataframeCreator as DldFlashProcessor
+
+
+def make_synthetic_processor(numOfMacrobunches, numOfElectrons, numOfMicrobunches, seed=0):
+    """ Create a processor holding DAQ-like channel arrays, including the NaN
+    padding of the electron channels, as after readData."""
+    rng = np.random.RandomState(seed)
+    prc = DldFlashProcessor.DldFlashProcessor()
+    prc.runNumber = 0
+    hits = rng.randint(0, numOfElectrons, numOfMacrobunches)
+    padding = np.arange(numOfElectrons)[None, :] >= hits[:, None]
+
+    def electronChannel(low, high):
+        values = rng.randint(low, high, (numOfMacrobunches, numOfElectrons)).astype(np.float64)
+        values[padding] = np.nan
+        return values
+
+    prc.dldPosX = electronChannel(0, 3000)
+    prc.dldPosY = electronChannel(0, 3000)
+    prc.dldTime = electronChannel(50000, 70000)
+    prc.dldMicrobunchId = electronChannel(0, numOfMicrobunches)
+    prc.dldDetectorId = electronChannel(0, 4)
+    prc.dldSectorId = electronChannel(0, 16)
+    prc.delayStage = np.repeat(rng.normal(0, 1, numOfMacrobunches // 100 + 1), 100)[:numOfMacrobunches]
+    prc.bam = rng.normal(0, 1, (numOfMacrobunches, numOfMicrobunches))
+    prc.bunchCharge = rng.normal(0, 1, (numOfMacrobunches, numOfMicrobunches))
+    prc.opticalDiode = rng.normal(0, 1, (numOfMacrobunches, numOfMicrobunches))
+    prc.pumpPol = np.zeros((numOfMacrobunches, 1))
+    prc.macroBunchPulseId = np.arange(numOfMacrobunches, dtype=np.float64)[:, None]
+    prc.timeStamp = 1.5e9 + np.arange(numOfMacrobunches, dtype=np.float64)[:, None] / 10
+    prc.daqAddresses = ['dldPosX', 'dldPosY', 'dldTime', 'delayStage', 'bam', 'dldMicrobunchId',
+                        'dldDetectorId', 'dldSectorId', 'bunchCharge', 'opticalDiode', 'pumpPol',
+                        'macroBunchPulseId', 'timeStamp']
+    prc.createDataframePerElectron()
+    prc.createDataframePerMicrobunch()
+    prc.dd = prc.dd.persist()
+    prc.ddMicrobunches = prc.ddMicrobunches.persist()
+    return prc
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(dirPath, name))
+               for dirPath, dirNames, fileNames in os.walk(path) for name in fileNames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the parquet codecs of storeDataframes')
+    parser.add_argument('-macrobunches', dest='macrobunches', type=int, default=20000,
+                        help='number of macrobunches of the synthetic run')
+    parser.add_argument('-electrons', dest='electrons', type=int, default=50,
+                        help='number of electron slots per macrobunch')
+    parser.add_argument('-microbunches', dest='microbunches', type=int, default=500,
+                        help='number of microbunches per macrobunch')
+    parser.add_argument('-codecs', dest='codecs', nargs='+',
+                        default=['none', 'snappy', 'lz4', 'gzip', 'zstd', 'brotli'],
+                        help='codecs to compare, used for all the columns')
+    parser.add_argument('-level', dest='level', type=int, default=0,
+                        help='compression level, 0 for the codec default')
+    parser.add_argument('-path', dest='path', default=None,
+                        help='folder where the dataframes are written, e.g. on the shared file system')
+    args = parser.parse_args()
+
+    prc = make_synthetic_processor(args.macrobunches, args.electrons, args.microbunches)
+    rawSize = (prc.dd.memory_usage(deep=True).sum() + prc.ddMicrobunches.memory_usage(deep=True).sum()).compute()
+    print('Synthetic run: {:,} electrons, {:.1f} MB in memory'.format(len(prc.dd), rawSize / 2 ** 20))
+
+    path = tempfile.mkdtemp(dir=args.path)
+    try:
+        for codec in args.codecs:
+            prc.PARQUET_CODEC = codec
+            prc.PARQUET_INT_CODEC = codec
+            prc.PARQUET_COMPRESSION_LEVEL = args.level
+            fileName = 'run_{}'.format(codec)
+            t0 = time.perf_counter()
+            try:
+                prc.storeDataframes(fileName=fileName, path=path + os.sep)
+            except Exception as e:
+                print('{}: not available ({})'.format(codec.ljust(8), e))
+                continue
+            writeTime = time.perf_counter() - t0
+            size = folder_size(os.path.join(path, fileName + '_el')) + folder_size(os.path.join(path, fileName + '_mb'))
+
+            reader = DldFlashProcessor.DldFlashProcessor()
+            t0 = time.perf_counter()
+            reader.readDataframes(fileName=fileName, path=path + os.sep)
+            reader.dd.compute()
+            reader.ddMicrobunches.compute()
+            readTime = time.perf_counter() - t0
+
+            print('{}: write {:7.1f} MB/s, size {:7.1f} MB (ratio {:4.2f}), read {:7.1f} MB/s'.format(
+                codec.ljust(8), rawSize / 2 ** 20 / writeTime, size / 2 ** 20, rawSize / size,
+                rawSize / 2 ** 20 / readTime))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,10 @@ import sys,os
 # sys.path.append(os.getcwd())
 
 import time
+import shutil
+import tempfile
 import processor.DldFlashDataframeCreator as DldFlashProcessor
+from utilities import misc, synthetic
 import matplotlib.pyplot as plt
 import argparse
 
@@ -22,6 +25,8 @@ import argparse
 parser = argparse.ArgumentParser(description='Bin data')
 parser.add_argument('-run', dest='runNumber', metavar='N', type=int,
                     help='an integer for the accumulator')
+parser.add_argument('-synthetic', dest='synthetic', type=int, metavar='MACROBUNCHES', default=None,
+                    help='read a synthetic run with this number of macrobunches instead of a stored one')
 # parser.add_argument('--clean', dest='clean', action='store_true',
 #                     help='removes options from current SETTINGS.ini that are not standard (default: keeps everything)')
 args = parser.parse_args()
@@ -31,7 +36,12 @@ runNumber = args.runNumber
 
 
 time.sleep(1)
-if runNumber is None:
+if args.synthetic is not None:
+    runNumber = 1 if runNumber is None else runNumber
+    rawPath = tempfile.mkdtemp()
+    synthetic.generate_run(rawPath, runNumber, num_of_macrobunches=args.synthetic,
+                           channels=misc.parse_category('DAQ channels') or synthetic.DEFAULT_CHANNELS)
+elif runNumber is None:
     runNumber = input("Please choose a run number: ")
 
 
@@ -40,7 +50,11 @@ times = {}
 processor = DldFlashProcessor.DldFlashProcessor()
 processor.runNumber = runNumber
 
-processor.readDataframes()
+if args.synthetic is not None:
+    processor.readData(runNumber, path=rawPath)
+    shutil.rmtree(rawPath, ignore_errors=True)
+else:
+    processor.readDataframes()
 
 
 last_t = t0
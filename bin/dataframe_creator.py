@@ -3,18 +3,51 @@
 
 @author: Steinn Ymir Agustsson
 """
+
+""" Convert runs to parquet dataframes, several runs at a time. Runs already
+converted are skipped, so an interrupted batch is resumed by running the
+same command again."""
+
+import argparse
+
 import processor.DldFlashDataframeCreator as DldFlashProcessor
-from utilities.misc import get_available_runs, create_dataframes
+from utilities.batch import convert_runs
+from utilities.runindex import update_run_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert runs to parquet dataframes')
+    parser.add_argument('runs', type=int, nargs='*',
+                        help='run numbers to convert. If none is given, all available runs are converted')
+    parser.add_argument('-workers', dest='workers', type=int, default=None,
+                        help='maximum number of runs converted at the same time (default N_CORES)')
+    parser.add_argument('-memory_fraction', dest='memory_fraction', type=float, default=0.8,
+                        help='fraction of the available memory used by the running conversions')
+    parser.add_argument('-memory_factor', dest='memory_factor', type=float, default=3.0,
+                        help='estimated memory of a conversion, in units of the size of its raw files')
+    parser.add_argument('-lazy', dest='lazy', action='store_true',
+                        help='read the raw files lazily, see DldFlashProcessor.readData')
+    parser.add_argument('-state', dest='state', default=None,
+                        help='json file storing the progress of the batch')
+    parser.add_argument('-overwrite', dest='overwrite', action='store_true',
+                        help='convert runs again even if their dataframes exist')
+    args = parser.parse_args()
+
+    print('running')
+    prc = DldFlashProcessor.DldFlashProcessor()
+    runs = update_run_index(prc.DATA_RAW_DIR)
+    del prc
+
+    print('{} runs found: '.format(len(runs)))
+    for run, info in runs.items():
+        print('run: {} path: {} files: {} size: {:.1f} GB'.format(int(run[3:]), info['path'], len(info['files']),
+                                                                   sum(info['sizes']) / 1e9))
 
-print('running')
-prc = DldFlashProcessor.DldFlashProcessor()
-runs = get_available_runs(prc.DATA_RAW_DIR)
-del prc
+    runNumbers = args.runs if len(args.runs) > 0 else sorted(int(run[3:]) for run in runs)
+    convert_runs(runNumbers, n_workers=args.workers, memory_fraction=args.memory_fraction,
+                 memory_factor=args.memory_factor, lazy=args.lazy, state_file=args.state,
+                 overwrite=args.overwrite)
 
-print('{} runs found: '.format(len(runs)))
-for run, path in runs.items():
-    run_n = int(run[3:])
-    print('run: {} path: {}'.format(run_n,path))
-    create_dataframes(run_n)
 
-fails = {}
\ No newline at end of file
+if __name__ == '__main__':
+    main()
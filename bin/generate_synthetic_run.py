@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+""" The purpose of this script is to write a synthetic run in the layout of the
+FLASH DAQ files, to test and benchmark reading, conversion and binning without
+access to beamtime data. The channels are those of the [DAQ channels] section of
+SETTINGS.ini, so that the run can be read with readData."""
+
+import argparse
+
+from utilities import misc, synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic run in the layout of the FLASH DAQ files')
+    parser.add_argument('path', help='folder where the run is written, to be used as data_raw_dir')
+    parser.add_argument('-run', dest='runNumber', type=int, default=1,
+                        help='number of the run')
+    parser.add_argument('-macrobunches', dest='macrobunches', type=int, default=10000,
+                        help='number of macrobunches of the run')
+    parser.add_argument('-electrons', dest='electrons', type=int, default=50,
+                        help='mean number of electrons per macrobunch')
+    parser.add_argument('-microbunches', dest='microbunches', type=int, default=500,
+                        help='number of microbunches per macrobunch')
+    parser.add_argument('-per-file', dest='perFile', type=int, default=1000,
+                        help='number of macrobunches in each file')
+    parser.add_argument('-seed', dest='seed', type=int, default=0,
+                        help='seed of the random numbers')
+    args = parser.parse_args()
+
+    channels = misc.parse_category('DAQ channels') or synthetic.DEFAULT_CHANNELS
+    ubidOffset = misc.parse_setting('processor', 'ubid_offset')
+    files = synthetic.generate_run(args.path, args.runNumber, num_of_macrobunches=args.macrobunches,
+                                   electrons_per_macrobunch=args.electrons, num_of_microbunches=args.microbunches,
+                                   macrobunches_per_file=args.perFile, channels=channels,
+                                   ubid_offset=5 if ubidOffset is None else ubidOffset, seed=args.seed)
+    print('Wrote run {} in {} files in {}'.format(args.runNumber, len(files), args.path))
+
+
+if __name__ == '__main__':
+    main()
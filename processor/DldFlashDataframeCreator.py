@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from configparser import ConfigParser
 import dask
@@ -8,24 +11,83 @@ import dask.dataframe
 import dask.multiprocessing
 from dask.diagnostics import ProgressBar
 import numpy as np
+import pandas as pd
+import psutil
 from processor import DldProcessor
 from utilities import misc
-from processor.pah import BeamtimeDaqAccess
+from utilities import runindex
+from processor import h5daq
+from processor import columnstore
+
+# PAH is optional, the built-in h5daq reader is used without it, see DAQ_READER
+try:
+    from processor.pah import BeamtimeDaqAccess
+except (ImportError, KeyError):
+    BeamtimeDaqAccess = None
 
 _VERBOSE = False
 
-# Try to load the Cython version of the microbunch assignment code
-# If fails, load a vanilla python equivalent (Steinn Y. Agustsson)
-try:
-    import processor.cscripts.DldFlashProcessorCy as DldFlashProcessorCy
+_MANIFEST_VERSION = 1
+
+# settings which change the content of the converted dataframes, recorded in the manifests
+_CONVERSION_SETTINGS = ('UBID_OFFSET', 'TOF_STEP_TO_NS', 'TOF_IN_NS', 'COLUMN_DTYPES')
+
+# columns of the electron dataframe in normalized storage
+_ELECTRON_COLUMNS = ('dldPosX', 'dldPosY', 'dldTime', 'dldMicrobunchId', 'dldDetectorId', 'dldSectorId',
+                     'macroBunchPulseId')
+
+# The microbunch assignment uses the vectorized numpy version, which gives the same
+# output as the Cython (DldFlashProcessorCy) and pure python (DldFlashProcessorNotCy)
+# versions without a compilation step. See bin/benchmark_microbunch_assignment.py
+import processor.cscripts.DldFlashProcessorVectorized as DldFlashProcessorVectorized
+
+assignToMircobunch = DldFlashProcessorVectorized.assignToMircobunch
+assignCompactToMircobunch = DldFlashProcessorVectorized.assignCompactToMircobunch
+
+
+def _readSettings():
+    """ Parse SETTINGS.ini, from the processor folder or its parent."""
+    settings = ConfigParser()
+    if os.path.isfile(os.path.join(os.path.dirname(__file__), 'SETTINGS.ini')):
+        settings.read(os.path.join(os.path.dirname(__file__), 'SETTINGS.ini'))
+    else:
+        settings.read(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'SETTINGS.ini'))
+    return settings
+
+
+def _parquetRows(path):
+    """ Number of rows of a parquet dataset, from the footers of its files."""
+    try:
+        import pyarrow.dataset
+        return pyarrow.dataset.dataset(path, format='parquet').count_rows()
+    except ImportError:
+        import fastparquet
+        return fastparquet.ParquetFile(path).count()
+
 
-    if _VERBOSE:
-        print('loaded cython module')
-except ImportError as e:
-    print('Failed loading Cython script. Using Python version instead. TODO: FIX IT!!#n Error msg: {}'.format(e))
-    import processor.cscripts.DldFlashProcessorNotCy as DldFlashProcessorCy
+def _writeState(stateFile, state):
+    """ Write the state file of ``updateDataframes``, replacing the previous one atomically."""
+    tmpFile = stateFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmpFile, stateFile)
 
-assignToMircobunch = DldFlashProcessorCy.assignToMircobunch
+
+def _storedRows(fullName, format):
+    """ Number of rows of the stored electron and microbunch dataframes.
+
+    Only the metadata is read: the parquet footers, the shapes of the npy
+    indexes and the number of rows of the hdf5 tables."""
+    if format == 'parquet':
+        return {'el': _parquetRows(fullName + "_el"), 'mb': _parquetRows(fullName + "_mb")}
+    elif format == 'npy':
+        return {key: int(sum(len(np.load(os.path.join(partition, columnstore.INDEX_FILE), mmap_mode='r'))
+                             for partition in columnstore.partitionPaths(fullName + suffix)))
+                for key, suffix in (('el', '_el_npy'), ('mb', '_mb_npy'))}
+    else:
+        with pd.HDFStore(fullName, 'r') as store:
+            return {'el': int(store.get_storer('/electrons').nrows),
+                    'mb': int(store.get_storer('/microbunches').nrows)}
 
 
 class DldFlashProcessor(DldProcessor.DldProcessor):
@@ -66,8 +128,18 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
 
         self.runNumber = None
         self.pulseIdInterval = None
-
-    def readData(self, runNumber=None, pulseIdInterval=None, path=None):
+        self.electronOffsets = None
+        # counted by readData, or after the dataframe creation in lazy mode, see countElectrons
+        self.numOfElectrons = None
+        self.electronsPerMacrobunch = None
+        # path the raw data was read from, see readData
+        self.rawDataPath = None
+        # channels of the run read last, with their shape, dtype and macrobunch ID
+        # interval, see h5daq.runMetadata. None if read through PAH
+        self.runMetadata = None
+
+    def readData(self, runNumber=None, pulseIdInterval=None, path=None, streaming=False, lazy=False,
+                 normalized=False):
         """Read data by run number or macrobunch pulseID interval.
 
         Useful for scans that would otherwise hit the machine's memory limit.
@@ -80,6 +152,29 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
                 defined by runNumber will be taken.
             path : str | None (default to ``self.DATA_RAW_DIR``)
                 path to location where raw HDF5 files are stored
+            streaming : bool | False
+                if True, the electron dataframe is built lazily, one partition per
+                macrobunch range, instead of being computed and concatenated in memory.
+                See ``createDataframePerElectron`` for details.
+            lazy : bool | False
+                if True, each channel attribute (dldPosX, dldTime, bam, ...) is a dask array
+                backed by the raw HDF5 datasets, with chunks aligned to the macrobunch ranges
+                of the electron dataframe, instead of being loaded in memory through PAH.
+                Only the slices needed by each macrobunch range are then read, which allows
+                to process runs larger than the machine's memory. The files are always read
+                with h5py then, whatever the DAQ_READER setting.
+            normalized : bool | False
+                if True, the electron dataframe only holds the electron channels and the
+                (macroBunchPulseId, dldMicrobunchId) keys, while the macrobunch and microbunch
+                channels (delayStage, bam, gmdBda, ...) are only stored in the microbunch
+                dataframe. They are added to the electrons when a column is used for binning,
+                filtering or ``correctBAM``, see ``joinColumns``.
+
+        The channels are read through the reader selected by DAQ_READER, see
+        ``createDaqAccess``. With the h5py reader, and in lazy mode, the channels, their
+        shapes and macrobunch ID intervals are taken from a single cached scan of the
+        files, see ``h5daq.runMetadata``, which is kept in ``self.runMetadata``. With
+        PAH, ``self.runMetadata`` is None.
 
         This is a union of the readRun and readInterval methods defined in previous versions.
         """
@@ -99,33 +194,41 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
             raise ValueError('Need either runNumber or pulseIdInterval to know what data to read.')
 
         # parse settings and set all dataset addresses as attributes.
-        settings = ConfigParser()
-        if os.path.isfile(os.path.join(os.path.dirname(__file__), 'SETTINGS.ini')):
-            settings.read(os.path.join(os.path.dirname(__file__), 'SETTINGS.ini'))
-        else:
-            settings.read(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'SETTINGS.ini'))
+        settings = _readSettings()
 
         section = 'DAQ channels'
+        self.partitionPlan = None
+        self.usedColumns = set()
+        self.rawDataPath = path
 
         print('searching for data...')
         if path is not None:
             try:
-                daqAccess = BeamtimeDaqAccess.create(path)
+                daqAccess = self.createDaqAccess(path)
+                runPath = path
             except:
                 self.path_to_run = misc.get_path_to_run(runNumber, path)
-                daqAccess = BeamtimeDaqAccess.create(self.path_to_run)
+                daqAccess = self.createDaqAccess(self.path_to_run)
+                runPath = self.path_to_run
         else:
             path = self.DATA_RAW_DIR
             self.path_to_run = misc.get_path_to_run(runNumber, path)
-            daqAccess = BeamtimeDaqAccess.create(self.path_to_run)
-
-
+            daqAccess = self.createDaqAccess(self.path_to_run)
+            runPath = self.path_to_run
 
         self.daqAddresses = []
+        availableIds = self.getIds(runNumber, path)
+        if lazy or self.daqReader() == 'h5py':
+            # the files are scanned once, and the scan cached, instead of once per channel
+            self.runMetadata = h5daq.runMetadata(h5daq.runFiles(runPath, runNumber))
+            isChannelAvailable = lambda address: h5daq.isChannelInInterval(self.runMetadata, address, availableIds)
+        else:
+            self.runMetadata = None
+            isChannelAvailable = lambda address: daqAccess.isChannelAvailable(address, availableIds)
         for entry in settings[section]:
             name = misc.camelCaseIt(entry)
             val = str(settings[section][entry])
-            if daqAccess.isChannelAvailable(val, self.getIds(runNumber, path)):
+            if isChannelAvailable(val):
                 self.daqAddresses.append(name)
                 if _VERBOSE:
                     print('assigning address: {}: {}'.format(name.ljust(20), val))
@@ -135,18 +238,42 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
                 print('skipping address missing from data: {}: {}'.format(name.ljust(20), val))
 
         # TODO: get the available pulse id from PAH
-        if pulseIdInterval is None:
-            print('Reading DAQ data from run {}... Please wait...'.format(runNumber))
+        if lazy:
+            print('Reading DAQ data lazily from run {}...'.format(runNumber))
+            files = h5daq.runFiles(runPath, runNumber)
+            if pulseIdInterval is None:
+                if 'macroBunchPulseId' in self.daqAddresses:
+                    referenceChannel = self.macroBunchPulseId
+                else:
+                    referenceChannel = getattr(self, self.daqAddresses[0])
+                segments, numOfColumns = h5daq.channelSegments(files, referenceChannel)
+                pulseIdInterval = h5daq.pulseIdIntervalOfSegments(segments)
+                self.pulseIdInterval = pulseIdInterval
+            numOfMacrobunches = pulseIdInterval[1] - pulseIdInterval[0]
+            macroBunchPulseId_correction = pulseIdInterval[0]
+            if self.AUTO_TUNE:
+                channelColumns = {name: self.runMetadata['channels'][getattr(self, name)]['shape'][1]
+                                  for name in self.daqAddresses}
+                self.planPartitions(numOfMacrobunches, channelColumns)
+            chunks = tuple(indexTo - indexFrom for indexFrom, indexTo in self.macrobunchRanges(numOfMacrobunches))
 
             for address_name in self.daqAddresses:
                 if _VERBOSE:
-                    print('reading address: {}'.format(address_name))
-                try:
-                    attrVal = getattr(self, address_name)
-                    values, otherStuff = daqAccess.allValuesOfRun(attrVal, runNumber)
-                except AssertionError:
-                    print('Assertion error: {}'.format(address_name, attrVal, values, otherStuff ))
+                    print('creating lazy address: {}'.format(address_name))
+                setattr(self, address_name,
+                        h5daq.lazyValuesOfInterval(files, getattr(self, address_name), pulseIdInterval, chunks))
+            print('Run {0} contains {1:,} Macrobunches, from {2:,} to {3:,}'\
+                .format(runNumber, numOfMacrobunches, pulseIdInterval[0], pulseIdInterval[1]))
+
+            if 'timeStamp' in self.daqAddresses:
+                self.startEndTime = dask.compute(self.timeStamp[0, 0], self.timeStamp[-1, 0])
 
+        elif pulseIdInterval is None:
+            print('Reading DAQ data from run {}... Please wait...'.format(runNumber))
+
+            channelValues = self.readChannels(runPath, runNumber=runNumber)
+            for address_name in self.daqAddresses:
+                values, otherStuff = channelValues[address_name]
                 setattr(self, address_name, values)
                 if address_name == 'macroBunchPulseId':  # catch the value of the first macrobunchID
                     pulseIdInterval = (otherStuff[0], otherStuff[-1])
@@ -169,10 +296,9 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
         else:
             print('reading DAQ data from interval {}'.format(pulseIdInterval))
             self.pulseIdInterval = pulseIdInterval
+            channelValues = self.readChannels(runPath, pulseIdInterval=pulseIdInterval)
             for address_name in self.daqAddresses:
-                if _VERBOSE:
-                    print('reading address: {}'.format(address_name))
-                setattr(self, address_name, daqAccess.valuesOfInterval(getattr(self, address_name), pulseIdInterval))
+                setattr(self, address_name, channelValues[address_name][0])
             numOfMacrobunches = pulseIdInterval[1] - pulseIdInterval[0]
             macroBunchPulseId_correction = pulseIdInterval[0]
 
@@ -181,132 +307,251 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
         self.macroBunchPulseId -= macroBunchPulseId_correction
         self.dldMicrobunchId -= self.UBID_OFFSET
 
-        if _VERBOSE:
-            print('Counting electrons...')
-
-        electronsToCount = self.dldPosX.copy().flatten()
-        electronsToCount = np.nan_to_num(electronsToCount)
-        electronsToCount = electronsToCount[electronsToCount > 0]
-        electronsToCount = electronsToCount[electronsToCount < 10000]
-        self.numOfElectrons = len(electronsToCount)
-        self.electronsPerMacrobunch = int(self.numOfElectrons / numOfMacrobunches)
-        print("Number of electrons: {0:,}; {1:,} e/Mb ".format(self.numOfElectrons, self.electronsPerMacrobunch))
+        self.numOfElectrons = self.electronsPerMacrobunch = None
+        if not lazy:  # lazy channels are not read just to count the electrons
+            if _VERBOSE:
+                print('Counting electrons...')
+            electronsToCount = self.dldPosX.copy().flatten()
+            electronsToCount = np.nan_to_num(electronsToCount)
+            electronsToCount = electronsToCount[electronsToCount > 0]
+            electronsToCount = electronsToCount[electronsToCount < 10000]
+            self.numOfElectrons = len(electronsToCount)
+            self.electronsPerMacrobunch = int(self.numOfElectrons / numOfMacrobunches)
+            print("Number of electrons: {0:,}; {1:,} e/Mb ".format(self.numOfElectrons, self.electronsPerMacrobunch))
+
+        if self.AUTO_TUNE and not lazy:  # lazy channels were planned before creating their chunks
+            channelColumns = {name: np.shape(getattr(self, name))[1] if np.ndim(getattr(self, name)) > 1 else 1
+                              for name in self.daqAddresses}
+            self.planPartitions(numOfMacrobunches, channelColumns, self.numOfElectrons / numOfMacrobunches)
 
         print("Creating dataframes... Please wait...")
         pbar = ProgressBar()
         with pbar:
-            self.createDataframePerElectron()
+            self.createDataframePerElectron(streaming=streaming, normalized=normalized)
             print('Electron dataframe created.')
-            self.createDataframePerMicrobunch()
+            self.createDataframePerMicrobunch(normalized=normalized)
             print('Microbunch dataframe created.')
+        if lazy and self.electronOffsets is not None:  # counted while creating the dataframe
+            self.countElectrons()
+        if normalized:
+            self.buildMicrobunchTables()
+        else:
+            self.microbunchTables = None
+
+    def countElectrons(self):
+        """ Number of electrons of the data read by ``readData``.
 
-    def createDataframePerElectronRange(self, mbIndexStart, mbIndexEnd):
+        In lazy mode, the electrons are not counted by ``readData``, which would
+        read the whole dldPosX channel a first time. They are taken from
+        ``self.electronOffsets`` if the dataframe was created in memory, or else
+        counted from the lazy dldPosX channel, chunk by chunk, when this is called.
+
+        :Return:
+            numOfElectrons : int
+                number of electrons, also set as ``self.numOfElectrons``, along with
+                ``self.electronsPerMacrobunch``.
+        """
+        if self.numOfElectrons is None:
+            if self.electronOffsets is not None:
+                self.numOfElectrons = int(self.electronOffsets[-1])
+            else:
+                self.numOfElectrons = int(((self.dldPosX > 0) & (self.dldPosX < 10000)).sum().compute())
+            self.electronsPerMacrobunch = int(self.numOfElectrons / len(self.dldPosX))
+            print("Number of electrons: {0:,}; {1:,} e/Mb ".format(self.numOfElectrons, self.electronsPerMacrobunch))
+        return self.numOfElectrons
+
+    def createDaqAccess(self, rootDirectoryOfH5Files):
+        """ Create the reader of the raw DAQ files chosen by the DAQ_READER setting.
+
+        :Parameters:
+            rootDirectoryOfH5Files : str
+                the root directory of the HDF files.
+
+        :Return:
+            daqAccess : BeamtimeDaqAccess or h5daq.H5DaqAccess
+                reader with the allValuesOfRun, valuesOfInterval and
+                isChannelAvailable methods of PAH.
+        """
+        if self.daqReader() == 'pah':
+            return BeamtimeDaqAccess.create(rootDirectoryOfH5Files)
+        else:
+            return h5daq.H5DaqAccess.create(rootDirectoryOfH5Files)
+
+    def daqReader(self):
+        """ Reader of the raw DAQ files selected by the DAQ_READER setting.
+
+        :Return:
+            reader : str
+                'pah' or 'h5py', 'auto' resolved to 'pah' if PAH can be imported.
+        """
+        reader = self.DAQ_READER.lower()
+        if reader == 'pah' or (reader == 'auto' and BeamtimeDaqAccess is not None):
+            if BeamtimeDaqAccess is None:
+                raise ImportError('PAH not found in PAH_MODULE_DIR, set DAQ_READER to h5py to read without it.')
+            return 'pah'
+        elif reader in ['h5py', 'auto']:
+            return 'h5py'
+        else:
+            raise ValueError('Invalid DAQ_READER {}, choose between auto, pah and h5py.'.format(self.DAQ_READER))
+
+    def readChannels(self, runPath, runNumber=None, pulseIdInterval=None):
+        """ Read all the DAQ channels concurrently through a pool of I/O threads.
+
+        The channels are read by ``self.N_IO_THREADS`` threads, each with its own
+        DAQ reader, see ``createDaqAccess``. h5py serializes all its calls on a
+        global lock, so the HDF5 reads and decompression themselves do not run in
+        parallel: the threads only overlap the latency of the file system (opening
+        files, waiting on network storage such as GPFS) and the python work of the
+        reader between the reads, e.g. the bookkeeping of PAH. With the h5py reader, intervals are
+        read directly from the rows where they are stored, found from the cached
+        segment index of ``h5daq``.
+
+        :Parameters:
+            runPath : str
+                path to the raw HDF5 files of the run.
+            runNumber : int | None
+                number of the run to read.
+            pulseIdInterval : (int, int) | None
+                first and last macrobunches of the data range to read.
+
+        :Return:
+            channelValues : dict
+                (values, otherStuff) of each channel in ``self.daqAddresses``, as
+                returned by PAH. otherStuff is None when reading an interval.
+        """
+        useSegments = pulseIdInterval is not None and self.daqReader() == 'h5py'
+        if useSegments:
+            files = h5daq.runFiles(runPath, runNumber)
+
+        def readChannel(address_name):
+            t0 = time.time()
+            attrVal = getattr(self, address_name)
+            try:
+                if pulseIdInterval is None:
+                    daqAccess = self.createDaqAccess(runPath)
+                    values, otherStuff = daqAccess.allValuesOfRun(attrVal, runNumber)
+                elif useSegments:
+                    values, otherStuff = h5daq.valuesOfInterval(files, attrVal, pulseIdInterval), None
+                else:
+                    daqAccess = self.createDaqAccess(runPath)
+                    values, otherStuff = daqAccess.valuesOfInterval(attrVal, pulseIdInterval), None
+            except AssertionError:
+                print('Assertion error: {} {}'.format(address_name, attrVal))
+                raise
+            return values, otherStuff, time.time() - t0
+
+        t0 = time.time()
+        nThreads = max(1, min(self.N_IO_THREADS, len(self.daqAddresses)))
+        with ThreadPoolExecutor(max_workers=nThreads) as executor:
+            results = dict(zip(self.daqAddresses, executor.map(readChannel, self.daqAddresses)))
+
+        channelValues = {}
+        for address_name, (values, otherStuff, readTime) in results.items():
+            print('read {}: {:.2f} s'.format(address_name.ljust(20), readTime))
+            channelValues[address_name] = (values, otherStuff)
+        print('Read {} channels in {:.2f} s with {} threads'.format(len(channelValues), time.time() - t0, nThreads))
+        return channelValues
+
+    def createDataframePerElectronRange(self, mbIndexStart, mbIndexEnd, channels=None, normalized=False):
         """Create a numpy array indexed by photoelectron events for a given range,
         [start, end), of electron macrobunch IDs.
-        
+
+        The DLD channels are NaN padded (macrobunch, electron) arrays. Only the
+        valid hits, those with a microbunch ID > -1, are kept, in a compact
+        (CSR-like) layout: the electrons of macrobunch i are the events
+        electronOffsets[i] to electronOffsets[i+1], and the per-macrobunch
+        and per-microbunch channels are gathered for these events only.
+
         :Parameters:
             mbIndexStart : int
                 The starting (inclusive) macrobunch ID.
             mbIndexEnd : int
                 The ending (non-inclusive) macrobunch ID.
+            channels : dict | None
+                The channel values of the macrobunch range, keyed by channel name.
+                If None, they are sliced from the channel attributes.
+            normalized : bool | False
+                If True, only the electron channels and macroBunchPulseId are created.
         
         :Return:
-            da : numpy array
-                Indexed photoelectron events
+            df : pandas dataframe
+                Indexed photoelectron events, with the column dtypes of ``self.COLUMN_DTYPES``.
+            electronOffsets : numpy array
+                Index of the first event of each macrobunch, plus the total number
+                of events as last element.
         """
-        # the chunk size here is too large in order to do the chunking by the loop around it.
-
         # Here all the columns to be stored in the dd dataframe are created from the raw h5 file
         # Each columns requires an ad hoc treatment, so they all need to be done individually
-        arrayCols = []  # TODO: find less ad hoc solution
+        arrayCols = {}  # TODO: find less ad hoc solution
 
-        if 'dldPosX' in self.daqAddresses:
-            daX = self.dldPosX[mbIndexStart:mbIndexEnd, :].flatten()
-            arrayCols.append(daX)
+        if channels is None:
+            channels = {name: getattr(self, name)[mbIndexStart:mbIndexEnd] for name in self.daqAddresses}
 
-        if 'dldPosY' in self.daqAddresses:
-            daY = self.dldPosY[mbIndexStart:mbIndexEnd, :].flatten()
-            arrayCols.append(daY)
+        # negative values (and the NaN padding) mark bad data
+        validHits = channels['dldMicrobunchId'] > -1
+        electronsPerMacrobunch = validHits.sum(axis=1)
+        electronOffsets = np.concatenate(([0], np.cumsum(electronsPerMacrobunch)))
+        macrobunchIndex = np.repeat(np.arange(validHits.shape[0]), electronsPerMacrobunch)
+        microbunchIds = channels['dldMicrobunchId'][validHits].astype(np.float64)
 
-        if 'dldTime' in self.daqAddresses:
-            daTime = self.dldTime[mbIndexStart:mbIndexEnd, :].flatten()
-            arrayCols.append(daTime)
+        def perMacrobunch(values):
+            return np.repeat(values, electronsPerMacrobunch)
 
-        if 'delayStage' in self.daqAddresses:
-            delayStageArray = np.zeros_like(self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :])
-            delayStageArray[:, :] = (self.delayStage[mbIndexStart:mbIndexEnd])[:, None]
-            daDelaystage = delayStageArray.flatten()
-            arrayCols.append(daDelaystage)
+        def perMicrobunch(values):
+            return assignCompactToMircobunch(macrobunchIndex, microbunchIds, values.astype(np.float64))
 
-        if 'bam' in self.daqAddresses:
-            bamArray = assignToMircobunch(
-                self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].astype(np.float64),
-                self.bam[mbIndexStart:mbIndexEnd, :].astype(np.float64))
-            daBam = bamArray.flatten()
-            arrayCols.append(daBam)
+        if normalized:  # slow channels stay in the microbunch dataframe
+            channelNames = [name for name in self.daqAddresses if name in _ELECTRON_COLUMNS]
+        else:
+            channelNames = self.daqAddresses
 
-        if 'dldMicrobunchId' in self.daqAddresses:
-            daMicrobunchId = self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].flatten()
-            arrayCols.append(daMicrobunchId)
+        if 'dldPosX' in channelNames:
+            arrayCols['dldPosX'] = channels['dldPosX'][validHits]
 
-        if 'dldDetectorId' in self.daqAddresses:
-            dldDetectorId = (self.dldDetectorId[mbIndexStart:mbIndexEnd, :].copy()).astype(int) % 2
-            daDetectorId = dldDetectorId.flatten()
-            arrayCols.append(daDetectorId)
+        if 'dldPosY' in channelNames:
+            arrayCols['dldPosY'] = channels['dldPosY'][validHits]
 
-        if 'dldSectorId' in self.daqAddresses:
-            dldSectorId = (self.dldSectorId[mbIndexStart:mbIndexEnd, :].copy()).astype(int) % 8
-            daSectorId = dldSectorId.flatten()
-            arrayCols.append(daSectorId)
+        if 'dldTime' in channelNames:
+            arrayCols['dldTime'] = channels['dldTime'][validHits]
 
-        if 'bunchCharge' in self.daqAddresses:
-            bunchChargeArray = assignToMircobunch(
-                self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].astype(np.float64),
-                self.bunchCharge[mbIndexStart:mbIndexEnd, :].astype(np.float64))
-            daBunchCharge = bunchChargeArray.flatten()
-            arrayCols.append(daBunchCharge)
+        if 'delayStage' in channelNames:
+            arrayCols['delayStage'] = perMacrobunch(channels['delayStage'])
 
-        if 'opticalDiode' in self.daqAddresses:
-            opticalDiodeArray = assignToMircobunch(
-                self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].astype(np.float64),
-                self.opticalDiode[mbIndexStart:mbIndexEnd, :].astype(np.float64))
-            daOpticalDiode = opticalDiodeArray.flatten()
-            arrayCols.append(daOpticalDiode)
+        if 'bam' in channelNames:
+            arrayCols['bam'] = perMicrobunch(channels['bam'])
+
+        if 'dldMicrobunchId' in channelNames:
+            arrayCols['dldMicrobunchId'] = microbunchIds
+
+        if 'dldDetectorId' in channelNames:
+            arrayCols['dldDetectorId'] = channels['dldDetectorId'][validHits].astype(int) % 2
 
-        if 'gmdTunnel' in self.daqAddresses:
-            gmdTunnelArray = assignToMircobunch(
-                self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].astype(np.float64),
-                self.gmdTunnel[mbIndexStart:mbIndexEnd, :].astype(np.float64))
-            daGmdTunnel = gmdTunnelArray.flatten()
-            arrayCols.append(daGmdTunnel)
+        if 'dldSectorId' in channelNames:
+            arrayCols['dldSectorId'] = channels['dldSectorId'][validHits].astype(int) % 8
 
-        if 'gmdBda' in self.daqAddresses:
-            gmdBdaArray = assignToMircobunch(
-                self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].astype(np.float64),
-                self.gmdBda[mbIndexStart:mbIndexEnd, :].astype(np.float64))
-            daGmdBda = gmdBdaArray.flatten()
-            arrayCols.append(daGmdBda)
+        if 'bunchCharge' in channelNames:
+            arrayCols['bunchCharge'] = perMicrobunch(channels['bunchCharge'])
+
+        if 'opticalDiode' in channelNames:
+            arrayCols['opticalDiode'] = perMicrobunch(channels['opticalDiode'])
+
+        if 'gmdTunnel' in channelNames:
+            arrayCols['gmdTunnel'] = perMicrobunch(channels['gmdTunnel'])
+
+        if 'gmdBda' in channelNames:
+            arrayCols['gmdBda'] = perMicrobunch(channels['gmdBda'])
 
         # convert the laser polarization motor position to the electron format
-        if 'pumpPol' in self.daqAddresses:
-            pumpPolArray = np.zeros_like(self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :])
-            pumpPolArray[:, :] = (self.pumpPol[mbIndexStart:mbIndexEnd, 0])[:, None]
-            daPumpPol = pumpPolArray.flatten()
-            arrayCols.append(daPumpPol)
+        if 'pumpPol' in channelNames:
+            arrayCols['pumpPol'] = perMacrobunch(channels['pumpPol'][:, 0])
 
         # convert the MacroBunchPulseId to the electron format. No check because this surely exists
-        if 'macroBunchPulseId' in self.daqAddresses:
-            macroBunchPulseIdArray = np.zeros_like(self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :])
-            macroBunchPulseIdArray[:, :] = (self.macroBunchPulseId[mbIndexStart:mbIndexEnd, 0])[:, None]
-            daMacroBunchPulseId = macroBunchPulseIdArray.flatten()
-            arrayCols.append(daMacroBunchPulseId)
+        if 'macroBunchPulseId' in channelNames:
+            arrayCols['macroBunchPulseId'] = perMacrobunch(channels['macroBunchPulseId'][:, 0])
 
         # convert the timeStamp to the electron format. No check because this surely exists
-        if 'timeStamp' in self.daqAddresses:
-            timeStampArray = np.zeros_like(self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :])
-            timeStampArray[:, :] = (self.timeStamp[mbIndexStart:mbIndexEnd, 0])[:, None]
-            daTimeStamp = timeStampArray.flatten()
-            arrayCols.append(daTimeStamp)
+        if 'timeStamp' in channelNames:
+            arrayCols['timeStamp'] = perMacrobunch(channels['timeStamp'][:, 0])
 
         # the Aux channel: aux0:
         # aux0Arr= assignToMircobunch(self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].astype(np.float64), self.dldAux[mbIndexStart:mbIndexEnd, 0].astype(np.float64))
@@ -316,16 +561,102 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
         # aux1Arr= assignToMircobunch(self.dldMicrobunchId[mbIndexStart:mbIndexEnd, :].astype(np.float64), self.dldAux[mbIndexStart:mbIndexEnd, 1].astype(np.float64))
         # daAux1 = dask.array.from_array(aux0Arr.flatten(), chunks=(chunks))
 
-        # added macroBunchPulseId at last position
-        # da = dask.array.stack([daX, daY, daTime, daDelaystage, daBam, daMicrobunchId,
-        #                       daDetectorId, daSectorId, daBunchCharge, daOpticalDiode,
-        #                       daGmdTunnel, daMacroBunchPulseId])
-        da = np.stack(arrayCols)
-        return da
+        df = self.castToColumnDtypes(pd.DataFrame(arrayCols))
+        return df, electronOffsets
+
+    def planPartitions(self, numOfMacrobunches, channelColumns, electronsPerMacrobunch=None):
+        """ Choose the partition size and the number of workers from the available memory.
+
+        The memory needed to create a partition is estimated per macrobunch from the
+        values of the padded electron channels and of the microbunch channels, and
+        from the compacted electron table, plus a factor 2 for temporaries. The number of
+        workers is the number of CPUs, reduced if the budget, ``MEMORY_FRACTION`` of the
+        available memory, cannot hold a reasonable partition per worker. The partitions
+        are then as large as the budget allows, with at least one per worker.
+
+        The plan is stored in ``self.partitionPlan`` and used by ``macrobunchRanges``,
+        the creation of the electron dataframe and ``computeBinnedData``.
+
+        :Parameters:
+            numOfMacrobunches : int
+                The number of macrobunches to process.
+            channelColumns : dict
+                The number of values per macrobunch of each channel in ``self.daqAddresses``.
+            electronsPerMacrobunch : float | None (default to the values per macrobunch of dldTime)
+                The average number of valid electrons per macrobunch.
+
+        :Return:
+            partitionPlan : dict
+                'workers', 'macrobunchesPerPartition', 'rowsPerPartition',
+                'bytesPerMacrobunch' and 'memoryBudget'.
+        """
+        if electronsPerMacrobunch is None:
+            electronsPerMacrobunch = channelColumns['dldTime']
+        bytesPerMacrobunch = 2 * 8 * (sum(channelColumns.values()) + len(channelColumns) * electronsPerMacrobunch)
+        memoryBudget = self.MEMORY_FRACTION * psutil.virtual_memory().available
+
+        minMacrobunchesPerPartition = 100
+        workers = int(max(1, min(psutil.cpu_count(),
+                                 memoryBudget // (bytesPerMacrobunch * minMacrobunchesPerPartition))))
+        macrobunchesPerPartition = int(max(1, min(memoryBudget // (bytesPerMacrobunch * workers),
+                                                  np.ceil(numOfMacrobunches / workers))))
+
+        self.partitionPlan = {
+            'workers': workers,
+            'macrobunchesPerPartition': macrobunchesPerPartition,
+            'rowsPerPartition': int(max(1, macrobunchesPerPartition * electronsPerMacrobunch)),
+            'bytesPerMacrobunch': int(bytesPerMacrobunch),
+            'memoryBudget': int(memoryBudget),
+        }
+        print('Partition plan: {} workers, {:,} macrobunches per partition, {:.1f} GB budget'.format(
+            workers, macrobunchesPerPartition, memoryBudget / 2 ** 30))
+        return self.partitionPlan
+
+    def macrobunchRanges(self, numOfMacrobunches):
+        """Split the macrobunches in the ranges from which the partitions of
+        the electron dataframe are created.
 
-    def createDataframePerElectron(self):
+        :Parameters:
+            numOfMacrobunches : int
+                The number of macrobunches to split.
+
+        :Return:
+            ranges : list of (int, int)
+                The starting (inclusive) and ending (non-inclusive) macrobunch index of each range.
+        """
+        if self.partitionPlan is not None:
+            chunkSize = self.partitionPlan['macrobunchesPerPartition']
+        else:
+            chunkSize = min(self.CHUNK_SIZE, numOfMacrobunches / self.N_CORES)  # ensure minimum one chunk per core.
+        numOfPartitions = int(numOfMacrobunches / chunkSize) + 1
+
+        ranges = []
+        for i in range(0, numOfPartitions):
+            indexFrom = int(i * chunkSize)
+            indexTo = int(min((i + 1) * chunkSize, numOfMacrobunches))
+            if indexTo > indexFrom:
+                ranges.append((indexFrom, indexTo))
+        return ranges
+
+    def createDataframePerElectron(self, streaming=False, normalized=False):
         """Create a dataframe indexed by photoelectron events from the read arrays
-        (either from the test file or the run number). The method needs no input parameters.
+        (either from the test file or the run number).
+
+        :Parameters:
+            streaming : bool | False
+                If False, all macrobunch ranges are computed, concatenated in a single
+                array and then wrapped in a dask dataframe.
+                If True, each macrobunch range becomes a lazy partition of the dask
+                dataframe, which is only created when computed. Storing the dataframe
+                with ``storeDataframes`` then writes each range to its own parquet file
+                as soon as it is produced, so that peak memory is bounded by one chunk
+                per worker instead of several times the run size.
+            normalized : bool | False
+                If True, the macrobunch and microbunch channels are left out, see ``readData``.
+
+        Only valid electrons are stored, see ``createDataframePerElectronRange``.
+        If not streaming, ``self.electronOffsets`` holds the index of the first
+        electron of each macrobunch in the dataframe.
         """
 
         # self.dldTime=self.dldTime*self.dldTimeStep
@@ -333,130 +664,207 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
             print('creating electron dataframe...')
 
         maxIndex = self.dldTime.shape[0]
-        chunkSize = min(self.CHUNK_SIZE, maxIndex / self.N_CORES)  # ensure minimum one chunk per core.
-        numOfPartitions = int(maxIndex / chunkSize) + 1
+
+        cols = ('dldPosX', 'dldPosY', 'dldTime', 'delayStage', 'bam', 'dldMicrobunchId', 'dldDetectorId', 'dldSectorId', 'bunchCharge',
+                'opticalDiode', 'gmdTunnel', 'gmdBda', 'pumpPol', 'macroBunchPulseId', 'timeStamp')
+        cols = tuple(x for x in cols if x in self.daqAddresses)
+        if normalized:
+            cols = tuple(x for x in cols if x in _ELECTRON_COLUMNS)
+
+        if streaming:
+            electronsPerMacrobunch = self.dldTime.shape[1]
+
+            def rangeToDataframe(indexFrom, indexTo, channels=None):
+                # a range holds at most electronsPerMacrobunch events per macrobunch,
+                # so starting its index at the first slot of the range keeps it unique
+                df, electronOffsets = self.createDataframePerElectronRange(indexFrom, indexTo, channels, normalized)
+                df.index = pd.RangeIndex(indexFrom * electronsPerMacrobunch,
+                                         indexFrom * electronsPerMacrobunch + len(df))
+                return df
+
         daList = []
 
-        for i in range(0, numOfPartitions):
-            indexFrom = int(i * chunkSize)
-            indexTo = int(min(indexFrom + chunkSize, maxIndex))
-            result = dask.delayed(self.createDataframePerElectronRange)(indexFrom, indexTo)
-            daList.append(result)
+        for indexFrom, indexTo in self.macrobunchRanges(maxIndex):
+            channels = None
+            if isinstance(self.dldTime, dask.array.Array):
+                # lazy channels: dask reads the slices of this range only and
+                # passes them as numpy arrays
+                channels = {name: getattr(self, name)[indexFrom:indexTo] for name in cols}
+            if streaming:
+                daList.append(dask.delayed(rangeToDataframe)(indexFrom, indexTo, channels))
+            else:
+                result = dask.delayed(self.createDataframePerElectronRange)(indexFrom, indexTo, channels, normalized)
+                daList.append(result)
         # self.dd = self.createDataframePerElectronRange(0, maxIndex)
 
         # Create the electron-indexed dataframe
-        self.daListResult = dask.compute(*daList)
-
-        a = np.concatenate(self.daListResult, axis=1)
-        da = dask.array.from_array(a.T, chunks=self.CHUNK_SIZE)
+        if streaming:
+            meta = self.castToColumnDtypes(pd.DataFrame(np.empty((0, len(cols)), dtype=np.float64), columns=cols))
+            self.dd = dask.dataframe.from_delayed(daList, meta=meta)
+            self.electronOffsets = None
+        else:
+            if self.partitionPlan is not None:
+                self.daListResult = dask.compute(*daList, num_workers=self.partitionPlan['workers'])
+            else:
+                self.daListResult = dask.compute(*daList)
 
-        cols = ('dldPosX', 'dldPosY', 'dldTime', 'delayStage', 'bam', 'dldMicrobunchId', 'dldDetectorId', 'dldSectorId', 'bunchCharge',
-                'opticalDiode', 'gmdTunnel', 'gmdBda', 'pumpPol', 'macroBunchPulseId', 'timeStamp')
+            df = pd.concat([df for df, electronOffsets in self.daListResult], ignore_index=True)
+            # offsets of the ranges, shifted to the position of each range in the dataframe
+            offsets = [electronOffsets for da, electronOffsets in self.daListResult]
+            shifts = np.cumsum([0] + [o[-1] for o in offsets[:-1]])
+            self.electronOffsets = np.concatenate([offsets[0][:1]] + [o[1:] + shift for o, shift in zip(offsets, shifts)])
 
-        cols = tuple(x for x in cols if x in self.daqAddresses)
-        self.dd = dask.dataframe.from_array(da, columns=cols)
-        # needed as negative values are used to mark bad data
-        self.dd = self.dd[self.dd['dldMicrobunchId'] > -1]
+            chunkSize = self.CHUNK_SIZE if self.partitionPlan is None else self.partitionPlan['rowsPerPartition']
+            self.dd = dask.dataframe.from_pandas(df, chunksize=chunkSize)
         # I propose leaving it like this, since energy calibration depends on microscope parameters and photon energy; CHANGED: default is as before, but if attribute TOF_IN_NS is set to true, it leaves the delay in steps.
         if self.TOF_IN_NS:
-            self.dd['dldTime'] = self.dd['dldTime'] * self.TOF_STEP_TO_NS
+            self.dd['dldTime'] = (self.dd['dldTime'] * self.TOF_STEP_TO_NS).astype(self.dd['dldTime'].dtype)
+
+    def createDataframePerMicrobunch(self, normalized=False):
+        """Create a dataframe indexed by the microbunch ID.
 
-    def createDataframePerMicrobunch(self):
-        """Create a dataframe indexed by the microbunch ID. The method needs no input parameters.
+        :Parameters:
+            normalized : bool | False
+                If True, the dldMicrobunchId and the GMD channels are added, so that
+                the dataframe holds all the values needed by the normalized electron
+                dataframe (see ``readData``).
         """
 
         if _VERBOSE:
             print('creating microbunch dataframe...')
 
+        # lazy channels are loaded here, since the microbunch channels are small
+        # compared to the electron ones. Of the aux channels, only the used column is read.
+        channels = {}
+        for name in ('delayStage', 'bam', 'bunchCharge', 'opticalDiode', 'gmdTunnel', 'gmdBda', 'pumpPol',
+                     'macroBunchPulseId', 'timeStamp'):
+            if name in self.daqAddresses:
+                channels[name] = np.asarray(getattr(self, name))
+
         arrayCols = []
-        numOfMicrobunches = self.bam.shape[1]
-        lengthToPad = numOfMicrobunches - self.opticalDiode.shape[1]
+        numOfMicrobunches = channels['bam'].shape[1]
+        lengthToPad = numOfMicrobunches - channels['opticalDiode'].shape[1]
 
         if 'delayStage' in self.daqAddresses:
-            delayStageArray = np.zeros_like(self.bam)
-            delayStageArray[:, :] = (self.delayStage[:])[:, None]
+            delayStageArray = np.zeros_like(channels['bam'])
+            delayStageArray[:, :] = (channels['delayStage'][:])[:, None]
             daDelayStage = dask.array.from_array(delayStageArray.flatten(), chunks=self.CHUNK_SIZE)
             arrayCols.append(daDelayStage)
 
         if 'bam' in self.daqAddresses:
-            daBam = dask.array.from_array(self.bam.flatten(), chunks=(self.CHUNK_SIZE))
+            daBam = dask.array.from_array(channels['bam'].flatten(), chunks=(self.CHUNK_SIZE))
             arrayCols.append(daBam)
 
         if 'dldAux0' in self.daqAddresses:
-            dldAux0 = self.dldAux0[:, 0]
-            aux0 = np.ones(self.bam.shape) * dldAux0[:, None]
+            dldAux0 = np.asarray(self.dldAux0[:, 0])
+            aux0 = np.ones(channels['bam'].shape) * dldAux0[:, None]
             daAux0 = dask.array.from_array(aux0.flatten(), chunks=(self.CHUNK_SIZE))
             arrayCols.append(daAux0)
 
         if 'dldAux1' in self.daqAddresses:
-            dldAux1 = self.dldAux1[:, 1]
-            aux1 = np.ones(self.bam.shape) * dldAux1[:, None]
+            dldAux1 = np.asarray(self.dldAux1[:, 1])
+            aux1 = np.ones(channels['bam'].shape) * dldAux1[:, None]
             daAux1 = dask.array.from_array(aux1.flatten(), chunks=(self.CHUNK_SIZE))
             arrayCols.append(daAux1)
 
         if 'bunchCharge' in self.daqAddresses:
-            daBunchCharge = dask.array.from_array(self.bunchCharge[:, 0:numOfMicrobunches].flatten(),
+            daBunchCharge = dask.array.from_array(channels['bunchCharge'][:, 0:numOfMicrobunches].flatten(),
                                                   chunks=(self.CHUNK_SIZE))
             arrayCols.append(daBunchCharge)
 
         if 'opticalDiode' in self.daqAddresses:
             try:
-                paddedOpticalDiode = np.pad(self.opticalDiode, ((0, 0), (0, lengthToPad)), 'constant',
+                paddedOpticalDiode = np.pad(channels['opticalDiode'], ((0, 0), (0, lengthToPad)), 'constant',
                                             constant_values=(0, 0))
                 daOpticalDiode = dask.array.from_array(paddedOpticalDiode.flatten(), chunks=self.CHUNK_SIZE)
             except:
-                print('fix optical diode DAQ: Length: ' + str(self.opticalDiode.shape[1]))
-                daOpticalDiode = dask.array.from_array(self.opticalDiode[:, 0:numOfMicrobunches].flatten(),
+                print('fix optical diode DAQ: Length: ' + str(channels['opticalDiode'].shape[1]))
+                daOpticalDiode = dask.array.from_array(channels['opticalDiode'][:, 0:numOfMicrobunches].flatten(),
                                                        chunks=self.CHUNK_SIZE)
             arrayCols.append(daOpticalDiode)
 
         if 'pumpPol' in self.daqAddresses:
-            pumpPolArray = np.zeros_like(self.bam)
-            pumpPolArray[:] = (self.pumpPol[:, 0])[:, None]
+            pumpPolArray = np.zeros_like(channels['bam'])
+            pumpPolArray[:] = (channels['pumpPol'][:, 0])[:, None]
             daPumpPol = dask.array.from_array(pumpPolArray.flatten(), chunks=self.CHUNK_SIZE)
             arrayCols.append(daPumpPol)
 
         if 'macroBunchPulseId' in self.daqAddresses:
-            macroBunchPulseIdArray = np.zeros_like(self.bam)
-            macroBunchPulseIdArray[:, :] = (self.macroBunchPulseId[:, 0])[:, None]
+            macroBunchPulseIdArray = np.zeros_like(channels['bam'])
+            macroBunchPulseIdArray[:, :] = (channels['macroBunchPulseId'][:, 0])[:, None]
             daMacroBunchPulseId = dask.array.from_array(macroBunchPulseIdArray.flatten(), chunks=(self.CHUNK_SIZE))
             arrayCols.append(daMacroBunchPulseId)
 
         if 'timeStamp' in self.daqAddresses:
-            timeStampArray = np.zeros_like(self.bam)
-            timeStampArray[:, :] = (self.timeStamp[:, 0])[:, None]
+            timeStampArray = np.zeros_like(channels['bam'])
+            timeStampArray[:, :] = (channels['timeStamp'][:, 0])[:, None]
             daTimeStamp = dask.array.from_array(timeStampArray.flatten(), chunks=(self.CHUNK_SIZE))
             arrayCols.append(daTimeStamp)
 
-        da = dask.array.stack(arrayCols)
-
-        # Create the microbunch-indexed dataframe
         cols = (
             'delayStage', 'bam', 'dldAux0', 'dldAux1', 'bunchCharge', 'opticalDiode', 'pumpPol', 'macroBunchPulseId', 'timeStamp')
         cols = tuple(x for x in cols if x in self.daqAddresses)
 
-        self.ddMicrobunches = dask.dataframe.from_array(da.T, columns=cols)
+        if normalized:
+            for name in ('gmdTunnel', 'gmdBda'):
+                if name in self.daqAddresses:
+                    gmd = np.full(channels['bam'].shape, np.nan)
+                    length = min(numOfMicrobunches, channels[name].shape[1])
+                    gmd[:, :length] = channels[name][:, :length]
+                    arrayCols.append(dask.array.from_array(gmd.flatten(), chunks=self.CHUNK_SIZE))
+                    cols += (name,)
+            microbunchIdArray = np.zeros_like(channels['bam'])
+            microbunchIdArray[:, :] = np.arange(numOfMicrobunches)[None, :]
+            arrayCols.append(dask.array.from_array(microbunchIdArray.flatten(), chunks=self.CHUNK_SIZE))
+            cols += ('dldMicrobunchId',)
 
-    def storeDataframes(self, fileName=None, path=None, format='parquet', append=False):
+        da = dask.array.stack(arrayCols)
+
+        # Create the microbunch-indexed dataframe
+
+        self.ddMicrobunches = self.castToColumnDtypes(dask.dataframe.from_array(da.T, columns=cols))
+
+    def storeDataframes(self, fileName=None, path=None, format='parquet', append=False, sortBy=None):
         """ Save imported dask dataframe as a parquet or hdf5 file.
 
+        Each partition of the electron dataframe is written to its own parquet file.
+        If the data was read with ``readData(streaming=True)``, partitions are only
+        created while being written, which keeps the memory usage low for long runs.
+
         :Parameters:
             fileName : str | None
                 The file namestring.
             path : str | None (default to ``self.DATA_PARQUET_DIR`` or ``self.DATA_H5_DIR``)
                 The path to the folder to save the format-converted data.
             format : str | 'parquet'
-                The output file format, possible choices are 'parquet', 'h5' or 'hdf5'.
+                The output file format, possible choices are 'parquet', 'h5', 'hdf5' or
+                'npy' (memory-mapped column store, see ``processor.columnstore``).
             append : bool | False (disable data appending as default)
-                When using parquet file, allows to append the data to pre-existing files.
+                When using parquet or npy files, allows to append the data to pre-existing files.
+            sortBy : list of str | None
+                Columns by which the electrons of each partition are sorted before
+                writing, e.g. ['delayStage'] so that each row group covers a narrow delay
+                window. By default electrons are in macrobunch order, i.e. sorted by
+                macroBunchPulseId.
+
+        A '<fileName>_manifest.json' file is written next to the dataframes, with the
+        raw files, channels and settings they were converted from, and their number
+        of rows, see ``checkManifest``. It is written before the dataframes and
+        completed with the rows once they are written. The raw files are None if the
+        run is not found, e.g. for dataframes created in memory.
+
+        The parquet codecs and row group size are set by the PARQUET_* settings,
+        see ``parquetWriteOptions``. The min and max of each column are stored for
+        each row group, so that ``readDataframes(filters=...)`` only reads the row
+        groups matching the filters.
         """
 
         format = format.lower()
-        assert format in ['parquet', 'h5', 'hdf5'], 'Invalid format for data input. Please select between parquet or h5'
+        assert format in ['parquet', 'h5', 'hdf5', 'npy'], 'Invalid format for data input. Please select between parquet, h5 or npy'
         
         # Update instance attributes based on input parameters
         if path is None:
-            if format == 'parquet':
+            if format in ['parquet', 'npy']:
                 path = self.DATA_PARQUET_DIR
             elif format in ['hdf5', 'h5']:
                 path = self.DATA_H5_DIR
@@ -468,14 +876,252 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
                 fileName = 'run{}'.format(self.runNumber)
         fileName = path + fileName  # TODO: test if naming is correct
 
+        dd = self.dd
+        if sortBy is not None:
+            dd = dd.map_partitions(lambda part: part.sort_values(list(sortBy), kind='stable'), meta=dd._meta)
+
+        # the manifest is written before the data, without rows until they are written,
+        # so that an interrupted conversion is not mistaken for a complete one
+        manifest = self.conversionInputs(self.runNumber, self.rawDataPath)
+        manifest.update({'version': _MANIFEST_VERSION, 'created': datetime.now().isoformat(), 'format': format,
+                         'pulseIdInterval': None if self.pulseIdInterval is None else
+                         [int(i) for i in self.pulseIdInterval],
+                         'rows': None})
+        self._writeManifest(fileName, manifest)
+
         if format == 'parquet':
-            self.dd.to_parquet(fileName + "_el", compression="UNCOMPRESSED", \
-                               append=append, ignore_divisions=True)
-            self.ddMicrobunches.to_parquet(fileName + "_mb", compression="UNCOMPRESSED", \
-                                           append=append, ignore_divisions=True)
+            dd.to_parquet(fileName + "_el", append=append, ignore_divisions=True,
+                          **self.parquetWriteOptions(dd))
+            self.ddMicrobunches.to_parquet(fileName + "_mb", append=append, ignore_divisions=True,
+                                           **self.parquetWriteOptions(self.ddMicrobunches))
         elif format in ['hdf5', 'h5']:
-            dask.dataframe.to_hdf(self.dd, fileName, '/electrons')
+            dask.dataframe.to_hdf(dd, fileName, '/electrons')
             dask.dataframe.to_hdf(self.ddMicrobunches, fileName, '/microbunches')
+        elif format == 'npy':
+            nWorkers = self.N_CORES if self.partitionPlan is None else self.partitionPlan['workers']
+            columnstore.storeDataframe(dd, fileName + "_el_npy", append=append, numWorkers=nWorkers)
+            columnstore.storeDataframe(self.ddMicrobunches, fileName + "_mb_npy", append=append, numWorkers=nWorkers)
+
+        manifest['rows'] = _storedRows(fileName, format)
+        self._writeManifest(fileName, manifest)
+
+    @staticmethod
+    def _writeManifest(fileName, manifest):
+        """ Write the '<fileName>_manifest.json' file, replacing the previous one atomically.
+        The folder is created if needed, as the manifest is written before the data."""
+        os.makedirs(os.path.dirname(os.path.abspath(fileName)), exist_ok=True)
+        tmpFile = fileName + '_manifest.json.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmpFile, fileName + '_manifest.json')
+
+    def conversionInputs(self, runNumber=None, path=None):
+        """ Inputs which determine the dataframes converted from a run.
+
+        These are stored in the '<fileName>_manifest.json' file written by
+        ``storeDataframes``, and compared by ``checkManifest``.
+
+        :Parameters:
+            runNumber : int | None
+                number of the run. If None, no raw files are listed.
+            path : str | None (default to ``self.DATA_RAW_DIR``)
+                path where the raw data of the run is looked for.
+
+        :Return:
+            inputs : dict
+                'runNumber', 'rawFiles' as a list of [name, size, modification time],
+                or None if the raw files of the run are not found, e.g. for dataframes
+                created in memory,
+                the 'channels' of the [DAQ channels] section of SETTINGS.ini and the
+                'settings' which change the converted values.
+        """
+        rawFiles = None
+        if runNumber is not None:
+            try:
+                if path is None:
+                    files = runindex.get_run_info(runNumber, self.DATA_RAW_DIR)['files']
+                else:
+                    files = h5daq.runFiles(path, runNumber)
+                rawFiles = []
+                for fileName in files:
+                    stat = os.stat(fileName)
+                    rawFiles.append([os.path.basename(fileName), stat.st_size, stat.st_mtime])
+            except (OSError, KeyError):
+                rawFiles = None
+        settings = _readSettings()
+        channels = dict(settings['DAQ channels']) if 'DAQ channels' in settings else {}
+        return {'runNumber': runNumber, 'rawFiles': rawFiles, 'channels': channels,
+                'settings': {name: getattr(self, name) for name in _CONVERSION_SETTINGS}}
+
+    def checkManifest(self, runNumber=None, fileName=None, path=None, format='parquet'):
+        """ Check whether stored dataframes are up to date with their inputs.
+
+        :Parameters:
+            runNumber : int | None (default to ``self.runNumber``)
+                number of the run.
+            fileName : str | None (default to 'run{runNumber}')
+                shared namestring of the dataframes.
+            path : str | None (default to ``self.DATA_PARQUET_DIR`` or ``self.DATA_H5_DIR``)
+                path to the folder of the dataframes.
+            format : str | 'parquet'
+                format of the dataframes, 'parquet', 'h5', 'hdf5' or 'npy'.
+
+        :Return:
+            changes : list of str or None
+                what changed since the conversion, e.g. raw files or channels, or
+                'no stored dataframes'. 'raw files not found' if the raw files of the
+                run are gone, in which case the dataframes can't be converted again.
+                The raw files of dataframes appended by ``updateDataframes`` are not
+                compared, as the run grows between the updates. Empty if the dataframes can be reused. None if
+                the dataframes exist but have no manifest, as when converted by older
+                versions, so that it is not known.
+        """
+        format = format.lower()
+        if runNumber is None:
+            runNumber = self.runNumber
+        if fileName is None:
+            fileName = 'run{}'.format(runNumber)
+        if path is None:
+            path = self.DATA_H5_DIR if format in ['hdf5', 'h5'] else self.DATA_PARQUET_DIR
+        fullName = path + fileName
+
+        try:
+            stored = _storedRows(fullName, format)
+        except (OSError, ValueError, KeyError):
+            return ['no stored dataframes']
+        try:
+            with open(fullName + '_manifest.json', 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        changes = []
+        if manifest.get('version') != _MANIFEST_VERSION:
+            changes.append('manifest version')
+        if manifest.get('rows') is None:
+            changes.append('incomplete conversion')
+        elif manifest.get('rows') != stored:
+            changes.append('stored rows {} instead of {}'.format(stored, manifest.get('rows')))
+        current = self.conversionInputs(runNumber, self.rawDataPath)
+        # compare through json, as stored in the manifest
+        current = json.loads(json.dumps(current))
+        if current['rawFiles'] is None and manifest.get('rawFiles') is not None:
+            changes.append('raw files not found')
+        elif current['rawFiles'] != manifest.get('rawFiles') and not manifest.get('incremental'):
+            # the raw files of dataframes converted by updateDataframes grow by design
+            changes.append('raw files')
+        if current['channels'] != manifest.get('channels'):
+            changes.append('[DAQ channels]')
+        for name, value in current['settings'].items():
+            if manifest.get('settings', {}).get(name) != value:
+                changes.append(name)
+        return changes
+
+    def updateDataframes(self, runNumber=None, fileName=None, path=None, holdBack=10, streaming=False, lazy=False):
+        """ Convert the macrobunches recorded since the last call and append them to the stored dataframes.
+
+        Meant for runs which are still being recorded: the last converted macrobunch
+        ID is stored in a '<fileName>_incremental.json' file next to the dataframes,
+        and each call reads only the new interval through ``readData(pulseIdInterval=...)``
+        and appends it to the '_el' and '_mb' parquet datasets. The macroBunchPulseId
+        columns are kept relative to the first macrobunch of the run, as in a
+        conversion of the full run.
+
+        The interval being appended is recorded in the state file, with the stored
+        rows, before appending it: if a call is interrupted, the next one finds
+        from the rows of the manifest whether the interval was appended, and does
+        not append it twice. If it was interrupted while writing, a ValueError asks
+        to convert the run again. The manifest of the dataframes is marked 'incremental',
+        with the converted interval, so that ``checkManifest`` does not report the
+        growing raw files of the run as changed.
+
+        :Parameters:
+            runNumber : int | None (default to ``self.runNumber``)
+                number of the run to update.
+            fileName : str | None (default to 'run{runNumber}')
+                shared namestring of the parquet dataframes.
+            path : str | None (default to ``self.DATA_PARQUET_DIR``)
+                path to the folder of the parquet dataframes.
+            holdBack : int | 10
+                number of the most recent macrobunches left for the next call, as
+                their data might not be written to all channels yet.
+            streaming : bool | False
+                passed to ``readData``.
+            lazy : bool | False
+                passed to ``readData``.
+
+        :Return:
+            pulseIdInterval : (int, int) | None
+                the interval of macrobunch IDs appended, or None if there was no new data.
+        """
+        if runNumber is None:
+            runNumber = self.runNumber
+        if fileName is None:
+            fileName = 'run{}'.format(runNumber)
+        if path is None:
+            path = self.DATA_PARQUET_DIR
+        stateFile = path + fileName + '_incremental.json'
+
+        try:
+            with open(stateFile, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+
+        if state is not None and state.get('appending') is not None:
+            # the previous call was interrupted: the interval was appended if the
+            # manifest, completed after the data, has other rows than before it
+            try:
+                with open(path + fileName + '_manifest.json', 'r') as f:
+                    rows = json.load(f).get('rows')
+            except (OSError, ValueError):
+                rows = None
+            if state['rows'] is None:  # the first conversion is done again from scratch
+                state = None
+            elif rows is None:
+                raise ValueError('An update of run {} was interrupted while appending macrobunches {:,} to {:,}, '
+                                 'delete the dataframes and {} to convert it again.'
+                                 .format(runNumber, state['appending'][0], state['appending'][1], stateFile))
+            else:
+                if rows != state['rows']:
+                    print('Macrobunches {:,} to {:,} of run {} were appended by an interrupted update'
+                          .format(state['appending'][0], state['appending'][1], runNumber))
+                    state['lastPulseId'] = state['appending'][1]
+                state['appending'] = None
+                _writeState(stateFile, state)
+
+        availableIds = self.getIds(runNumber)
+        if state is None:
+            firstPulseId = lastPulseId = int(availableIds[0])
+            rows = None
+        else:
+            firstPulseId, lastPulseId = state['firstPulseId'], state['lastPulseId']
+            rows = _storedRows(path + fileName, 'parquet')
+        newLastPulseId = int(availableIds[1]) - holdBack
+        if newLastPulseId <= lastPulseId:
+            print('No new macrobunches in run {} since {:,}'.format(runNumber, lastPulseId))
+            return None
+
+        pulseIdInterval = (lastPulseId, newLastPulseId)
+        _writeState(stateFile, {'runNumber': runNumber, 'firstPulseId': firstPulseId, 'lastPulseId': lastPulseId,
+                                'appending': list(pulseIdInterval), 'rows': rows})
+        self.readData(runNumber=runNumber, pulseIdInterval=pulseIdInterval, streaming=streaming, lazy=lazy)
+        # readData counts the macrobunches from the start of the interval
+        shift = lastPulseId - firstPulseId
+        if shift != 0:
+            self.dd['macroBunchPulseId'] = self.dd['macroBunchPulseId'] + shift
+            self.ddMicrobunches['macroBunchPulseId'] = self.ddMicrobunches['macroBunchPulseId'] + shift
+        self.storeDataframes(fileName, path=path, append=state is not None)
+
+        with open(path + fileName + '_manifest.json', 'r') as f:
+            manifest = json.load(f)
+        manifest['incremental'] = True
+        manifest['pulseIdInterval'] = [firstPulseId, newLastPulseId]
+        self._writeManifest(path + fileName, manifest)
+        _writeState(stateFile, {'runNumber': runNumber, 'firstPulseId': firstPulseId, 'lastPulseId': newLastPulseId,
+                                'appending': None, 'rows': None})
+        print('Appended macrobunches {:,} to {:,} of run {}'.format(pulseIdInterval[0], pulseIdInterval[1], runNumber))
+        return pulseIdInterval
 
     def getIds(self, runNumber=None, path=None):
         """ Returns the first and the last macrobunch IDs of a given run number
@@ -512,6 +1158,14 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
             settings.read(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'SETTINGS.ini'))
         path = settings['paths']['DATA_RAW_DIR']
 
+        if self.daqReader() == 'h5py':
+            # the cached segment index of the macrobunch ID channel avoids scanning the files
+            if 'DAQ channels' in settings and 'macro_bunch_pulse_id' in settings['DAQ channels']:
+                files = h5daq.runFiles(self.path_to_run, runNumber)
+                segments, numOfColumns = h5daq.channelSegments(files, settings['DAQ channels']['macro_bunch_pulse_id'])
+                return h5daq.pulseIdIntervalOfSegments(segments)
+            return h5daq.H5DaqAccess.create(self.path_to_run).availablePulseIdInterval(runNumber)
+
         # needs to import stuff from PAH modules
         import sys
         sys.path.append(settings['paths']['PAH_MODULE_DIR'])
@@ -582,7 +1236,7 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
         # adc1Name = '/Experiment/PG/SIS8300 100MHz ADC/CH6/TD'
         # adc2Name = '/Experiment/PG/SIS8300 100MHz ADC/CH7/TD'
 
-        daqAccess = BeamtimeDaqAccess.create(path)
+        daqAccess = self.createDaqAccess(path)
 
         print('reading DAQ data')
         # ~ print("reading dldPosX")
@@ -666,7 +1320,7 @@ class DldFlashProcessor(DldProcessor.DldProcessor):
         # adc1Name = '/Experiment/PG/SIS8300 100MHz ADC/CH6/TD'
         # adc2Name = '/Experiment/PG/SIS8300 100MHz ADC/CH7/TD'
 
-        daqAccess = BeamtimeDaqAccess.create(path)
+        daqAccess = self.createDaqAccess(path)
 
         print('reading DAQ data')
         # ~ print("reading dldPosX")
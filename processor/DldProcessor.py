@@ -8,20 +8,104 @@ from datetime import datetime
 import dask
 import dask.dataframe
 import dask.multiprocessing
+from dask.diagnostics import ProgressBar
 import h5py
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 from configparser import ConfigParser
 # import matplotlib.pyplot as plt
 from utilities import misc
+from processor import binning, columnstore
 from processor.BinnedArrays import BinnedArray
+from processor.cscripts.DldFlashProcessorVectorized import assignCompactToMircobunch
 
 # warnings.resetwarnings()
 
 _VERBOSE = False
 
+# columns of the microbunch dataframe which have one value per macrobunch
+_MACROBUNCH_COLUMNS = ('delayStage', 'dldAux0', 'dldAux1', 'pumpPol', 'timeStamp')
+
+# comparison operators of the filter expressions of readDataframes and applyFilters
+_FILTER_OPERATORS = {
+    '==': lambda col, val: col == val,
+    '=': lambda col, val: col == val,
+    '!=': lambda col, val: col != val,
+    '<': lambda col, val: col < val,
+    '<=': lambda col, val: col <= val,
+    '>': lambda col, val: col > val,
+    '>=': lambda col, val: col >= val,
+    'in': lambda col, val: col.isin(val),
+    'not in': lambda col, val: ~col.isin(val),
+}
+
+
+def _disjunctiveFilters(filters):
+    """ Filters as a list of lists of (column, operator, value), i.e. in the
+    disjunctive normal form used by the parquet readers. A single conjunction,
+    and filters as lists instead of tuples, e.g. read from json, are also accepted."""
+    if len(filters) > 0 and len(filters[0]) > 0 and isinstance(filters[0][0], str):
+        filters = [filters]
+    for conjunction in filters:
+        for col, op, val in conjunction:
+            if op not in _FILTER_OPERATORS:
+                raise ValueError('Invalid filter operator {} for column {}'.format(op, col))
+    return [[tuple(expression) for expression in conjunction] for conjunction in filters]
+
+
+def _filterColumns(filters):
+    """ Set of the columns used by some filters."""
+    return {col for conjunction in _disjunctiveFilters(filters) for col, op, val in conjunction}
+
+
+# columns computed by the post-processing methods, and the columns they are computed from
+_DERIVED_COLUMNS = {
+    'pumpProbeTime': ('delayStage', 'bam'),
+    'posR': ('posX', 'posY'),
+    'posT': ('posX', 'posY'),
+}
+
+
+def _sourceColumns(columns):
+    """ Set of the stored columns needed to get some columns, replacing the
+    derived ones by the columns they are computed from."""
+    sources = set()
+    for col in columns:
+        sources.update(_DERIVED_COLUMNS.get(col, (col,)))
+    return sources
+
+
+def _projectedColumns(storedColumns, normalized, columns, filters):
+    """ Stored columns of the electron dataframe to read, or None to read them all.
+
+    Besides the requested ones, the columns used by the filters and, if some
+    columns have to be joined from the microbunch tables, the join keys are read."""
+    if columns is None:
+        return None
+    needed = _sourceColumns(columns)
+    if filters is not None:
+        needed |= _filterColumns(filters)
+    if normalized and not needed <= set(storedColumns):
+        needed |= {'macroBunchPulseId', 'dldMicrobunchId'}
+    return [col for col in storedColumns if col in needed]
+
+
+def _momentArrays(moments):
+    """ The moments of ``binning.histogramMoments`` as a dict of arrays, with the
+    counts under 'counts' and the moments of the weights named '<weight>_<moment>',
+    with NaN as the minimum and maximum of the bins without weights."""
+    arrays = {}
+    for key, values in moments.items():
+        if key == 'counts':
+            arrays[key] = values
+            continue
+        weight, moment = key
+        if moment in ('min', 'max'):
+            values = np.where(np.isinf(values), np.nan, values)
+        arrays['{}_{}'.format(weight, moment)] = values
+    return arrays
+
 
 class DldProcessor:
     """
@@ -34,12 +118,39 @@ class DldProcessor:
             The number of available CPU cores to use.
         CHUNK_SIZE : int
             Size of the chunks in which a parquet file will be divided.
+        N_IO_THREADS : int
+            The number of threads reading the DAQ channels concurrently.
+        DAQ_READER : str
+            Reader of the raw DAQ files: 'pah' (PAH, from PAH_MODULE_DIR), 'h5py'
+            (built-in reader of ``processor.h5daq``) or 'auto' (PAH if it can be imported).
+        AUTO_TUNE : bool
+            If True, the partition size and the number of workers are planned
+            from the available memory instead of CHUNK_SIZE and N_CORES.
+        MEMORY_FRACTION : float
+            Fraction of the available memory used by the workers when AUTO_TUNE is True.
+        PARQUET_ENGINE : str
+            Parquet library used to store the dataframes: 'pyarrow', 'fastparquet' or
+            'auto' (pyarrow if installed).
+        PARQUET_CODEC, PARQUET_INT_CODEC : str
+            Parquet compression of the float and of the integer columns ('snappy',
+            'zstd', 'gzip', 'lz4', 'brotli' or 'none'). Single columns can be set in
+            the [parquet codecs] section.
+        PARQUET_COMPRESSION_LEVEL : int
+            Compression level of the codecs which support it, 0 for the codec default.
+        PARQUET_ROW_GROUP_SIZE : int
+            Maximum number of rows of the parquet row groups.
+        BINNING_ENGINE : str
+            Implementation of the histograms of computeBinnedData: 'numba' (compiled
+            kernel, binning the partitions in parallel threads), 'numpy' or 'auto'
+            (numba if installed). See ``processor.binning``.
         TOF_STEP_NS : float
             The step size in ns of the dldTime. Used to convert the
             step number to the ToF time in the delay line detector.
         TOF_STEP_EV : float
             The step size in eV of the dldTime. Used to convert the
             step number to energy of the photoemitted electrons.
+        COLUMN_DTYPES : dict
+            The dtype of each dataframe column, from the [column dtypes] section.
         DATA_RAW_DIR : str
             Path to raw data hdf5 files output by FLASH
         DATA_PARQUET_DIR : str
@@ -60,6 +171,22 @@ class DldProcessor:
 
         self.resetBins()
 
+        # per-macrobunch and per-microbunch values of normalized dataframes,
+        # see buildMicrobunchTables()
+        self.microbunchTables = None
+
+        # partition size and number of workers chosen by the auto-tuning,
+        # see DldFlashProcessor.planPartitions()
+        self.partitionPlan = None
+
+        # columns used by the filters and post-processing steps applied to the
+        # dataframes, see requiredColumns()
+        self.usedColumns = set()
+
+        # partitions of the memory-mapped electron dataframe, if read from the
+        # 'npy' format, see readDataframes()
+        self.columnStore = None
+
         # initialize attributes to their type. Values are then taken from
         # SETTINGS.ini through initAttributes()
 
@@ -86,12 +213,48 @@ class DldProcessor:
         self.N_CORES = int(max(os.cpu_count()-1,1))
         self.UBID_OFFSET = int(0)
         self.CHUNK_SIZE = int(1000000)
+        self.N_IO_THREADS = int(4)
+        self.DAQ_READER = str('auto')
+        self.AUTO_TUNE = bool(False)
+        self.MEMORY_FRACTION = np.float64(0.5)
+        self.PARQUET_ENGINE = str('auto')
+        self.PARQUET_CODEC = str('snappy')
+        self.PARQUET_INT_CODEC = str('zstd')
+        self.PARQUET_COMPRESSION_LEVEL = int(0)
+        self.PARQUET_ROW_GROUP_SIZE = int(1000000)
+        self.BINNING_ENGINE = str('auto')
         self.TOF_STEP_TO_NS = np.float64(0.020574)
         self.ET_CONV_E_OFFSET = np.float64(357.7)
         self.ET_CONV_T_OFFSET = np.float64(82.7)
         self.ET_CONV_L = np.float64(.75)
         self.TOF_IN_NS = bool(True)
 
+        # parquet codec of single columns, from the [parquet codecs] section of SETTINGS.ini
+        self.PARQUET_COLUMN_CODECS = {}
+
+        # dtype of each dataframe column, overwritten by the [column dtypes] section of
+        # SETTINGS.ini, e.g. "dld_pos_x = float32". Integer types are only safe for
+        # columns without NaN values.
+        self.COLUMN_DTYPES = {
+            'dldPosX': 'float32',
+            'dldPosY': 'float32',
+            'dldTime': 'float32',
+            'delayStage': 'float64',
+            'bam': 'float32',
+            'dldMicrobunchId': 'int16',
+            'dldDetectorId': 'uint8',
+            'dldSectorId': 'uint8',
+            'bunchCharge': 'float32',
+            'opticalDiode': 'float32',
+            'gmdTunnel': 'float32',
+            'gmdBda': 'float32',
+            'dldAux0': 'float32',
+            'dldAux1': 'float32',
+            'pumpPol': 'float32',
+            'macroBunchPulseId': 'float64',
+            'timeStamp': 'float64',
+        }
+
         self.DATA_RAW_DIR = str('/gpfs/pg2/current/raw/hdf')
         self.DATA_H5_DIR = str('/home/pg2user/data/h5')
         self.DATA_PARQUET_DIR = str('/home/pg2user/DATA/parquet/')
@@ -146,6 +309,158 @@ class DldProcessor:
                     else:
                         pass
 
+        if 'column dtypes' in settings:
+            for entry in settings['column dtypes']:
+                self.COLUMN_DTYPES[misc.camelCaseIt(entry)] = str(settings['column dtypes'][entry])
+        if 'parquet codecs' in settings:
+            for entry in settings['parquet codecs']:
+                self.PARQUET_COLUMN_CODECS[misc.camelCaseIt(entry)] = str(settings['parquet codecs'][entry])
+
+    def castToColumnDtypes(self, dataframe):
+        """ Cast the columns of a dataframe to the dtypes of ``self.COLUMN_DTYPES``.
+
+        Columns missing from the schema are left unchanged.
+
+        :Parameters:
+            dataframe : pandas or dask dataframe
+                The dataframe to cast.
+
+        :Return:
+            dataframe : pandas or dask dataframe
+                The dataframe with the compact column dtypes.
+        """
+        dtypes = {col: self.COLUMN_DTYPES[col] for col in dataframe.columns
+                  if col in self.COLUMN_DTYPES and dataframe[col].dtype != self.COLUMN_DTYPES[col]}
+        if len(dtypes) == 0:
+            return dataframe
+        return dataframe.astype(dtypes)
+
+    def buildMicrobunchTables(self):
+        """ Build the lookup tables of a normalized dataframe pair.
+
+        In normalized storage the electron dataframe ``dd`` only holds the
+        electron channels and the (macroBunchPulseId, dldMicrobunchId) keys, while
+        the slow channels are kept once per microbunch in ``ddMicrobunches``.
+        This loads ``ddMicrobunches`` in (macrobunch, microbunch) arrays, from
+        which ``joinColumns`` gathers the values of each electron.
+
+        Must be called before filtering ``ddMicrobunches``.
+        """
+        table = self.ddMicrobunches.compute()
+        table = table[np.isfinite(table['macroBunchPulseId'])]
+        macrobunchIndex = table['macroBunchPulseId'].values.astype(np.intp)
+        microbunchIndex = table['dldMicrobunchId'].values.astype(np.intp)
+        shape = (macrobunchIndex.max() + 1, microbunchIndex.max() + 1)
+
+        self.microbunchTables = {}
+        for col in table.columns:
+            if col in ('macroBunchPulseId', 'dldMicrobunchId'):
+                continue
+            if col in _MACROBUNCH_COLUMNS:
+                values = np.full(shape[0], np.nan)
+                values[macrobunchIndex] = table[col].values
+            else:
+                values = np.full(shape, np.nan)
+                values[macrobunchIndex, microbunchIndex] = table[col].values
+            self.microbunchTables[col] = values
+
+    def joinColumns(self, columns):
+        """ Add columns of the microbunch tables to the electron dataframe.
+
+        The values are gathered lazily, partition by partition, from the
+        macroBunchPulseId and dldMicrobunchId of each electron. Columns already in
+        ``dd``, and all columns if the dataframes are not normalized, are ignored.
+
+        :Parameters:
+            columns : list of str
+                Names of the columns needed in ``dd``.
+        """
+        if self.microbunchTables is None:
+            return
+        toJoin = [col for col in columns if col not in self.dd.columns and col in self.microbunchTables]
+        if len(toJoin) == 0:
+            return
+        tables = {col: self.microbunchTables[col] for col in toJoin}
+        dtypes = {col: self.COLUMN_DTYPES.get(col, 'float64') for col in toJoin}
+        numOfMacrobunches = len(next(iter(tables.values())))
+
+        def gather(part):
+            part = part.copy()
+            macrobunchIds = part['macroBunchPulseId'].values
+            valid = (macrobunchIds >= 0) & (macrobunchIds < numOfMacrobunches)
+            macrobunchIndex = np.where(valid, macrobunchIds, 0).astype(np.intp)
+            microbunchIds = np.where(valid, part['dldMicrobunchId'].values, -1)
+            for col, table in tables.items():
+                if table.ndim == 1:
+                    values = np.where(valid, table[macrobunchIndex], np.nan)
+                else:
+                    values = assignCompactToMircobunch(macrobunchIndex, microbunchIds, table)
+                part[col] = values.astype(dtypes[col])
+            return part
+
+        meta = self.dd._meta.copy()
+        for col in toJoin:
+            meta[col] = np.array([], dtype=dtypes[col])
+        self.dd = self.dd.map_partitions(gather, meta=meta)
+
+    def parquetWriteOptions(self, dataframe):
+        """ Keyword arguments of ``to_parquet`` implementing the parquet settings.
+
+        Each column gets the codec set in ``PARQUET_COLUMN_CODECS``, or else
+        ``PARQUET_INT_CODEC`` for integer columns (IDs, which compress very well)
+        and ``PARQUET_CODEC`` for all others.
+
+        :Parameters:
+            dataframe : dask dataframe
+                The dataframe to write.
+
+        :Return:
+            options : dict
+                engine, compression and row group size options of ``to_parquet``.
+        """
+        engine = self.PARQUET_ENGINE
+        if engine == 'auto':
+            try:
+                import pyarrow
+                engine = 'pyarrow'
+            except ImportError:
+                engine = 'fastparquet'
+
+        codecs = {}
+        for col in dataframe.columns:
+            if col in self.PARQUET_COLUMN_CODECS:
+                codec = self.PARQUET_COLUMN_CODECS[col]
+            elif np.issubdtype(dataframe[col].dtype, np.integer):
+                codec = self.PARQUET_INT_CODEC
+            else:
+                codec = self.PARQUET_CODEC
+            codecs[col] = 'none' if codec.lower() == 'uncompressed' else codec.lower()
+
+        # name of the compression level argument of the codecs which have one, in fastparquet
+        levelArguments = {'zstd': 'level', 'gzip': 'compresslevel', 'brotli': 'quality'}
+        level = self.PARQUET_COMPRESSION_LEVEL
+
+        options = {'engine': engine}
+        if engine == 'pyarrow':
+            options['compression'] = codecs
+            options['row_group_size'] = self.PARQUET_ROW_GROUP_SIZE
+            options['write_statistics'] = True  # min/max of each row group, used by the read filters
+            if level != 0:
+                options['compression_level'] = {col: level for col, codec in codecs.items()
+                                                if codec in levelArguments}
+        else:
+            compression = {}
+            for col, codec in codecs.items():
+                if codec == 'none':
+                    continue
+                if level != 0 and codec in levelArguments:
+                    compression[col] = {'type': codec.upper(), 'args': {levelArguments[codec]: level}}
+                else:
+                    compression[col] = codec.upper()
+            options['compression'] = compression
+            options['row_group_offsets'] = self.PARQUET_ROW_GROUP_SIZE
+        return options
+
     def get_channel_report(self):
         """ Generates a Pandas dataframe containing relevant statistical quantities on all available channels"""
         print('creating channel report...')
@@ -221,7 +536,7 @@ class DldProcessor:
         
 
 
-    def readDataframes(self, fileName=None, path=None, format='parquet'):
+    def readDataframes(self, fileName=None, path=None, format='parquet', filters=None, columns=None):
         """ Load data from a parquet or HDF5 dataframe.
 
         Access the data as hdf5 file (this is the format used internally,
@@ -233,15 +548,29 @@ class DldProcessor:
             path : str | None (default to ``self.DATA_PARQUET_DIR`` or ``self.DATA_H5_DIR``)
                 name of the filepath (down to the lowest-level folder)
             format : str | 'parquet'
-                file format, 'parquet' (parquet file), 'h5' or 'hdf5' (hdf5 file).
+                file format, 'parquet' (parquet file), 'h5' or 'hdf5' (hdf5 file) or
+                'npy' (memory-mapped column store, see ``processor.columnstore``). As long
+                as the electron dataframe of a column store is not filtered or modified,
+                ``computeBinnedData`` bins the memory-mapped columns directly.
+            filters : list | None
+                Filter expressions, see ``applyFilters``, e.g.
+                ``[('dldMicrobunchId', '>', 100), ('dldMicrobunchId', '<', 400)]``.
+                For parquet files they are passed to the reader, which skips the
+                row groups whose statistics do not match them, and they are then
+                applied exactly to the loaded rows.
+            columns : list of str | None
+                Columns of the electron dataframe to read, e.g. ``requiredColumns()``
+                of a previous analysis. The columns needed by ``filters``, and those the
+                requested post-processing columns are computed from, are added. If None,
+                all the columns are read. The microbunch dataframe is always read whole.
         """
 
         format = format.lower()
         assert format in [
-            'parquet', 'h5', 'hdf5'], 'Invalid format for data input. Please select between parquet or h5.'
+            'parquet', 'h5', 'hdf5', 'npy'], 'Invalid format for data input. Please select between parquet, h5 or npy.'
 
         if path is None:
-            if format == 'parquet':
+            if format in ['parquet', 'npy']:
                 path = self.DATA_PARQUET_DIR
             elif format in ['hdf5', 'h5']:
                 path = self.DATA_H5_DIR
@@ -257,11 +586,111 @@ class DldProcessor:
         if format == 'parquet':
             self.dd = dask.dataframe.read_parquet(fullName + "_el")
             self.ddMicrobunches = dask.dataframe.read_parquet(fullName + "_mb")
+            normalized = 'dldMicrobunchId' in self.ddMicrobunches.columns
+            projection = _projectedColumns(list(self.dd.columns), normalized, columns, filters)
+            electronFilters = None
+            if filters is not None:
+                # push the filters down to the datasets which have all their columns. In
+                # normalized storage the microbunch dataframe is needed whole for the lookup tables.
+                filterColumns = _filterColumns(filters)
+                if filterColumns <= set(self.dd.columns):
+                    electronFilters = _disjunctiveFilters(filters)
+                if filterColumns <= set(self.ddMicrobunches.columns) and not normalized:
+                    self.ddMicrobunches = dask.dataframe.read_parquet(fullName + "_mb",
+                                                                      filters=_disjunctiveFilters(filters))
+            if projection is not None or electronFilters is not None:
+                self.dd = dask.dataframe.read_parquet(fullName + "_el", columns=projection, filters=electronFilters)
         elif format in ['hdf5', 'h5']:
             self.dd = dask.dataframe.read_hdf(
                 fullName, '/electrons', mode='r', chunksize=self.CHUNK_SIZE)
             self.ddMicrobunches = dask.dataframe.read_hdf(
                 fullName, '/microbunches', mode='r', chunksize=self.CHUNK_SIZE)
+            normalized = 'dldMicrobunchId' in self.ddMicrobunches.columns
+            projection = _projectedColumns(list(self.dd.columns), normalized, columns, filters)
+            if projection is not None:
+                self.dd = dask.dataframe.read_hdf(
+                    fullName, '/electrons', mode='r', chunksize=self.CHUNK_SIZE, columns=projection)
+        elif format == 'npy':
+            self.ddMicrobunches, mbPartitions = columnstore.readDataframe(fullName + "_mb_npy")
+            self.dd, partitions = columnstore.readDataframe(fullName + "_el_npy")
+            normalized = 'dldMicrobunchId' in self.ddMicrobunches.columns
+            projection = _projectedColumns(list(self.dd.columns), normalized, columns, filters)
+            if projection is not None:
+                self.dd, partitions = columnstore.readDataframe(fullName + "_el_npy", columns=projection)
+        self.usedColumns = set()
+
+        # files written before the column schema was introduced are all float64
+        self.dd = self.castToColumnDtypes(self.dd)
+        self.ddMicrobunches = self.castToColumnDtypes(self.ddMicrobunches)
+
+        if format == 'npy':
+            # the dataframe name identifies the unmodified dataframe, see computeBinnedData
+            self.columnStore = {'partitions': partitions, 'columns': list(self.dd.columns), 'name': self.dd._name}
+        else:
+            self.columnStore = None
+
+        if 'dldMicrobunchId' in self.ddMicrobunches.columns:  # normalized storage
+            self.buildMicrobunchTables()
+        else:
+            self.microbunchTables = None
+
+        if filters is not None:
+            self.applyFilters(filters)
+
+    def requiredColumns(self):
+        """ Stored columns needed to repeat the current analysis.
+
+        These are the columns of the scheduled bins and those used by the filters
+        and post-processing steps applied since the dataframes were loaded, with
+        derived columns such as pumpProbeTime replaced by the columns they are
+        computed from. Reading only these columns, with
+        ``readDataframes(columns=processor.requiredColumns())``, is enough to
+        apply the same steps again.
+
+        :Return:
+            columns : list of str
+                Sorted names of the required columns.
+        """
+        columns = _sourceColumns(set(self.binNameList) | self.usedColumns)
+        if self.microbunchTables is not None and not columns <= set(self.dd.columns):
+            columns |= {'macroBunchPulseId', 'dldMicrobunchId'}
+        return sorted(columns)
+
+    def applyFilters(self, filters):
+        """ Filters the dataframes contained in the processor instance by a set of expressions.
+
+        As ``addFilter``, but with comparisons in the format of the parquet readers.
+
+        :Parameters:
+            filters : list
+                List of (column, operator, value) tuples which must all hold, or a list
+                of such lists of which at least one must hold. The operators are
+                '==', '!=', '<', '<=', '>', '>=', 'in' and 'not in'.
+
+        :Effect:
+            Filters the ``dd`` dataframe, and ``ddMicrobunches`` if it has all the
+            columns used by the filters, in place.
+        """
+        filters = _disjunctiveFilters(filters)
+        if len(filters) == 0:
+            return
+        filterColumns = _filterColumns(filters)
+
+        def mask(dataframe):
+            result = None
+            for conjunction in filters:
+                conjunctionMask = None
+                for col, op, val in conjunction:
+                    m = _FILTER_OPERATORS[op](dataframe[col], val)
+                    conjunctionMask = m if conjunctionMask is None else conjunctionMask & m
+                result = conjunctionMask if result is None else result | conjunctionMask
+            return result
+
+        self.usedColumns |= filterColumns
+        self.joinColumns(list(filterColumns))
+        self.dd = self.dd[mask(self.dd)]
+        if filterColumns <= set(self.ddMicrobunches.columns):
+            self.ddMicrobunches = self.ddMicrobunches[mask(self.ddMicrobunches)]
 
     def appendDataframeParquet(self, fileName):
         """ Append data to an existing dask Parquet dataframe.
@@ -347,6 +776,8 @@ class DldProcessor:
                 =======  =====================================
         """
 
+        self.usedColumns |= {'delayStage', 'bam'}
+        self.joinColumns(['delayStage', 'bam'])
         self.dd['pumpProbeTime'] = self.dd['delayStage'] - \
                                    self.dd['bam'] * sign
         self.ddMicrobunches['pumpProbeTime'] = self.ddMicrobunches['delayStage'] - \
@@ -367,6 +798,7 @@ class DldProcessor:
         def angle(df):
             return np.arctan2(df.posY - kCenter[1], df.posX - kCenter[0])
 
+        self.usedColumns |= {'posX', 'posY'}
         self.dd['posR'] = self.dd.map_partitions(radius)
         self.dd['posT'] = self.dd.map_partitions(angle)
 
@@ -440,18 +872,33 @@ class DldProcessor:
         except ValueError:
             raise ValueError('Failed the GMD normalization.')
 
-    def make_GMD_histogram(self,axis_name,axis_values): # TODO: improve performance... its deadly slow! 
+    def make_GMD_histogram(self,axis_name,axis_values):
+        """ Sum of the positive GMD values of the electrons, for the nearest of the
+        axis_values. The sums are accumulated by the binning engine, with the midpoints
+        of the sorted axis values as bin edges, see ``binning.histogramMoments``, and
+        returned in the order of axis_values. The bins are closed on the left, so the
+        midpoints are moved up to the next float: a value exactly halfway goes to the
+        lower axis value, as with a nearest-value search."""
+        axis_values = np.asarray(axis_values, dtype=np.float64)
+        order = np.argsort(axis_values, kind='stable')
+        sorted_values = axis_values[order]
+        midpoints = np.nextafter((sorted_values[:-1] + sorted_values[1:]) / 2, np.inf)
+        edges = np.concatenate(([-np.inf], midpoints, [np.inf]))
+
+        def gmdSums(part):
+            gmd = np.nan_to_num(part['gmdBda'].values.astype(np.float64))
+            moments = binning.histogramMoments([part[axis_name].values], [edges],
+                                               {'gmdBda': np.where(gmd > 0, gmd, 0.)}, self.BINNING_ENGINE)
+            return moments[('gmdBda', 'sum')]
+
+        self.joinColumns(['gmdBda', axis_name])
+        partials = [dask.delayed(gmdSums)(part)
+                    for part in self.dd[list(dict.fromkeys(['gmdBda', axis_name]))].to_delayed()]
+        sorted_sums, = dask.compute(binning.treeSum(partials))
+        norm_array = np.empty_like(sorted_sums)
+        norm_array[order] = sorted_sums
+        return norm_array
 
-            gmd = np.nan_to_num(self.dd['gmdBda'].values.compute())
-            axisDataframe = self.dd[axis_name].values.compute()
-
-            norm_array = np.zeros(len(axis_values))
-            for j in range(0,len(gmd)):
-                if (gmd[j]>0):
-                    ind = np.argmin(np.abs(axis_values-axisDataframe[j]))
-                    norm_array[ind]+=gmd[j]
-            return norm_array
-    
     def normalizeAxisMean(self,data_array,ax):
         """ Normalize to the mean of the given axis
         :Parameters:
@@ -691,6 +1138,8 @@ class DldProcessor:
             Filters the columns of ``dd`` and ``ddMicrobunches`` dataframes in place.
         """
 
+        self.usedColumns.add(colname)
+        self.joinColumns([colname])
         if colname in self.dd.columns:
             if lb is not None:
                 self.dd = self.dd[self.dd[colname] > lb]
@@ -897,99 +1346,190 @@ class DldProcessor:
             along pumpProbeDelay or polar k-space coordinates.
         """
 
-        def analyzePart(part):
-            """ Function called by each thread of the analysis.
-            """
+        result, = self.binPartitions([self.binNameList], [self.binRangeList])
 
-            grouperList = []
-            for i in range(len(self.binNameList)):
-                grouperList.append(
-                    pd.cut(part[self.binNameList[i]], self.binRangeList[i]))
-            grouped = part.groupby(grouperList)
-            result = (grouped.count())['microbunchId'].to_xarray().values
+        if saveName is not None:
+            self.save_binned(result, saveName, path=savePath, mode='w')
 
-            return np.nan_to_num(result)
+        return result
+
+    def binPartitions(self, binNameLists, binRangeLists, weights=None):
+        """ Compute several histograms of the electron dataframe in one pass.
+
+        Each partition is read once, with the union of the binned columns, and
+        all the histograms are filled from it. The partial histograms of the
+        partitions are then summed in a tree, see ``binning.treeSum``.
+
+        :Parameters:
+            binNameLists : list of lists of str
+                the binned columns of each histogram, as ``binNameList``.
+            binRangeLists : list of lists of numpy arrays
+                the bin edges of each histogram, as ``binRangeList``.
+            weights : list of str | None
+                columns of which the count, sum, sum of squares, minimum and maximum
+                are accumulated in each bin of each histogram, with the counts.
+
+        :Return:
+            results : list of numpy arrays or dicts
+                float64 counts of each histogram. If weights are given, the moments
+                of each histogram instead, as returned by ``binning.histogramMoments``.
+        """
+        columns = list(dict.fromkeys(name for binNameList in binNameLists for name in binNameList))
+        if weights is not None:
+            columns = list(dict.fromkeys(columns + list(weights)))
+
+        def fill(arrays):
+            """ The histograms of the columns of one partition."""
+            # the bins of the evenly spaced axes are computed arithmetically,
+            # see binning.histogram
+            if weights is None:
+                return tuple(binning.histogram([arrays[binName] for binName in binNameList], binRangeList,
+                                               self.BINNING_ENGINE)
+                             for binNameList, binRangeList in zip(binNameLists, binRangeLists))
+            return tuple(binning.histogramMoments([arrays[binName] for binName in binNameList], binRangeList,
+                                                  {weight: arrays[weight] for weight in weights},
+                                                  self.BINNING_ENGINE)
+                         for binNameList, binRangeList in zip(binNameLists, binRangeLists))
 
         # new binner for a partition, not using the Pandas framework. It should
         # be faster!
         def analyzePartNumpy(part):
             """ Function called by each thread of the analysis. This now should be faster.
             """
+            return fill({col: part[col].values for col in columns})
+
+        def analyzeColumnStorePartition(partitionPath):
+            """ Bin the memory-mapped columns of a partition of the column store."""
+            return fill(columnstore.memmapColumns(partitionPath, columns))
+
+        self.joinColumns(columns)
+        # only the binned columns are loaded and passed to the partitions: the
+        # columns used by filters and post-processing are read by dask as needed
+        dd = self.dd[columns]
+
+        nWorkers = self.N_CORES if self.partitionPlan is None else self.partitionPlan['workers']
+        # the compiled kernel releases the GIL: the partitions are binned in threads,
+        # sharing their memory instead of pickling them to other processes
+        scheduler = None
+        if self.BINNING_ENGINE.lower() == 'numba' or (self.BINNING_ENGINE.lower() == 'auto' and binning.NUMBA_AVAILABLE):
+            scheduler = 'threads'
+        if self.columnStore is not None and self.columnStore['name'] == self.dd._name \
+                and set(columns) <= set(self.columnStore['columns']):
+            # unmodified column store: bin the memory-mapped files, without building dataframes
+            partials = [dask.delayed(analyzeColumnStorePartition)(partition)
+                        for partition in self.columnStore['partitions']]
+        else:
+            partials = [dask.delayed(analyzePartNumpy)(part) for part in dd.to_delayed()]
 
-            # get the data as numpy:
-            vals = part.values
-            cols = part.columns.values
-            # create array of columns to be used for binning
-            colsToBin = []
-            for binName in self.binNameList:
-                idx = cols.tolist().index(binName)
-                colsToBin.append(idx)
-
-#            # create the array with the bins and bin ranges
-#            numBins = []
-#            ranges = []
-#            for i in range(0, len(colsToBin)):
-#                # need to subtract 1 from the number of bin ranges
-#                numBins.append(len(self.binRangeList[i]) - 1)
-#                ranges.append(
-#                    (self.binRangeList[i].min(),
-#                     self.binRangeList[i].max()))
-#            # now we are ready for the analysis with numpy:
-#            res, edges = np.histogramdd(
-#                vals[:, colsToBin], bins=numBins, range=ranges)
-            res, edges = np.histogramdd(vals[:, colsToBin], bins=self.binRangeList)
-            return res
-
-        # prepare the partitions for the calculation in parallel
-        calculatedResults = []
-
+        # one graph for all the partitions: the partial histograms are summed in a
+        # tree as soon as they are ready, so that no worker waits for a whole batch
         if _VERBOSE:
             warnString = "always"
         else:
             warnString = "ignore"
         with warnings.catch_warnings():
             warnings.simplefilter(warnString)
+            with ProgressBar():
+                results, = dask.compute(binning.treeSum(partials), num_workers=nWorkers, scheduler=scheduler)
+        if weights is not None:
+            return list(results)
+        return [np.nan_to_num(result).astype(np.float64) for result in results]
 
-            for i in tqdm(range(0, self.dd.npartitions, self.N_CORES)):
-                resultsToCalculate = []
-                # process the data in blocks of n partitions (given by the number
-                # of cores):
-                for j in range(0, self.N_CORES):
-                    if (i + j) >= self.dd.npartitions:
-                        break
-                    part = self.dd.get_partition(i + j)
-                    resultsToCalculate.append(dask.delayed(analyzePartNumpy)(part))
-
-                # now do the calculation on each partition (using the dask
-                # framework):
-                if len(resultsToCalculate) > 0:
-                    #                print("computing partitions " + str(i) + " to " + str(i + j) + " of " + str(
-                    #                    self.dd.npartitions) + ". partitions calculated in parallel: " + str(
-                    #                    len(resultsToCalculate)))
-                    results = dask.compute(*resultsToCalculate)
-                    total = np.zeros_like(results[0])
-                    for result in results:
-                        total = total + result
-                    calculatedResults.append(total)
-                    del total
-                del resultsToCalculate
-
-        # we now need to add them all up (single core):
-        result = np.zeros_like(calculatedResults[0])
-        for r in calculatedResults:
-            r = np.nan_to_num(r)
-            result = result + r
-        result = result.astype(np.float64)
+    def computeHistograms(self, binnings, weights=None, asNumpy=False):
+        """ Compute several independent histograms in a single pass over the data.
 
-        if saveName is not None:
-            self.save_binned(result, saveName, path=savePath, mode='w')
+        This replaces calling ``resetBins``, ``addBinning`` and ``computeBinnedData``
+        once per histogram, e.g. for an energy spectrum, a kx-ky map and a delay
+        trace of the same run: each partition is read once for all of them. The
+        scheduled bins of ``addBinning`` are not changed.
 
-        return result
+        :Parameters:
+            binnings : dict
+                the bins of each histogram, by name, as a list of one tuple per
+                dimension: (column, start, end, steps, ...) with the arguments of
+                ``addBinning``, or (column, edges) with explicit bin edges, e.g.
+                ``{'energy': [('dldTime', 620, 670, 1)],
+                'kMap': [('dldPosX', 480, 980, 5), ('dldPosY', 480, 980, 5)]}``.
+            weights : list of str | None
+                columns of which the count, sum, sum of squares, minimum and maximum in
+                each bin of each histogram are computed in the same pass, see
+                ``computeBinnedArray``.
+            asNumpy : bool | False
+                if True, the histograms are returned as numpy arrays, without
+                building BinnedArrays.
 
-    def computeBinnedArray(self, fast_mode=False):
-        """returns a BinnedArray object of the binned data."""
-        res = self.computeBinnedData()
-        return self.res_to_xarray(res,fast_mode=fast_mode)
+        :Return:
+            results : dict
+                a BinnedArray of each histogram, by name, with the binned columns as
+                dimensions and the middle points of the bins as coordinates. If weights
+                are given, a dict of BinnedArrays for each histogram instead, with the
+                counts and the moments of the weights, as returned by ``computeBinnedArray``.
+        """
+        names = list(binnings)
+        binNameLists = []
+        binRangeLists = []
+        for name in names:
+            binNameList = []
+            binRangeList = []
+            for binSpec in binnings[name]:
+                binNameList.append(binSpec[0])
+                if len(binSpec) == 2:
+                    binRangeList.append(np.asarray(binSpec[1], dtype=np.float64))
+                else:
+                    binRangeList.append(self.genBins(*binSpec[1:]))
+            binNameLists.append(binNameList)
+            binRangeLists.append(binRangeList)
+            self.usedColumns.update(binNameList)
+
+        if weights is not None:
+            self.usedColumns.update(weights)
+
+        results = self.binPartitions(binNameLists, binRangeLists, weights)
+        if weights is not None:
+            results = [_momentArrays(result) for result in results]
+        if asNumpy:
+            return dict(zip(names, results))
+        histograms = {}
+        for name, binNameList, binRangeList, result in zip(names, binNameLists, binRangeLists, results):
+            coords = {binName: (bins[:-1] + bins[1:]) / 2 for binName, bins in zip(binNameList, binRangeList)}
+            if weights is None:
+                histograms[name] = BinnedArray(result, dims=binNameList, coords=coords, name=name)
+            else:
+                histograms[name] = {key: BinnedArray(values, dims=binNameList, coords=coords, name=key)
+                                    for key, values in result.items()}
+        return histograms
+
+    def computeBinnedArray(self, fast_mode=False, weights=None):
+        """returns a BinnedArray object of the binned data.
+
+        :Parameters:
+            fast_mode : bool | False
+                if True, skips the metadata which require computation, see ``res_to_xarray``.
+            weights : list of str | None
+                columns of which the count, sum, sum of squares, minimum and maximum
+                in each bin are computed in the same pass as the counts. NaN weights
+                are ignored: the count of a weight is the number of its values which
+                are not NaN, and the minimum and maximum of the bins without weights
+                are NaN.
+
+        :Return:
+            ba : BinnedArray
+                the binned data. If weights are given, a dict of BinnedArrays of the
+                same bins instead, with the counts under 'counts' and each moment
+                named '<weight>_<moment>', e.g. 'gmdBda_count', 'gmdBda_sum',
+                'gmdBda_sumSquares', 'gmdBda_min' and 'gmdBda_max'.
+        """
+        if weights is None:
+            res = self.computeBinnedData()
+            return self.res_to_xarray(res,fast_mode=fast_mode)
+        self.usedColumns.update(weights)
+        moments, = self.binPartitions([self.binNameList], [self.binRangeList], weights)
+        arrays = _momentArrays(moments)
+        ba = self.res_to_xarray(arrays.pop('counts'), fast_mode=fast_mode)
+        binnedArrays = {'counts': ba}
+        for key, values in arrays.items():
+            binnedArrays[key] = BinnedArray(values, dims=ba.dims, coords=ba.coords, name=key)
+        return binnedArrays
 
     def res_to_xarray(self,res,fast_mode=False):
         """ creates a BinnedArray (xarray subclass) out of the given np.array
@@ -1140,18 +1680,21 @@ class DldProcessor:
 
             return res
 
+        self.joinColumns(self.binNameList)
+        dd = self.dd[list(dict.fromkeys(self.binNameList))]
+
         # prepare the partitions for the calculation in parallel
         calculatedResults = []
         results = []
         print(rank, size)
-        for i in range(0, self.dd.npartitions, size):
+        for i in range(0, dd.npartitions, size):
             resultsToCalculate = []
             # process the data in blocks of n partitions (given by the number of cores):
             # for j in range(0, self.N_CORES):
-            if (i + rank) >= self.dd.npartitions:
+            if (i + rank) >= dd.npartitions:
                 break
-            partval = self.dd.get_partition(i + rank).values.compute()
-            partcol = self.dd.get_partition(i + rank).columns.values
+            partval = dd.get_partition(i + rank).values.compute()
+            partcol = dd.get_partition(i + rank).columns.values
             if (i == 0):
                 results = analyzePartNumpy(partval, partcol)
             else:
@@ -1160,7 +1703,7 @@ class DldProcessor:
                   str(i +
                       rank) +
                   " of " +
-                  str(self.dd.npartitions) +
+                  str(dd.npartitions) +
                   ". partitions calculated in parallel: " +
                   str(size))
 
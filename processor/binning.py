@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Multidimensional histograms of the dataframe partitions.
+
+``histogram`` gives the same result as ``np.histogramdd`` with explicit bin
+edges, but the bin of each event is computed arithmetically on the axes with
+evenly spaced edges, as those made by ``genBins`` with ``np.linspace``, instead
+of by a binary search of the edges. The bins of all the axes are combined in a
+flat bin index and counted with a single ``np.bincount``. Axes with unevenly
+spaced edges still use ``np.searchsorted``. ``histogramMoments`` also
+accumulates the sum, sum of squares, minimum and maximum of weight columns in
+each bin, from the same flat bin index.
+
+If numba is installed, the events are instead binned by compiled kernels,
+which loop over the events of the columns, with the flat bin index as only
+temporary array, and release the GIL, so that the partitions are binned in parallel by the dask
+threaded scheduler, without copying them between processes. The NumPy
+implementation is used otherwise.
+"""
+import dask
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# True if the compiled kernel can be used, see ``histogram``
+NUMBA_AVAILABLE = numba is not None
+
+
+def uniformAxis(edges, rtol=1e-9):
+    """ Start and width of the bins of evenly spaced edges.
+
+    :Parameters:
+        edges : numpy array
+            increasing bin edges of an axis.
+        rtol : float | 1e-9
+            tolerance on the bin widths, relative to the mean width.
+
+    :Return:
+        axis : (float, float) or None
+            first edge and bin width, None if the edges are not evenly spaced.
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    if len(edges) < 2 or not np.all(np.isfinite(edges)):
+        return None
+    step = (edges[-1] - edges[0]) / (len(edges) - 1)
+    if not step > 0 or np.any(np.abs(np.diff(edges) - step) > rtol * step):
+        return None
+    return edges[0], step
+
+
+def binIndices(values, edges, axis=None):
+    """ Bin of each value, as in ``np.histogramdd``.
+
+    The bins are closed on the left, and the last one also on the right.
+    On a uniform axis, the bin computed from the start and width of the
+    bins is corrected by comparing the value to the edges of that bin, so
+    that rounding never puts a value next to an edge in a different bin
+    than the binary search.
+
+    :Parameters:
+        values : numpy array
+            values of one column.
+        edges : numpy array
+            increasing bin edges.
+        axis : (float, float) or None | None
+            start and width of the bins, as returned by ``uniformAxis``. If
+            None, the bins are found with ``np.searchsorted``.
+
+    :Return:
+        indices : numpy array
+            bin of each value, as int64.
+        inside : numpy array
+            True for the values within the edges, others have invalid indices.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    numOfBins = len(edges) - 1
+    inside = (values >= edges[0]) & (values <= edges[-1])  # also excludes NaN
+    if axis is None:
+        indices = np.searchsorted(edges, values, side='right') - 1
+        # values on the last edge are in the last bin
+        indices[values == edges[-1]] = numOfBins - 1
+    else:
+        with np.errstate(invalid='ignore'):
+            indices = ((values - axis[0]) * (1. / axis[1])).astype(np.int64)
+        np.clip(indices, 0, numOfBins - 1, out=indices)
+        indices -= values < edges[indices]
+        # upper edge of each bin, infinite for the last one, closed on the right
+        upperEdges = np.append(edges[1:-1], np.inf)
+        indices += values >= upperEdges[indices]
+    return indices, inside
+
+
+if NUMBA_AVAILABLE:
+    @numba.njit(nogil=True, cache=True)
+    def _addAxisKernel(values, edges, start, invStep, uniform, flat):
+        """ Combine the bins of one axis into the flat bin index of each event,
+        -1 for the events out of the edges of any axis, see ``binIndices``."""
+        numOfBins = len(edges) - 1
+        for i in range(len(values)):
+            if flat[i] < 0:
+                continue
+            x = values[i]
+            if not (x >= edges[0] and x <= edges[numOfBins]):  # also excludes NaN
+                flat[i] = -1
+                continue
+            if uniform:
+                k = min(max(int((x - start) * invStep), 0), numOfBins - 1)
+                if x < edges[k]:
+                    k -= 1
+                elif k < numOfBins - 1 and x >= edges[k + 1]:
+                    k += 1
+            else:  # last edge with x >= edge, the last bin is closed on the right
+                low = 0
+                high = numOfBins
+                while high - low > 1:
+                    middle = (low + high) // 2
+                    if x >= edges[middle]:
+                        low = middle
+                    else:
+                        high = middle
+                k = low
+            flat[i] = flat[i] * numOfBins + k
+
+    @numba.njit(nogil=True, cache=True)
+    def _countKernel(flat, counts):
+        """ Add the events with a valid flat bin index to the counts."""
+        for i in range(len(flat)):
+            if flat[i] >= 0:
+                counts[flat[i]] += 1
+
+    @numba.njit(nogil=True, cache=True)
+    def _momentsKernel(flat, weights, counts, sums, sumSquares, mins, maxs):
+        """ Add the weights of the events with a valid flat bin index to the
+        counts, sums, sums of squares, minima and maxima, ignoring NaN weights."""
+        for i in range(len(flat)):
+            k = flat[i]
+            w = weights[i]
+            if k >= 0 and w == w:
+                counts[k] += 1
+                sums[k] += w
+                sumSquares[k] += w * w
+                if w < mins[k]:
+                    mins[k] = w
+                if w > maxs[k]:
+                    maxs[k] = w
+
+
+def _useNumba(engine):
+    """ True if the compiled kernels are used by the given engine."""
+    engine = engine.lower()
+    if engine not in ['auto', 'numba', 'numpy']:
+        raise ValueError('Invalid binning engine {}, choose between auto, numba and numpy.'.format(engine))
+    if engine == 'numba' and not NUMBA_AVAILABLE:
+        raise ImportError('numba is not installed, use the numpy binning engine.')
+    return engine == 'numba' or (engine == 'auto' and NUMBA_AVAILABLE)
+
+
+def flatBinIndex(columns, edges, engine='auto'):
+    """ Flat bin index of each event, in the C order of the histogram.
+
+    :Parameters:
+        columns : list of numpy arrays
+            values of each binned dimension, of the same length.
+        edges : list of numpy arrays
+            bin edges of each dimension.
+        engine : str | 'auto'
+            'numba' for the compiled kernels, 'numpy' for the NumPy implementation,
+            or 'auto' for the kernels if numba is installed. The kernels make one
+            pass per axis over the events, with the flat bin index as only
+            temporary array.
+
+    :Return:
+        flat : numpy array
+            int64 index of the bin of each event, -1 for the events out of the edges.
+    """
+    if _useNumba(engine):
+        flat = np.zeros(len(columns[0]), dtype=np.int64)
+        for values, e in zip(columns, edges):
+            values = np.asarray(values)  # columns and memory maps are not copied
+            if values.dtype not in (np.float32, np.float64):
+                values = values.astype(np.float64)
+            e = np.ascontiguousarray(e, dtype=np.float64)
+            axis = uniformAxis(e)
+            if axis is None:
+                _addAxisKernel(values, e, 0., 0., False, flat)
+            else:
+                _addAxisKernel(values, e, axis[0], 1. / axis[1], True, flat)
+        return flat
+    flat = None
+    valid = None
+    for values, e in zip(columns, edges):
+        indices, inside = binIndices(values, e, uniformAxis(e))
+        flat = indices if flat is None else flat * (len(e) - 1) + indices
+        valid = inside if valid is None else valid & inside
+    flat[~valid] = -1
+    return flat
+
+
+def histogram(columns, edges, engine='auto'):
+    """ Count the events in the bins of several columns.
+
+    :Parameters:
+        columns : list of numpy arrays
+            values of each binned dimension, of the same length.
+        edges : list of numpy arrays
+            bin edges of each dimension.
+        engine : str | 'auto'
+            'numba' for the compiled kernels, 'numpy' for the NumPy implementation,
+            or 'auto' for the kernels if numba is installed.
+
+    :Return:
+        result : numpy array
+            float64 counts, of shape (len(edges[0]) - 1, len(edges[1]) - 1, ...),
+            as ``np.histogramdd(columns, bins=edges)[0]``.
+    """
+    shape = tuple(len(e) - 1 for e in edges)
+    if len(edges) == 0:
+        _useNumba(engine)
+        return np.zeros(shape)
+    flat = flatBinIndex(columns, edges, engine)
+    if _useNumba(engine):
+        counts = np.zeros(int(np.prod(shape)), dtype=np.int64)
+        _countKernel(flat, counts)
+    else:
+        counts = np.bincount(flat[flat >= 0], minlength=int(np.prod(shape)))
+    return counts.reshape(shape).astype(np.float64)
+
+
+def histogramMoments(columns, edges, weights, engine='auto'):
+    """ Count the events in the bins of several columns, and accumulate the
+    count, sum, sum of squares, minimum and maximum of weight columns in each
+    bin, in the same pass.
+
+    :Parameters:
+        columns : list of numpy arrays
+            values of each binned dimension, of the same length.
+        edges : list of numpy arrays
+            bin edges of each dimension.
+        weights : dict
+            weight columns by name, of the same length as the binned columns.
+            NaN weights are ignored.
+        engine : str | 'auto'
+            'numba' for the compiled kernels, 'numpy' for the NumPy implementation,
+            or 'auto' for the kernels if numba is installed.
+
+    :Return:
+        moments : dict
+            the counts, as returned by ``histogram``, under 'counts', and for each
+            weight the (name, 'count'), (name, 'sum'), (name, 'sumSquares'),
+            (name, 'min') and (name, 'max') float64 arrays of the same shape. The
+            count is the number of events with a weight which is not NaN, by which
+            the sums are divided to get means. The minimum and maximum
+            of the bins without weights are +inf and -inf, so that partial results
+            can be combined, see ``treeSum``.
+    """
+    shape = tuple(len(e) - 1 for e in edges)
+    size = int(np.prod(shape))
+    useNumba = _useNumba(engine)
+    flat = flatBinIndex(columns, edges, engine) if len(edges) > 0 else np.zeros(0, dtype=np.int64)
+    if useNumba:
+        counts = np.zeros(size, dtype=np.int64)
+        _countKernel(flat, counts)
+    else:
+        counts = np.bincount(flat[flat >= 0], minlength=size)
+    moments = {'counts': counts.reshape(shape).astype(np.float64)}
+    for name, values in weights.items():
+        values = np.asarray(values, dtype=np.float64)
+        mins = np.full(size, np.inf)
+        maxs = np.full(size, -np.inf)
+        if useNumba:
+            weightCounts = np.zeros(size, dtype=np.int64)
+            sums = np.zeros(size)
+            sumSquares = np.zeros(size)
+            _momentsKernel(flat, values, weightCounts, sums, sumSquares, mins, maxs)
+        else:
+            valid = (flat >= 0) & ~np.isnan(values)
+            validFlat = flat[valid]
+            values = values[valid]
+            weightCounts = np.bincount(validFlat, minlength=size)
+            sums = np.bincount(validFlat, weights=values, minlength=size)
+            sumSquares = np.bincount(validFlat, weights=values * values, minlength=size)
+            np.minimum.at(mins, validFlat, values)
+            np.maximum.at(maxs, validFlat, values)
+        moments[(name, 'count')] = weightCounts.reshape(shape).astype(np.float64)
+        moments[(name, 'sum')] = sums.reshape(shape)
+        moments[(name, 'sumSquares')] = sumSquares.reshape(shape)
+        moments[(name, 'min')] = mins.reshape(shape)
+        moments[(name, 'max')] = maxs.reshape(shape)
+    return moments
+
+
+def _sumHistograms(*histograms):
+    """ Sum of partial histograms, in a new array, or of tuples of histograms,
+    summed element by element, or of moments of ``histogramMoments``, of which
+    the minima and maxima are combined with min and max."""
+    if isinstance(histograms[0], tuple):
+        return tuple(_sumHistograms(*elements) for elements in zip(*histograms))
+    if isinstance(histograms[0], dict):
+        total = {}
+        for key in histograms[0]:
+            if key != 'counts' and key[1] == 'min':
+                total[key] = np.minimum.reduce([h[key] for h in histograms])
+            elif key != 'counts' and key[1] == 'max':
+                total[key] = np.maximum.reduce([h[key] for h in histograms])
+            else:
+                total[key] = _sumHistograms(*[h[key] for h in histograms])
+        return total
+    total = np.array(histograms[0], dtype=np.float64)
+    for h in histograms[1:]:
+        total += h
+    return total
+
+
+def treeSum(partials, splitEvery=8):
+    """ Sum delayed partial histograms with a tree of delayed sums.
+
+    Each sum only waits for its own ``splitEvery`` inputs, so the partial
+    histograms are added in parallel as soon as they are computed, and
+    released, instead of after all of them.
+
+    :Parameters:
+        partials : list of dask.delayed
+            partial histograms of the same shape, e.g. one per partition, or
+            tuples of histograms, summed element by element, or moments of
+            ``histogramMoments``.
+        splitEvery : int | 8
+            number of histograms added by each sum.
+
+    :Return:
+        total : dask.delayed
+            the sum of all the histograms.
+    """
+    if len(partials) == 0:
+        raise ValueError('No histograms to sum')
+    while len(partials) > 1:
+        partials = [dask.delayed(_sumHistograms)(*partials[i:i + splitEvery])
+                    for i in range(0, len(partials), splitEvery)]
+    return partials[0]
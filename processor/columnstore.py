@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped column store of the converted dataframes.
+
+A dataframe is stored in a folder, e.g. 'run12345_el_npy' next to the parquet
+'run12345_el', with one subfolder per partition, named
+``part.00000``, ``part.00001``, ..., and one ``.npy`` file per column in each
+partition, plus ``_index.npy`` with the index. The files are plain numpy arrays
+in the dtypes of the dataframe, so that they are read by memory-mapping them:
+nothing is decoded, and only the pages of the columns actually used are loaded,
+and then kept in the page cache for the following reads. The partitions of
+``readDataframe`` are built on the mapped arrays without copying them, one
+pandas block per column, and ``computeBinnedData`` bins the mapped arrays
+directly, without building dataframes.
+"""
+import os
+import shutil
+
+import dask
+import dask.dataframe
+import numpy as np
+import pandas as pd
+
+INDEX_FILE = '_index.npy'
+COLUMNS_FILE = '_columns.txt'
+
+
+def partitionPaths(path):
+    """ Folders of the complete partitions of a stored dataframe, in order.
+
+    Partitions without the '_columns.txt' file, written last by ``writePartition``,
+    were interrupted while being written: they are skipped, with a warning.
+
+    :Parameters:
+        path : str
+            folder of the dataframe.
+
+    :Return:
+        partitions : list of str
+            full paths of the partition folders.
+    """
+    if not os.path.isdir(path):
+        raise FileNotFoundError('No column store in {}'.format(path))
+    partitions = []
+    for name in sorted(os.listdir(path)):
+        partitionPath = os.path.join(path, name)
+        if not (name.startswith('part.') and os.path.isdir(partitionPath)):
+            continue
+        if os.path.isfile(os.path.join(partitionPath, COLUMNS_FILE)):
+            partitions.append(partitionPath)
+        else:
+            print('WARNING: skipping incomplete partition {}'.format(partitionPath))
+    return partitions
+
+
+def storedColumns(partitionPath):
+    """ Names of the columns stored in a partition folder, in stored order."""
+    with open(os.path.join(partitionPath, COLUMNS_FILE), 'r') as f:
+        return f.read().splitlines()
+
+
+def writePartition(part, partitionPath):
+    """ Store a pandas dataframe as one .npy file per column.
+
+    :Parameters:
+        part : pandas dataframe
+            the partition to store.
+        partitionPath : str
+            folder of the partition, created if needed.
+
+    :Return:
+        rows : int
+            number of rows written.
+    """
+    os.makedirs(partitionPath, exist_ok=True)
+    for col in part.columns:
+        np.save(os.path.join(partitionPath, '{}.npy'.format(col)), np.ascontiguousarray(part[col].values))
+    np.save(os.path.join(partitionPath, INDEX_FILE), np.ascontiguousarray(part.index.values))
+    # written last, marks the partition as complete
+    with open(os.path.join(partitionPath, COLUMNS_FILE), 'w') as f:
+        f.write('\n'.join(part.columns))
+    return len(part)
+
+
+def storeDataframe(dataframe, path, append=False, numWorkers=None):
+    """ Store a dask dataframe, one partition folder per dask partition.
+
+    Partitions are computed and written in parallel, so that a streaming
+    dataframe is never held in memory as a whole.
+
+    :Parameters:
+        dataframe : dask dataframe
+            the dataframe to store.
+        path : str
+            folder of the dataframe.
+        append : bool | False
+            if True, the partitions are added after the last complete one in
+            ``path``, and the incomplete ones are removed, otherwise the existing
+            ones are replaced.
+        numWorkers : int | None
+            number of partitions written at the same time.
+
+    :Return:
+        rows : int
+            number of rows written.
+    """
+    os.makedirs(path, exist_ok=True)
+    existing = sorted(name for name in os.listdir(path)
+                      if name.startswith('part.') and os.path.isdir(os.path.join(path, name)))
+    first = 0
+    for name in existing:
+        if append and os.path.isfile(os.path.join(path, name, COLUMNS_FILE)):
+            first = int(name[len('part.'):]) + 1
+        else:
+            # replaced, or left incomplete by an interrupted write
+            shutil.rmtree(os.path.join(path, name))
+    writes = [dask.delayed(writePartition)(part, os.path.join(path, 'part.{:05d}'.format(first + i)))
+              for i, part in enumerate(dataframe.to_delayed())]
+    return sum(dask.compute(*writes, num_workers=numWorkers))
+
+
+def memmapColumns(partitionPath, columns=None):
+    """ Memory-mapped arrays of the columns of a partition.
+
+    :Parameters:
+        partitionPath : str
+            folder of the partition.
+        columns : list of str | None
+            columns to map. If None, all the stored ones.
+
+    :Return:
+        arrays : dict
+            read only numpy memmap of each column, in the order of ``columns``.
+    """
+    if columns is None:
+        columns = storedColumns(partitionPath)
+    return {col: np.load(os.path.join(partitionPath, '{}.npy'.format(col)), mmap_mode='r') for col in columns}
+
+
+def readPartition(partitionPath, columns=None):
+    """ Pandas dataframe of some columns of a partition, on the memory-mapped
+    arrays: the columns are not consolidated in blocks, which would copy them."""
+    arrays = memmapColumns(partitionPath, columns)
+    index = np.load(os.path.join(partitionPath, INDEX_FILE), mmap_mode='r')
+    return pd.DataFrame(arrays, index=pd.Index(index, copy=False), copy=False)
+
+
+def readDataframe(path, columns=None):
+    """ Dask dataframe of a stored column store, one partition per partition folder.
+
+    :Parameters:
+        path : str
+            folder of the dataframe.
+        columns : list of str | None
+            columns to read. If None, all the stored ones.
+
+    :Return:
+        dataframe : dask dataframe
+            the lazily loaded dataframe.
+        partitions : list of str
+            folders of its partitions, as returned by ``partitionPaths``.
+    """
+    partitions = partitionPaths(path)
+    if len(partitions) == 0:
+        raise FileNotFoundError('No partitions in {}'.format(path))
+    stored = storedColumns(partitions[0])
+    if columns is None:
+        columns = stored
+    else:
+        columns = [col for col in stored if col in columns]
+    arrays = memmapColumns(partitions[0], columns)
+    index = np.load(os.path.join(partitions[0], INDEX_FILE), mmap_mode='r')
+    meta = pd.DataFrame({col: np.array([], dtype=values.dtype) for col, values in arrays.items()},
+                        index=np.array([], dtype=index.dtype))
+    dataframe = dask.dataframe.from_delayed([dask.delayed(readPartition)(partition, columns)
+                                             for partition in partitions], meta=meta, verify_meta=False)
+    return dataframe, partitions
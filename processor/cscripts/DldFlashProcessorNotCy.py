@@ -6,7 +6,7 @@
 import numpy as np
 import math
 
-DTYPE = np.float
+DTYPE = np.float64
 
 def main():
     pass
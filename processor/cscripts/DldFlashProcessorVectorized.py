@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized numpy version of the microbunch assignment code.
+
+Drop-in replacement for DldFlashProcessorCy and DldFlashProcessorNotCy,
+which needs no compilation step.
+"""
+import numpy as np
+
+DTYPE = np.float64
+
+
+def main():
+    pass
+
+
+def assignToMircobunch(microbunchIds, toConvert):
+    """ Convert array from (mab,mib) to (mab,el)
+
+    Here we convert an array ordered as (macrobunch, microbunch) into (macrobunch, electron).
+    This is needed, for example, to convert bam data into the electron table.
+
+    Electrons with a NaN, negative or out of range microbunch ID get NaN, all others
+    get the value of their microbunch, gathered in a single ``take_along_axis`` lookup.
+    The output is identical to the one of the loop implementation in DldFlashProcessorNotCy.
+
+    :Parameters:
+        microbunchIds : numpy array
+            (macrobunch, electron) array of the microbunch ID of each electron.
+        toConvert : numpy array
+            (macrobunch, microbunch) array of the values to assign to each electron.
+
+    :Return:
+        result : numpy array
+            (macrobunch, electron) array of float64 values.
+    """
+    microbunchIds = np.asarray(microbunchIds, dtype=DTYPE)
+    toConvert = np.asarray(toConvert, dtype=DTYPE)
+    assert microbunchIds.shape[0] == toConvert.shape[0]
+
+    numOfMicrobunches = toConvert.shape[1]
+    # comparisons with NaN are False, so NaN IDs are masked as well
+    valid = (microbunchIds >= 0) & (microbunchIds < numOfMicrobunches)
+    if numOfMicrobunches == 0 or not valid.any():
+        return np.full(microbunchIds.shape, np.nan, dtype=DTYPE)
+
+    # casting truncates towards zero, like int() in the loop implementation
+    intMicrobunchIds = np.where(valid, microbunchIds, 0).astype(np.intp)
+    result = np.take_along_axis(toConvert, intMicrobunchIds, axis=1)
+    result[~valid] = np.nan
+
+    return result
+
+
+
+def assignCompactToMircobunch(macrobunchIndex, microbunchIds, toConvert):
+    """ Convert array from (mab,mib) to compact electron storage
+
+    Same as ``assignToMircobunch``, but for electrons stored as a flat list of
+    valid hits instead of a NaN padded (macrobunch, electron) array, so that
+    the lookup is done only for existing electrons.
+
+    :Parameters:
+        macrobunchIndex : numpy array
+            row of ``toConvert`` (macrobunch) of each electron.
+        microbunchIds : numpy array
+            microbunch ID of each electron.
+        toConvert : numpy array
+            (macrobunch, microbunch) array of the values to assign to each electron.
+
+    :Return:
+        result : numpy array
+            array of float64 values, one per electron.
+    """
+    microbunchIds = np.asarray(microbunchIds, dtype=DTYPE)
+    toConvert = np.asarray(toConvert, dtype=DTYPE)
+    assert microbunchIds.shape == np.shape(macrobunchIndex)
+
+    numOfMicrobunches = toConvert.shape[1]
+    valid = (microbunchIds >= 0) & (microbunchIds < numOfMicrobunches)
+    result = np.full(microbunchIds.shape, np.nan, dtype=DTYPE)
+    result[valid] = toConvert[macrobunchIndex[valid], microbunchIds[valid].astype(np.intp)]
+
+    return result
+
+if __name__ == '__main__':
+    main()
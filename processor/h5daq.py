@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+"""
+Direct h5py access to the raw HDF5 files written by the FLASH DAQ.
+
+In the FLASH layout, each DAQ channel is an HDF5 group containing an ``index``
+dataset, with the macrobunch ID of each row, and a ``value`` dataset, with the
+data of each macrobunch. A run is split in several files, named as
+``FLASH1_USER2_stream_2_run12345_file1_20190101T000000.1.h5``.
+
+The location of the macrobunch IDs in the files, i.e. the (file, row) where
+each block of consecutive IDs is stored, is indexed per file and cached, in
+memory and in json files, so that reading an interval only opens the files
+which contain it and reads the corresponding rows. The channels of each file,
+with their shape, dtype and macrobunch ID interval, are scanned once and cached
+in the same way, see ``runMetadata``. The json cache holds one file per raw
+file and is bounded, see ``pruneCache``.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+
+import dask
+import dask.array
+import h5py
+import numpy as np
+
+# on disk cache of the segment index, one json file per raw file
+SEGMENT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.hextof_processor', 'segments')
+# number of json files kept in the cache, the least recently used are deleted, see pruneCache
+SEGMENT_CACHE_MAX_FILES = 20000
+
+_segmentCache = {}
+_segmentCacheLock = threading.Lock()
+_metadataCache = {}
+_prunedCacheDirs = set()
+
+
+def runFiles(rootDirectoryOfH5Files, runNumber):
+    """ Find the raw HDF5 files of a run.
+
+    :Parameters:
+        rootDirectoryOfH5Files : str
+            path where to look for data (recursive in subdirectories)
+        runNumber : int | None
+            number of the run. If None, all the files found are returned.
+
+    :Return:
+        files : list of str
+            full paths of the files of the run, sorted by file number.
+    """
+    runName = 'run{}'.format(runNumber)
+    files = []
+    for dirPath, dirNames, fileNames in os.walk(rootDirectoryOfH5Files):
+        for name in fileNames:
+            nameParts = name.split('_')
+            if name.endswith('.h5') and (runNumber is None or (len(nameParts) > 4 and nameParts[4] == runName)):
+                files.append(os.path.join(dirPath, name))
+    if len(files) == 0:
+        raise FileNotFoundError('No files of run {} under path {}'.format(runNumber, rootDirectoryOfH5Files))
+    return sorted(files, key=_fileNumber)
+
+
+def _fileNumber(fileName):
+    """ Sorting key of the raw files: file number first, then name."""
+    match = re.search(r'_file(\d+)_', os.path.basename(fileName))
+    return (int(match.group(1)) if match else 0, os.path.basename(fileName))
+
+
+def _indexSegments(index):
+    """ Split the macrobunch IDs of a dataset in blocks of consecutive IDs,
+    as a list of (first ID, last ID + 1, first row)."""
+    if len(index) == 0:
+        return []
+    breaks = np.nonzero(np.diff(index) != 1)[0] + 1
+    return [(int(index[rowFrom]), int(index[rowTo - 1]) + 1, int(rowFrom))
+            for rowFrom, rowTo in zip(np.append(0, breaks), np.append(breaks, len(index)))]
+
+
+def _cacheKey(fileName, cacheDir, suffix):
+    """ Key of a raw file in the memory caches, its (path, size, modification
+    time), and path of its json cache file in ``cacheDir``, or None."""
+    if cacheDir is None:
+        cacheDir = SEGMENT_CACHE_DIR
+    stat = os.stat(fileName)
+    key = (os.path.abspath(fileName), stat.st_size, stat.st_mtime)
+    cacheFile = None
+    if cacheDir:
+        cacheFile = os.path.join(cacheDir, hashlib.md5(key[0].encode()).hexdigest() + suffix)
+    return key, cacheFile
+
+
+def _loadCacheFile(key, cacheFile):
+    """ Cached content of a json cache file, None if missing or outdated."""
+    if cacheFile is None:
+        return None
+    try:
+        with open(cacheFile, 'r') as f:
+            stored = json.load(f)
+        if (stored['fileName'], stored['size'], stored['mtime']) == key:
+            os.utime(cacheFile)  # marks it as recently used, see pruneCache
+            return stored['channels']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _saveCacheFile(key, cacheFile, channels):
+    """ Atomically write a json cache file, ignoring errors as the cache is optional."""
+    if cacheFile is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+        tmpFile = '{}.{}.{}.tmp'.format(cacheFile, os.getpid(), threading.get_ident())
+        with open(tmpFile, 'w') as f:
+            json.dump({'fileName': key[0], 'size': key[1], 'mtime': key[2], 'channels': channels}, f)
+        os.replace(tmpFile, cacheFile)
+    except OSError:
+        pass
+    cacheDir = os.path.dirname(cacheFile)
+    if cacheDir not in _prunedCacheDirs:
+        _prunedCacheDirs.add(cacheDir)
+        pruneCache(cacheDir)
+
+
+def pruneCache(cacheDir=None, maxFiles=None):
+    """ Delete the least recently used json cache files beyond a maximum number.
+
+    The cache files are named after the path of their raw file, and replaced
+    when it changes, but those of deleted or moved raw files are never read
+    again. The cache is pruned once per process, when it is first written to.
+
+    :Parameters:
+        cacheDir : str | None (default to ``SEGMENT_CACHE_DIR``)
+            folder of the json cache files.
+        maxFiles : int | None (default to ``SEGMENT_CACHE_MAX_FILES``)
+            number of cache files kept.
+
+    :Return:
+        removed : int
+            number of deleted cache files.
+    """
+    if cacheDir is None:
+        cacheDir = SEGMENT_CACHE_DIR
+    if maxFiles is None:
+        maxFiles = SEGMENT_CACHE_MAX_FILES
+    entries = []
+    try:
+        for entry in os.scandir(cacheDir):
+            if entry.name.endswith('.json'):
+                entries.append((entry.stat().st_mtime, entry.path))
+    except OSError:  # another process may be pruning the cache
+        return 0
+    removed = 0
+    for mtime, path in sorted(entries)[:max(0, len(entries) - maxFiles)]:
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def _setCacheEntry(cache, key, value):
+    """ Set a memory cache entry, dropping those of previous versions of the same file."""
+    for oldKey in [oldKey for oldKey in cache if oldKey[0] == key[0] and oldKey != key]:
+        del cache[oldKey]
+    cache[key] = value
+
+
+def _storeSegments(key, cacheFile, cached):
+    """ Store the segment index of a file in memory and on disk."""
+    _saveCacheFile(key, cacheFile, cached)
+    with _segmentCacheLock:
+        _setCacheEntry(_segmentCache, key, cached)
+
+
+def fileSegments(fileName, channelNames, cacheDir=None):
+    """ Segment index of some channels of a raw file.
+
+    The index is cached in memory and in ``cacheDir``, and read again from the
+    file only if its size or modification time changed.
+
+    :Parameters:
+        fileName : str
+            raw HDF5 file.
+        channelNames : list of str
+            DAQ addresses of the channels.
+        cacheDir : str | None (default to ``SEGMENT_CACHE_DIR``)
+            folder of the json cache files. If '', the index is not stored on disk.
+
+    :Return:
+        segments : dict
+            for each channel found in the file, a list of (first macrobunch ID,
+            last macrobunch ID + 1, first row) and the number of values per macrobunch.
+    """
+    key, cacheFile = _cacheKey(fileName, cacheDir, '.json')
+
+    with _segmentCacheLock:
+        cached = _segmentCache.get(key)
+    if cached is None:
+        stored = _loadCacheFile(key, cacheFile)
+        if stored is not None:
+            cached = {name: None if found is None else ([tuple(seg) for seg in found[0]], found[1])
+                      for name, found in stored.items()}
+    if cached is None:
+        cached = {}
+
+    missing = [name for name in channelNames if name not in cached]
+    if len(missing) > 0:
+        cached = dict(cached)
+        with h5py.File(fileName, 'r') as h5File:
+            for name in missing:
+                if name not in h5File:
+                    cached[name] = None
+                    continue
+                shape = h5File[name]['value'].shape
+                index = h5File[name]['index'][()].astype(np.int64)
+                cached[name] = (_indexSegments(index), shape[1] if len(shape) > 1 else 1)
+        _storeSegments(key, cacheFile, cached)
+    return {name: cached[name] for name in channelNames if cached[name] is not None}
+
+
+def fileMetadata(fileName, cacheDir=None):
+    """ Channels of a raw file, with the shape and dtype of their values and
+    their macrobunch ID interval.
+
+    The file is scanned once: the index of all its channels is read, and also
+    stored in the segment index of ``fileSegments``. The result is cached in
+    memory and in ``cacheDir`` as the segment index.
+
+    :Parameters:
+        fileName : str
+            raw HDF5 file.
+        cacheDir : str | None (default to ``SEGMENT_CACHE_DIR``)
+            folder of the json cache files. If '', the metadata is not stored on disk.
+
+    :Return:
+        channels : dict
+            for each channel, in the order of ``listChannels``, a dict with the
+            'shape' (rows, values per macrobunch) and 'dtype' of the values, and the
+            'pulseIdInterval' (first, last + 1) of the macrobunch IDs, None if empty.
+    """
+    key, cacheFile = _cacheKey(fileName, cacheDir, '.channels.json')
+    with _segmentCacheLock:
+        channels = _metadataCache.get(key)
+    if channels is not None:
+        return channels
+    channels = _loadCacheFile(key, cacheFile)
+    if channels is None:
+        channels = {}
+        segments = {}
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Group) and 'index' in obj and 'value' in obj:
+                shape = obj['value'].shape
+                index = obj['index'][()].astype(np.int64)
+                segments['/' + name] = (_indexSegments(index), shape[1] if len(shape) > 1 else 1)
+                channels['/' + name] = {'shape': [shape[0], shape[1] if len(shape) > 1 else 1],
+                                        'dtype': obj['value'].dtype.str,
+                                        'pulseIdInterval': None if len(index) == 0 else
+                                        [int(index.min()), int(index.max()) + 1]}
+
+        with h5py.File(fileName, 'r') as h5File:
+            h5File.visititems(visit)
+        _saveCacheFile(key, cacheFile, channels)
+
+        segmentKey, segmentFile = _cacheKey(fileName, cacheDir, '.json')
+        with _segmentCacheLock:
+            segments.update(_segmentCache.get(segmentKey, {}))
+        _storeSegments(segmentKey, segmentFile, segments)
+    with _segmentCacheLock:
+        _setCacheEntry(_metadataCache, key, channels)
+    return channels
+
+
+def runMetadata(files, cacheDir=None):
+    """ Channels of a run, from one scan of each file, see ``fileMetadata``.
+
+    :Parameters:
+        files : list of str
+            raw HDF5 files of the run, sorted by file number.
+        cacheDir : str | None (default to ``SEGMENT_CACHE_DIR``)
+            folder of the json cache files.
+
+    :Return:
+        metadata : dict
+            'channels': for each channel, a dict with the 'shape' of its values over
+            the whole run, their 'dtype' and the 'pulseIdInterval' of the channel;
+            'pulseIdInterval': the macrobunch ID interval of the run, spanning the
+            first channel of each file as in PAH; 'files': the files of the run.
+    """
+    channels = {}
+    intervals = []
+    for fileName in files:
+        fileChannels = fileMetadata(fileName, cacheDir)
+        for i, (name, found) in enumerate(fileChannels.items()):
+            interval = found['pulseIdInterval']
+            if i == 0 and interval is not None:
+                intervals.append(interval)
+            if name not in channels:
+                channels[name] = {'shape': tuple(found['shape']), 'dtype': np.dtype(found['dtype']),
+                                  'pulseIdInterval': None if interval is None else tuple(interval)}
+                continue
+            channel = channels[name]
+            channel['shape'] = (channel['shape'][0] + found['shape'][0], max(channel['shape'][1], found['shape'][1]))
+            if interval is not None:
+                if channel['pulseIdInterval'] is None:
+                    channel['pulseIdInterval'] = tuple(interval)
+                else:
+                    channel['pulseIdInterval'] = (min(channel['pulseIdInterval'][0], interval[0]),
+                                                  max(channel['pulseIdInterval'][1], interval[1]))
+    pulseIdInterval = None
+    if len(intervals) > 0:
+        pulseIdInterval = (min(i[0] for i in intervals), max(i[1] for i in intervals))
+    return {'channels': channels, 'pulseIdInterval': pulseIdInterval, 'files': list(files)}
+
+
+def isChannelInInterval(metadata, channelName, pulseIdInterval):
+    """ True if a channel of ``runMetadata`` has data in the given macrobunch ID interval."""
+    channel = metadata['channels'].get(channelName)
+    if channel is None or channel['pulseIdInterval'] is None:
+        return False
+    return channel['pulseIdInterval'][0] < pulseIdInterval[1] and channel['pulseIdInterval'][1] > pulseIdInterval[0]
+
+
+def channelSegments(files, channelName, cacheDir=None):
+    """ Locate the rows of a channel in the files of a run.
+
+    :Parameters:
+        files : list of str
+            raw HDF5 files of the run, sorted by file number.
+        channelName : str
+            DAQ address of the channel.
+        cacheDir : str | None (default to ``SEGMENT_CACHE_DIR``)
+            folder of the json cache files of ``fileSegments``.
+
+    :Return:
+        segments : list of (int, int, str, int)
+            (first macrobunch ID, last macrobunch ID + 1, file name, first row)
+            of each block of consecutive macrobunch IDs, in file order.
+        numOfColumns : int
+            number of values per macrobunch.
+    """
+    segments = []
+    numOfColumns = None
+    for fileName in files:
+        found = fileSegments(fileName, [channelName], cacheDir).get(channelName)
+        if found is None:
+            continue
+        fileSegs, numOfColumns = found
+        segments.extend((segFrom, segTo, fileName, row) for segFrom, segTo, row in fileSegs)
+    if numOfColumns is None:
+        raise KeyError('Channel {} not found in the run files'.format(channelName))
+    return segments, numOfColumns
+
+
+def pulseIdIntervalOfSegments(segments):
+    """ Macrobunch ID interval covered by the given segments, as (first, last + 1)."""
+    return min(s[0] for s in segments), max(s[1] for s in segments)
+
+
+def readSegments(segments, channelName, pulseIdInterval, numOfColumns):
+    """ Read the values of a channel for a macrobunch ID interval.
+
+    Rows are aligned to the macrobunch IDs, so row i holds the data of macrobunch
+    pulseIdInterval[0] + i. Macrobunches missing from the files are filled with NaN.
+
+    :Parameters:
+        segments : list of (int, int, str, int)
+            segments of the channel, as returned by ``channelSegments``.
+        channelName : str
+            DAQ address of the channel.
+        pulseIdInterval : (int, int)
+            first (inclusive) and last (non-inclusive) macrobunch IDs.
+        numOfColumns : int
+            number of values per macrobunch.
+
+    :Return:
+        values : numpy array
+            (macrobunch, value) array of float64.
+    """
+    idFrom, idTo = pulseIdInterval
+    values = np.full((idTo - idFrom, numOfColumns), np.nan)
+    h5File = None
+    try:
+        for segFrom, segTo, fileName, row in segments:
+            lo, hi = max(segFrom, idFrom), min(segTo, idTo)
+            if lo >= hi:
+                continue
+            if h5File is None or h5File.filename != fileName:
+                if h5File is not None:
+                    h5File.close()
+                h5File = h5py.File(fileName, 'r')
+            data = h5File[channelName]['value'][row + lo - segFrom:row + hi - segFrom]
+            values[lo - idFrom:hi - idFrom] = data.reshape(hi - lo, numOfColumns)
+    finally:
+        if h5File is not None:
+            h5File.close()
+    return values
+
+
+def valuesOfInterval(files, channelName, pulseIdInterval):
+    """ Read the values of a channel for a macrobunch ID interval.
+
+    Only the rows of the interval are read, from the files containing it.
+
+    :Parameters:
+        files : list of str
+            raw HDF5 files of the run, sorted by file number.
+        channelName : str
+            DAQ address of the channel.
+        pulseIdInterval : (int, int)
+            first (inclusive) and last (non-inclusive) macrobunch IDs.
+
+    :Return:
+        values : numpy array
+            (macrobunch, value) array of float64, aligned to the macrobunch IDs as
+            in ``readSegments``.
+    """
+    segments, numOfColumns = channelSegments(files, channelName)
+    segments = [s for s in segments if s[0] < pulseIdInterval[1] and s[1] > pulseIdInterval[0]]
+    return readSegments(segments, channelName, pulseIdInterval, numOfColumns)
+
+
+def lazyValuesOfInterval(files, channelName, pulseIdInterval, chunks):
+    """ Dask array of the values of a channel, backed by the HDF5 datasets.
+
+    Rows are aligned to the macrobunch IDs as in ``readSegments``. Each chunk of
+    rows is a single task which reads only the corresponding slices of the files,
+    and nothing is read until the array, or a slice of it, is computed.
+
+    :Parameters:
+        files : list of str
+            raw HDF5 files of the run, sorted by file number.
+        channelName : str
+            DAQ address of the channel.
+        pulseIdInterval : (int, int)
+            first (inclusive) and last (non-inclusive) macrobunch IDs.
+        chunks : tuple of int
+            number of rows of each chunk, e.g. the sizes of the macrobunch ranges
+            in which the electron dataframe is created.
+
+    :Return:
+        values : dask array
+            (macrobunch, value) array of float64.
+    """
+    segments, numOfColumns = channelSegments(files, channelName)
+    blocks = []
+    idFrom = pulseIdInterval[0]
+    for chunk in chunks:
+        interval = (idFrom, idFrom + chunk)
+        chunkSegments = [s for s in segments if s[0] < interval[1] and s[1] > interval[0]]
+        if len(chunkSegments) == 0:
+            block = dask.array.full((chunk, numOfColumns), np.nan, chunks=(chunk, numOfColumns))
+        else:
+            block = dask.array.from_delayed(
+                dask.delayed(readSegments)(chunkSegments, channelName, interval, numOfColumns),
+                shape=(chunk, numOfColumns), dtype=np.float64)
+        blocks.append(block)
+        idFrom += chunk
+    return dask.array.concatenate(blocks, axis=0)
+
+
+def listChannels(fileName):
+    """ DAQ addresses of the channels stored in a raw file, i.e. of the groups
+    holding an ``index`` and a ``value`` dataset."""
+    names = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Group) and 'index' in obj and 'value' in obj:
+            names.append('/' + name)
+
+    with h5py.File(fileName, 'r') as h5File:
+        h5File.visititems(visit)
+    return names
+
+
+class H5DaqAccess:
+    """ Reader of the raw FLASH DAQ files, with the interface of PAH's BeamtimeDaqAccess.
+
+    The files are read directly with h5py: the location of each macrobunch is
+    taken from the cached segment index (see ``fileSegments``), and the values
+    of all the files are read into a single preallocated array, aligned to the
+    macrobunch IDs.
+    """
+
+    def __init__(self, rootDirectoryOfH5Files):
+        self.rootDirectoryOfH5Files = rootDirectoryOfH5Files
+        self._files = {}
+
+    @staticmethod
+    def create(rootDirectoryOfH5Files):
+        """ Creates a H5DaqAccess object for the given root directory, as
+        ``BeamtimeDaqAccess.create``.
+
+        :Parameters:
+            rootDirectoryOfH5Files : str
+                the root directory of the HDF files, searched recursively.
+
+        :Return:
+            daqAccess : H5DaqAccess
+                the ready to use DAQ access object.
+
+        :Raise:
+            AssertionError if the given rootDirectoryOfH5Files does not exist.
+        """
+        assert os.path.isdir(rootDirectoryOfH5Files), \
+            'Root directory of the HDF5 files not found: {}'.format(rootDirectoryOfH5Files)
+        return H5DaqAccess(rootDirectoryOfH5Files)
+
+    def runFiles(self, runNumber=None):
+        """ Files of a run, or all the files if runNumber is None, see ``runFiles``."""
+        if runNumber not in self._files:
+            self._files[runNumber] = runFiles(self.rootDirectoryOfH5Files, runNumber)
+        return self._files[runNumber]
+
+    def allChannelNames(self, runNumber=None):
+        """ DAQ addresses of the channels in the first file of a run."""
+        return list(fileMetadata(self.runFiles(runNumber)[0]))
+
+    def availablePulseIdInterval(self, runNumber):
+        """ Macrobunch ID interval of a run, as (first, last + 1).
+
+        As in PAH, the interval spans the first channel stored in each file."""
+        pulseIdInterval = runMetadata(self.runFiles(runNumber))['pulseIdInterval']
+        if pulseIdInterval is None:
+            raise KeyError('No DAQ data in the files of run {}'.format(runNumber))
+        return pulseIdInterval
+
+    def filesOfInterval(self, pulseIdInterval):
+        """ Files of the root directory with data in a macrobunch ID interval.
+
+        The files are selected from the macrobunch ID interval of their channels,
+        cached with the segment index (see ``fileMetadata``), so that only the
+        files of the interval are opened to locate and read a channel."""
+        files = []
+        for fileName in self.runFiles():
+            for channel in fileMetadata(fileName).values():
+                interval = channel['pulseIdInterval']
+                if interval is not None and interval[0] < pulseIdInterval[1] and interval[1] > pulseIdInterval[0]:
+                    files.append(fileName)
+                    break
+        return files
+
+    def isChannelAvailable(self, channelName, pulseIdInterval):
+        """ True if the channel has data in the given macrobunch ID interval."""
+        try:
+            segments, numOfColumns = channelSegments(self.filesOfInterval(pulseIdInterval), channelName)
+        except KeyError:
+            return False
+        return any(s[0] < pulseIdInterval[1] and s[1] > pulseIdInterval[0] for s in segments)
+
+    def allValuesOfRun(self, channelName, runNumber):
+        """ Values of a channel for a whole run.
+
+        :Parameters:
+            channelName : str
+                DAQ address of the channel.
+            runNumber : int
+                number of the run.
+
+        :Return:
+            values : numpy array
+                (macrobunch, value) array of float64, aligned to the macrobunch IDs.
+            pulseIdInterval : (int, int)
+                macrobunch ID interval of the run, as (first, last + 1).
+        """
+        pulseIdInterval = self.availablePulseIdInterval(runNumber)
+        return valuesOfInterval(self.runFiles(runNumber), channelName, pulseIdInterval), pulseIdInterval
+
+    def valuesOfInterval(self, channelName, pulseIdInterval):
+        """ Values of a channel for a macrobunch ID interval, from the files of
+        the root directory containing it, see ``filesOfInterval`` and ``valuesOfInterval``."""
+        # without any file in the interval, the channel is still located in all
+        # the files, for the number of values of the NaN filled array
+        files = self.filesOfInterval(pulseIdInterval) or self.runFiles()
+        return valuesOfInterval(files, channelName, pulseIdInterval)
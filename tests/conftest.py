@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+""" Fixtures of the tests: a synthetic run, written once per session with
+``utilities.synthetic``, and processors reading it.
+
+The processor reads the [DAQ channels] of SETTINGS.ini, which is created by
+InitializeSettings.py. The synthetic run is written with the same channels."""
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if not os.path.isfile(os.path.join(ROOT, 'SETTINGS.ini')):
+    pytest.skip('SETTINGS.ini not found, run InitializeSettings.py first', allow_module_level=True)
+
+from processor import DldFlashDataframeCreator
+from processor import h5daq
+from utilities import misc, synthetic
+
+RUN_NUMBER = 7
+NUM_OF_MACROBUNCHES = 600
+MACROBUNCHES_PER_FILE = 200
+# time of flight step of the synthetic peaks, see utilities.synthetic.DEFAULT_PEAKS
+TOF_STEP_TO_NS = 0.006858710665255785
+
+
+def daqChannels():
+    """ DAQ addresses of the channels read by the processor."""
+    return misc.parse_category('DAQ channels') or synthetic.DEFAULT_CHANNELS
+
+
+def writeRun(rootpath, num_of_macrobunches=NUM_OF_MACROBUNCHES, runNumber=RUN_NUMBER, **kwargs):
+    """ Write the synthetic run of the tests, with the channels of SETTINGS.ini."""
+    ubidOffset = misc.parse_setting('processor', 'ubid_offset')
+    return synthetic.generate_run(rootpath, runNumber, num_of_macrobunches=num_of_macrobunches,
+                                  electrons_per_macrobunch=20, macrobunches_per_file=MACROBUNCHES_PER_FILE,
+                                  channels=daqChannels(), ubid_offset=5 if ubidOffset is None else ubidOffset,
+                                  **kwargs)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def segmentCacheDir(tmp_path_factory):
+    """ Keep the json cache of h5daq out of the home folder."""
+    cacheDir = h5daq.SEGMENT_CACHE_DIR
+    h5daq.SEGMENT_CACHE_DIR = str(tmp_path_factory.mktemp('segments'))
+    yield h5daq.SEGMENT_CACHE_DIR
+    h5daq.SEGMENT_CACHE_DIR = cacheDir
+
+
+@pytest.fixture(scope='session')
+def rawPath(tmp_path_factory):
+    """ Folder of the synthetic run RUN_NUMBER."""
+    path = str(tmp_path_factory.mktemp('raw'))
+    writeRun(path)
+    return path
+
+
+def newProcessor(rawPath, parquetPath):
+    """ Processor reading the synthetic run from rawPath, and storing in parquetPath."""
+    processor = DldFlashDataframeCreator.DldFlashProcessor()
+    processor.DATA_RAW_DIR = rawPath
+    processor.DATA_PARQUET_DIR = str(parquetPath) + os.sep
+    processor.CHUNK_SIZE = 100000
+    processor.N_CORES = 1
+    processor.TOF_STEP_TO_NS = TOF_STEP_TO_NS
+    return processor
+
+
+@pytest.fixture
+def processor(rawPath, tmp_path):
+    """ A new processor of the synthetic run, storing in a temporary folder."""
+    return newProcessor(rawPath, tmp_path)
+
+
+@pytest.fixture(scope='session')
+def readProcessor(rawPath, tmp_path_factory):
+    """ A processor which read the synthetic run, shared by the tests which do not modify it."""
+    processor = newProcessor(rawPath, tmp_path_factory.mktemp('parquet'))
+    processor.readData(RUN_NUMBER, path=rawPath)
+    return processor
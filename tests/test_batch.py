@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+""" The batch conversion of runs, with the skipping of converted runs and resuming."""
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from conftest import newProcessor, writeRun
+from processor import DldFlashDataframeCreator
+from utilities import batch, runindex
+
+pytestmark = pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                                reason='the workers inherit the test settings when forked')
+
+CONVERTED, NEW, BROKEN = 7, 8, 9
+
+
+@pytest.fixture
+def batchPaths(tmp_path, monkeypatch):
+    """ Raw folder with two synthetic runs, CONVERTED and NEW, and a run with a
+    broken file, BROKEN, and the parquet folder where CONVERTED is already converted."""
+    rawPath = str(tmp_path / 'raw')
+    parquetPath = str(tmp_path / 'parquet') + os.sep
+    for run in (CONVERTED, NEW):
+        writeRun(rawPath, num_of_macrobunches=200, runNumber=run)
+    with open(os.path.join(rawPath, 'fl1user2', 'FLASH1_USER2_stream_2_run{}_file1_20190101T000000.1.h5'.format(
+            BROKEN)), 'wb') as f:
+        f.write(b'not an HDF5 file')
+
+    configured = newProcessor(rawPath, parquetPath[:-1])
+
+    class BatchProcessor(DldFlashDataframeCreator.DldFlashProcessor):
+        """ Processor with the settings of the tests, also in the workers."""
+
+        def __init__(self):
+            super().__init__()
+            for name in ('DATA_RAW_DIR', 'DATA_PARQUET_DIR', 'CHUNK_SIZE', 'N_CORES', 'TOF_STEP_TO_NS'):
+                setattr(self, name, getattr(configured, name))
+
+    monkeypatch.setattr(batch.DldFlashProcessor, 'DldFlashProcessor', BatchProcessor)
+    indexFile = str(tmp_path / 'run_index.json')
+    monkeypatch.setattr(runindex, 'default_index_file', lambda rootpath: indexFile)
+
+    processor = BatchProcessor()
+    processor.readData(CONVERTED)
+    processor.storeDataframes()
+    return rawPath, parquetPath, str(tmp_path / 'state.json')
+
+
+def loadState(stateFile):
+    with open(stateFile, 'r') as f:
+        return json.load(f)['runs']
+
+
+def outputTimes(run, parquetPath):
+    return [os.stat(output).st_mtime_ns for output in batch.run_outputs(run, parquetPath)]
+
+
+def test_convert_runs(batchPaths):
+    rawPath, parquetPath, stateFile = batchPaths
+    converted = outputTimes(CONVERTED, parquetPath)
+    fails = batch.convert_runs([CONVERTED, NEW, BROKEN], n_workers=2, state_file=stateFile)
+
+    # the run already converted is skipped, the failed worker is reported
+    assert list(fails) == [BROKEN]
+    assert outputTimes(CONVERTED, parquetPath) == converted
+    state = loadState(stateFile)
+    assert 'run{}'.format(CONVERTED) not in state
+    assert state['run{}'.format(NEW)]['status'] == 'done'
+    assert state['run{}'.format(BROKEN)]['status'] == 'failed'
+    checker = batch.DldFlashProcessor.DldFlashProcessor()
+    assert batch.is_run_converted(NEW, parquetPath, checker)
+    assert not batch.is_run_converted(BROKEN, parquetPath, checker)
+
+
+def test_resume_interrupted_batch(batchPaths):
+    rawPath, parquetPath, stateFile = batchPaths
+    # NEW was being converted when the batch was interrupted, leaving a partial output
+    with open(stateFile, 'w') as f:
+        json.dump({'runs': {'run{}'.format(NEW): {'status': 'running'}}}, f)
+    os.makedirs(batch.run_outputs(NEW, parquetPath)[0])
+    with open(os.path.join(batch.run_outputs(NEW, parquetPath)[0], 'part.0.parquet'), 'w') as f:
+        f.write('partial')
+    converted = outputTimes(CONVERTED, parquetPath)
+
+    assert batch.convert_runs([CONVERTED, NEW], n_workers=1, state_file=stateFile) == {}
+    assert outputTimes(CONVERTED, parquetPath) == converted
+    assert loadState(stateFile)['run{}'.format(NEW)]['status'] == 'done'
+    reader = batch.DldFlashProcessor.DldFlashProcessor()
+    reader.readDataframes('run{}'.format(NEW))
+    assert len(reader.dd) > 0
+
+
+def test_run_without_manifest_is_not_converted(batchPaths, capsys):
+    rawPath, parquetPath, stateFile = batchPaths
+    checker = batch.DldFlashProcessor.DldFlashProcessor()
+    assert batch.is_run_converted(CONVERTED, parquetPath, checker)
+    os.remove(parquetPath + 'run{}_manifest.json'.format(CONVERTED))
+    assert not batch.is_run_converted(CONVERTED, parquetPath, checker)
+    assert 'WARNING: run {} has no conversion manifest'.format(CONVERTED) in capsys.readouterr().out
+    # without a processor, only the dataframes are checked
+    assert batch.is_run_converted(CONVERTED, parquetPath)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+""" The binning engines against np.histogramdd, and the binning of the processor."""
+import dask
+import dask.dataframe
+import numpy as np
+import pytest
+
+from processor import binning
+
+ENGINES = ['numpy', pytest.param('numba', marks=pytest.mark.skipif(not binning.NUMBA_AVAILABLE,
+                                                                    reason='numba is not installed'))]
+
+
+def makeColumns(numOfEvents=20000, seed=0):
+    rng = np.random.RandomState(seed)
+    columns = [rng.normal(0, 1, numOfEvents), rng.uniform(-1, 11, numOfEvents).astype(np.float32)]
+    columns[0][::97] = np.nan
+    # values on the edges, including the last one
+    columns[1][:11] = np.arange(11)
+    return columns
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_histogram_uniform(engine):
+    columns = makeColumns()
+    edges = [np.linspace(-3, 3, 61), np.linspace(0, 10, 11)]
+    assert binning.uniformAxis(edges[0]) is not None
+    expected, _ = np.histogramdd(np.stack([c.astype(np.float64) for c in columns], axis=1), bins=edges)
+    assert np.array_equal(binning.histogram(columns, edges, engine), expected)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_histogram_nonuniform(engine):
+    columns = makeColumns(seed=1)
+    edges = [np.array([-3., -1., -0.5, 0., 0.1, 2.]), np.geomspace(0.5, 10, 8)]
+    assert binning.uniformAxis(edges[0]) is None
+    expected, _ = np.histogramdd(np.stack([c.astype(np.float64) for c in columns], axis=1), bins=edges)
+    assert np.array_equal(binning.histogram(columns, edges, engine), expected)
+
+
+def test_uniform_axis_rejects_infinite_edges():
+    assert binning.uniformAxis(np.array([-np.inf, 0., np.inf])) is None
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_histogram_moments(engine):
+    columns = makeColumns(seed=2)
+    edges = [np.linspace(-3, 3, 7), np.linspace(0, 10, 3)]
+    weights = np.random.RandomState(3).normal(5, 2, len(columns[0]))
+    weights[::13] = np.nan
+    moments = binning.histogramMoments(columns, edges, {'w': weights}, engine)
+    assert np.array_equal(moments['counts'], binning.histogram(columns, edges, 'numpy'))
+
+    indices = [np.digitize(c, e) - 1 for c, e in zip(columns, edges)]
+    for i in range(len(edges[0]) - 1):
+        for j in range(len(edges[1]) - 1):
+            selected = (indices[0] == i) & ((indices[1] == j) | ((j == 1) & (columns[1] == 10)))
+            values = weights[selected & ~np.isnan(weights)]
+            assert moments[('w', 'count')][i, j] == len(values)
+            assert moments[('w', 'sum')][i, j] == pytest.approx(values.sum())
+            assert moments[('w', 'sumSquares')][i, j] == pytest.approx((values ** 2).sum())
+            assert moments[('w', 'min')][i, j] == (values.min() if len(values) else np.inf)
+            assert moments[('w', 'max')][i, j] == (values.max() if len(values) else -np.inf)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_tree_sum_of_partitions(engine):
+    columns = makeColumns(seed=4)
+    edges = [np.linspace(-3, 3, 13), np.linspace(0, 10, 5)]
+    partials = [dask.delayed(binning.histogramMoments)([c[start:start + 1000] for c in columns], edges,
+                                                       {'w': columns[0][start:start + 1000]}, engine)
+                for start in range(0, len(columns[0]), 1000)]
+    total, = dask.compute(binning.treeSum(partials, splitEvery=3), scheduler='sync')
+    whole = binning.histogramMoments(columns, edges, {'w': columns[0]}, engine)
+    for key, values in whole.items():
+        np.testing.assert_allclose(total[key], values)
+
+
+def test_computeBinnedData_matches_histogramdd(readProcessor):
+    processor = readProcessor
+    processor.resetBins()
+    processor.addBinning('dldTime', 620, 670, 1)
+    processor.addBinning('dldPosX', 0, 1500, 100)
+    result = processor.computeBinnedData()
+    electrons = processor.dd[['dldTime', 'dldPosX']].compute()
+    expected, _ = np.histogramdd(electrons.values.astype(np.float64), bins=processor.binRangeList)
+    assert np.array_equal(result, expected)
+
+
+def test_computeHistograms_matches_computeBinnedData(readProcessor):
+    processor = readProcessor
+    processor.resetBins()
+    processor.addBinning('dldTime', 620, 670, 2)
+    expected = [processor.computeBinnedData()]
+    processor.resetBins()
+    processor.addBinning('dldPosX', 0, 1500, 100)
+    processor.addBinning('dldPosY', 0, 1500, 100)
+    expected.append(processor.computeBinnedData())
+    histograms = processor.computeHistograms({'time': [('dldTime', 620, 670, 2)],
+                                              'position': [('dldPosX', 0, 1500, 100), ('dldPosY', 0, 1500, 100)]},
+                                             asNumpy=True)
+    assert np.array_equal(histograms['time'], expected[0])
+    assert np.array_equal(histograms['position'], expected[1])
+    # the scheduled bins are not changed
+    assert processor.binNameList == ['dldPosX', 'dldPosY']
+
+
+def test_weighted_histograms_match_histogramdd(readProcessor):
+    processor = readProcessor
+    electrons = processor.dd[['dldTime', 'dldPosX', 'gmdBda', 'bam']].compute().reset_index(drop=True)
+    # NaN weights are not counted
+    electrons.loc[::7, 'gmdBda'] = np.nan
+    bins = [('dldTime', 620, 670, 2), ('dldPosX', 0, 1500, 100)]
+    dd = processor.dd
+    try:
+        processor.dd = dask.dataframe.from_pandas(electrons, npartitions=3)
+        arrays = processor.computeHistograms({'weighted': bins}, weights=['gmdBda', 'bam'], asNumpy=True)
+    finally:
+        processor.dd = dd
+    arrays = arrays['weighted']
+
+    edges = [processor.genBins(*binSpec[1:]) for binSpec in bins]
+    sample = electrons[['dldTime', 'dldPosX']].values.astype(np.float64)
+    counts, _ = np.histogramdd(sample, bins=edges)
+    assert np.array_equal(arrays['counts'], counts)
+    for weight in ['gmdBda', 'bam']:
+        values = electrons[weight].values.astype(np.float64)
+        valid = ~np.isnan(values)
+        for moment, weights in [('count', valid), ('sum', np.where(valid, values, 0.)),
+                                ('sumSquares', np.where(valid, values ** 2, 0.))]:
+            expected, _ = np.histogramdd(sample, bins=edges, weights=weights)
+            np.testing.assert_allclose(arrays['{}_{}'.format(weight, moment)], expected)
+        filled = arrays['{}_count'.format(weight)] > 0
+        assert np.isnan(arrays['{}_min'.format(weight)][~filled]).all()
+        assert (arrays['{}_min'.format(weight)][filled] <= arrays['{}_max'.format(weight)][filled]).all()
+    assert (arrays['gmdBda_count'] < counts).any()
+    assert np.array_equal(arrays['bam_count'], counts)
+
+
+def test_make_GMD_histogram_nearest_value(readProcessor):
+    """ The GMD sums go to the nearest axis value, the lower one when halfway."""
+    processor = readProcessor
+    electrons = processor.dd[['delayStage', 'gmdBda']].compute()
+    axis = np.round(np.linspace(electrons['delayStage'].min(), electrons['delayStage'].max(), 7), 3)
+    expected = np.zeros(len(axis))
+    gmd = np.nan_to_num(electrons['gmdBda'].values.astype(np.float64))
+    for value, delay in zip(gmd, electrons['delayStage'].values):
+        if value > 0:
+            expected[np.argmin(np.abs(axis - delay))] += value
+    np.testing.assert_allclose(processor.make_GMD_histogram('delayStage', axis), expected)
+    # in the order of the axis values, if they are not increasing
+    np.testing.assert_allclose(processor.make_GMD_histogram('delayStage', axis[::-1]), expected[::-1])
+    shuffled = np.random.RandomState(0).permutation(len(axis))
+    np.testing.assert_allclose(processor.make_GMD_histogram('delayStage', axis[shuffled]), expected[shuffled])
+
+    ties = dask.dataframe.from_pandas(electrons.iloc[:4].assign(delayStage=[0.5, 1.5, 0.5, 2.], gmdBda=1.),
+                                      npartitions=1)
+    dd = processor.dd
+    try:
+        processor.dd = ties
+        assert np.array_equal(processor.make_GMD_histogram('delayStage', np.array([0., 1., 2.])), [2., 1., 1.])
+        assert np.array_equal(processor.make_GMD_histogram('delayStage', np.array([2., 1., 0.])), [1., 1., 2.])
+    finally:
+        processor.dd = dd
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+""" The memory mapped column store of the dataframes."""
+import mmap
+import os
+
+import dask.dataframe
+import numpy as np
+import pandas as pd
+
+from conftest import RUN_NUMBER, newProcessor
+from processor import columnstore
+
+
+def test_round_trip(readProcessor, tmp_path):
+    readProcessor.storeDataframes(path=str(tmp_path) + os.sep, format='npy')
+    reader = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    reader.readDataframes('run{}'.format(RUN_NUMBER), format='npy')
+    for stored, read in [(readProcessor.dd, reader.dd), (readProcessor.ddMicrobunches, reader.ddMicrobunches)]:
+        stored, read = stored.compute().reset_index(drop=True), read.compute().reset_index(drop=True)
+        assert read.dtypes.equals(stored.dtypes)
+        assert read.equals(stored)
+
+
+def test_incomplete_partition_is_skipped(readProcessor, tmp_path):
+    readProcessor.storeDataframes(path=str(tmp_path) + os.sep, format='npy')
+    # a partition interrupted while being written, before its columns file
+    partition = os.path.join(str(tmp_path), 'run{}_el_npy'.format(RUN_NUMBER), 'part.99999')
+    os.makedirs(partition)
+    np.save(os.path.join(partition, '_index.npy'), np.arange(10))
+    reader = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    reader.readDataframes('run{}'.format(RUN_NUMBER), format='npy', columns=['dldTime'])
+    assert len(reader.dd) == len(readProcessor.dd)
+
+
+def test_partitions_are_not_copied(tmp_path):
+    partition = str(tmp_path / 'part.00000')
+    columnstore.writePartition(pd.DataFrame({'a': np.arange(5.), 'b': np.arange(5.), 'c': np.arange(5)}), partition)
+    part = columnstore.readPartition(partition)
+    for col in part.columns:
+        values = part[col].values
+        while not isinstance(values, mmap.mmap):
+            values = values.base
+    assert part.equals(pd.DataFrame({'a': np.arange(5.), 'b': np.arange(5.), 'c': np.arange(5)}))
+
+
+def test_append_after_interrupted_write(tmp_path):
+    path = str(tmp_path / 'store')
+    frame = pd.DataFrame({'a': np.arange(30.)})
+    first = dask.dataframe.from_pandas(frame, npartitions=3)
+    assert columnstore.storeDataframe(first, path) == 30
+    # a partition appended later, and one left incomplete by an interrupted write
+    columnstore.writePartition(frame.iloc[:5], os.path.join(path, 'part.00003'))
+    os.makedirs(os.path.join(path, 'part.00004'))
+    np.save(os.path.join(path, 'part.00004', 'a.npy'), np.arange(3.))
+
+    assert columnstore.storeDataframe(first, path, append=True) == 30
+    names = sorted(os.listdir(path))
+    assert names == ['part.{:05d}'.format(i) for i in [0, 1, 2, 3, 4, 5, 6]]
+    stored, partitions = columnstore.readDataframe(path)
+    assert len(partitions) == 7
+    assert np.array_equal(stored['a'].compute().values,
+                          np.concatenate([frame['a'].values, frame['a'].values[:5], frame['a'].values]))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+""" The h5py reader of the DAQ files, against PAH's BeamtimeDaqAccess."""
+import os
+
+import numpy as np
+import pytest
+
+from conftest import NUM_OF_MACROBUNCHES, RUN_NUMBER, daqChannels
+from processor import h5daq
+
+try:
+    from processor import pah
+except (ImportError, KeyError):
+    pah = None
+
+requiresPah = pytest.mark.skipif(pah is None, reason='PAH is not installed (PAH_MODULE_DIR in SETTINGS.ini)')
+
+FIRST_PULSE_ID = 100000000
+
+
+@pytest.fixture
+def daqAccess(rawPath):
+    return h5daq.H5DaqAccess.create(rawPath)
+
+
+def test_interval_convention(daqAccess):
+    """ Run intervals are (first, last + 1), and row i holds macrobunch first + i,
+    as consumed through otherStuff[-1] by readData."""
+    channel = daqChannels()['macro_bunch_pulse_id']
+    assert daqAccess.availablePulseIdInterval(RUN_NUMBER) == (FIRST_PULSE_ID, FIRST_PULSE_ID + NUM_OF_MACROBUNCHES)
+    values, otherStuff = daqAccess.allValuesOfRun(channel, RUN_NUMBER)
+    assert otherStuff[-1] - otherStuff[0] == len(values) == NUM_OF_MACROBUNCHES
+    assert np.array_equal(values[:, 0], np.arange(otherStuff[0], otherStuff[-1]))
+
+
+def test_files_of_interval(daqAccess):
+    files = daqAccess.runFiles(RUN_NUMBER)
+    assert daqAccess.filesOfInterval((FIRST_PULSE_ID + 10, FIRST_PULSE_ID + 20)) == files[:1]
+    assert daqAccess.filesOfInterval((FIRST_PULSE_ID + 190, FIRST_PULSE_ID + 210)) == files[:2]
+    assert daqAccess.filesOfInterval((0, 10)) == []
+
+    channel = daqChannels()['dld_time']
+    assert daqAccess.isChannelAvailable(channel, (FIRST_PULSE_ID + 450, FIRST_PULSE_ID + 460))
+    assert not daqAccess.isChannelAvailable(channel, (0, 10))
+    assert not daqAccess.isChannelAvailable('/no/such/channel', (FIRST_PULSE_ID, FIRST_PULSE_ID + 10))
+    # outside the run, all NaN
+    assert np.isnan(daqAccess.valuesOfInterval(channel, (0, 10))).all()
+
+
+@requiresPah
+def test_matches_pah(rawPath, daqAccess):
+    pahAccess = pah.BeamtimeDaqAccess.create(rawPath)
+    fileAccess = pah.H5FileDataAccess(pah.H5FileManager(rawPath))
+    assert tuple(daqAccess.availablePulseIdInterval(RUN_NUMBER)) == \
+        tuple(fileAccess.availablePulseIdInterval(RUN_NUMBER))
+
+    interval = (FIRST_PULSE_ID + 150, FIRST_PULSE_ID + 450)
+    for name in ['dld_time', 'dld_microbunch_id', 'delay_stage', 'bam', 'macro_bunch_pulse_id']:
+        channel = daqChannels()[name]
+        values, otherStuff = daqAccess.allValuesOfRun(channel, RUN_NUMBER)
+        pahValues, pahOtherStuff = pahAccess.allValuesOfRun(channel, RUN_NUMBER)
+        assert (otherStuff[0], otherStuff[-1]) == (pahOtherStuff[0], pahOtherStuff[-1])
+        np.testing.assert_array_equal(values, pahValues)
+        np.testing.assert_array_equal(daqAccess.valuesOfInterval(channel, interval),
+                                      pahAccess.valuesOfInterval(channel, interval))
+        assert daqAccess.isChannelAvailable(channel, interval) == pahAccess.isChannelAvailable(channel, interval)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+""" Incremental conversion of a run which is still being recorded."""
+import json
+import os
+
+import pytest
+
+from conftest import RUN_NUMBER, newProcessor, writeRun
+from processor import DldFlashDataframeCreator
+
+
+@pytest.fixture
+def growingRun(tmp_path):
+    """ Raw folder with the first 400 macrobunches of the run, which grows with ``growRun``.
+    The delay stage does not move, as the scan steps depend on the length of the run."""
+    rawPath = str(tmp_path / 'raw')
+    writeRun(rawPath, num_of_macrobunches=400, delay_steps=1)
+    return rawPath
+
+
+def growRun(rawPath):
+    """ Write the same macrobunches again, and 200 more."""
+    writeRun(rawPath, delay_steps=1)
+
+
+def storedElectrons(processor):
+    reader = newProcessor(processor.DATA_RAW_DIR, processor.DATA_PARQUET_DIR)
+    reader.readDataframes('run{}'.format(RUN_NUMBER))
+    return reader.dd.compute().sort_values(['macroBunchPulseId', 'dldTime']).reset_index(drop=True)
+
+
+def test_appended_run_matches_full_conversion(growingRun, tmp_path):
+    processor = newProcessor(growingRun, tmp_path)
+    first = processor.updateDataframes(RUN_NUMBER, holdBack=10)
+    assert first[1] - first[0] == 390
+    assert processor.updateDataframes(RUN_NUMBER, holdBack=10) is None
+
+    growRun(growingRun)
+    second = processor.updateDataframes(RUN_NUMBER, holdBack=10)
+    assert second == (first[1], first[1] + 200)
+
+    full = newProcessor(growingRun, tmp_path)
+    full.readData(RUN_NUMBER, path=growingRun)
+    expected = full.dd.compute()
+    expected = expected[expected['macroBunchPulseId'] < second[1] - first[0]]
+    expected = expected.sort_values(['macroBunchPulseId', 'dldTime']).reset_index(drop=True)
+    assert storedElectrons(processor).equals(expected)
+
+    # the raw files grow by design, they are not reported as changed
+    processor.rawDataPath = growingRun
+    assert processor.checkManifest(RUN_NUMBER) == []
+
+
+def test_interrupted_update_is_not_appended_twice(growingRun, tmp_path, monkeypatch):
+    processor = newProcessor(growingRun, tmp_path)
+    processor.updateDataframes(RUN_NUMBER, holdBack=10)
+    growRun(growingRun)
+    rows = len(storedElectrons(processor))
+
+    # interrupted after appending, before recording it in the state file
+    writeState = DldFlashDataframeCreator._writeState
+    calls = []
+
+    def interruptedWriteState(stateFile, state):
+        calls.append(state)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        writeState(stateFile, state)
+
+    monkeypatch.setattr(DldFlashDataframeCreator, '_writeState', interruptedWriteState)
+    with pytest.raises(KeyboardInterrupt):
+        processor.updateDataframes(RUN_NUMBER, holdBack=10)
+    monkeypatch.setattr(DldFlashDataframeCreator, '_writeState', writeState)
+    appended = len(storedElectrons(processor))
+    assert appended > rows
+
+    assert processor.updateDataframes(RUN_NUMBER, holdBack=10) is None
+    assert len(storedElectrons(processor)) == appended
+    with open(os.path.join(str(tmp_path), 'run{}_incremental.json'.format(RUN_NUMBER)), 'r') as f:
+        state = json.load(f)
+    assert state['appending'] is None
+    assert state['lastPulseId'] == calls[0]['appending'][1]
+    assert state['lastPulseId'] - state['firstPulseId'] == 590
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+""" The conversion manifests written next to the stored dataframes."""
+import json
+import os
+
+import numpy as np
+
+from conftest import RUN_NUMBER, newProcessor
+
+
+def test_manifest_up_to_date(readProcessor, tmp_path):
+    path = str(tmp_path) + os.sep
+    readProcessor.storeDataframes(path=path)
+    with open(path + 'run{}_manifest.json'.format(RUN_NUMBER), 'r') as f:
+        manifest = json.load(f)
+    assert manifest['runNumber'] == RUN_NUMBER
+    assert len(manifest['rawFiles']) == 3
+    assert manifest['rows'] == {'el': len(readProcessor.dd), 'mb': len(readProcessor.ddMicrobunches)}
+
+    checker = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    checker.rawDataPath = readProcessor.DATA_RAW_DIR
+    assert checker.checkManifest(RUN_NUMBER) == []
+    checker.UBID_OFFSET += 1
+    assert checker.checkManifest(RUN_NUMBER) == ['UBID_OFFSET']
+    assert checker.checkManifest(RUN_NUMBER + 1) == ['no stored dataframes']
+
+
+def test_manifest_without_raw_run(readProcessor, tmp_path):
+    """ Dataframes which can not be traced back to a raw run are stored without raw files."""
+    path = str(tmp_path) + os.sep
+    runNumber = readProcessor.runNumber
+    try:
+        readProcessor.runNumber = 0  # as the dataframes created in memory by the benchmarks
+        readProcessor.storeDataframes('copy', path=path)
+    finally:
+        readProcessor.runNumber = runNumber
+    with open(path + 'copy_manifest.json', 'r') as f:
+        manifest = json.load(f)
+    assert manifest['rawFiles'] is None
+    assert manifest['rows']['el'] == len(readProcessor.dd)
+
+
+def test_missing_raw_files_and_interrupted_conversion(readProcessor, tmp_path):
+    path = str(tmp_path) + os.sep
+    readProcessor.storeDataframes(path=path)
+    checker = newProcessor(str(tmp_path / 'moved'), tmp_path)
+    assert checker.checkManifest(RUN_NUMBER) == ['raw files not found']
+    assert checker.conversionInputs(RUN_NUMBER)['rawFiles'] is None
+
+    # the manifest is completed after the data, an interrupted conversion has no rows
+    manifestFile = path + 'run{}_manifest.json'.format(RUN_NUMBER)
+    with open(manifestFile, 'r') as f:
+        manifest = json.load(f)
+    manifest['rows'] = None
+    with open(manifestFile, 'w') as f:
+        json.dump(manifest, f)
+    checker.rawDataPath = readProcessor.DATA_RAW_DIR
+    assert checker.checkManifest(RUN_NUMBER) == ['incomplete conversion']
+
+
+def test_stored_rows_of_column_store(readProcessor, tmp_path):
+    path = str(tmp_path) + os.sep
+    readProcessor.storeDataframes(path=path, format='npy')
+    checker = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    checker.rawDataPath = readProcessor.DATA_RAW_DIR
+    assert checker.checkManifest(RUN_NUMBER, format='npy') == []
+    # a partition interrupted while being written is not counted
+    partition = os.path.join(path + 'run{}_el_npy'.format(RUN_NUMBER), 'part.99999')
+    os.makedirs(partition)
+    np.save(os.path.join(partition, '_index.npy'), np.arange(10))
+    assert checker.checkManifest(RUN_NUMBER, format='npy') == []
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+""" The vectorized gather of the microbunch channels and the compact electron storage."""
+import numpy as np
+
+import processor.cscripts.DldFlashProcessorNotCy as DldFlashProcessorNotCy
+import processor.cscripts.DldFlashProcessorVectorized as DldFlashProcessorVectorized
+
+
+def makeArrays(numOfMacrobunches=40, numOfElectrons=30, numOfMicrobunches=50, seed=0):
+    """ Microbunch IDs with NaN padding, negative and out of range IDs, and values with NaNs."""
+    rng = np.random.RandomState(seed)
+    microbunchIds = np.floor(rng.uniform(-5, numOfMicrobunches + 5, (numOfMacrobunches, numOfElectrons)))
+    hits = rng.randint(0, numOfElectrons, numOfMacrobunches)
+    microbunchIds[np.arange(numOfElectrons)[None, :] >= hits[:, None]] = np.nan
+    toConvert = rng.normal(0, 1, (numOfMacrobunches, numOfMicrobunches))
+    toConvert[rng.uniform(size=toConvert.shape) < 0.05] = np.nan
+    return microbunchIds, toConvert
+
+
+def test_vectorized_gather_matches_loop():
+    microbunchIds, toConvert = makeArrays()
+    expected = DldFlashProcessorNotCy.assignToMircobunch(microbunchIds, toConvert)
+    result = DldFlashProcessorVectorized.assignToMircobunch(microbunchIds, toConvert)
+    # bitwise, so that NaNs are compared too
+    assert np.array_equal(result.view(np.uint64), expected.view(np.uint64))
+
+
+def test_vectorized_gather_without_valid_ids():
+    microbunchIds = np.full((3, 4), np.nan)
+    result = DldFlashProcessorVectorized.assignToMircobunch(microbunchIds, np.ones((3, 5)))
+    assert result.shape == (3, 4) and np.isnan(result).all()
+
+
+def test_compact_gather_matches_padded():
+    microbunchIds, toConvert = makeArrays(seed=1)
+    valid = microbunchIds > -1
+    macrobunchIndex = np.nonzero(valid)[0]
+    result = DldFlashProcessorVectorized.assignCompactToMircobunch(macrobunchIndex, microbunchIds[valid], toConvert)
+    expected = DldFlashProcessorVectorized.assignToMircobunch(microbunchIds, toConvert)[valid]
+    assert np.array_equal(result.view(np.uint64), expected.view(np.uint64))
+
+
+def test_electron_dataframe_is_compact(readProcessor):
+    """ The dataframe holds the valid hits only, in macrobunch order, with the
+    microbunch channels gathered as from the NaN padded arrays."""
+    processor = readProcessor
+    electrons = processor.dd.compute()
+    valid = processor.dldMicrobunchId > -1
+    assert len(electrons) == np.count_nonzero(valid)
+    assert processor.electronOffsets[-1] == len(electrons)
+    assert np.array_equal(np.diff(processor.electronOffsets), valid.sum(axis=1))
+
+    dtype = electrons['dldPosX'].dtype
+    assert np.array_equal(electrons['dldPosX'].values, processor.dldPosX[valid].astype(dtype))
+    bam = DldFlashProcessorVectorized.assignToMircobunch(processor.dldMicrobunchId, processor.bam)[valid]
+    np.testing.assert_array_equal(electrons['bam'].values, bam.astype(electrons['bam'].dtype))
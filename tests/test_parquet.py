@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+""" Storing the dataframes as parquet: round trip, codecs, row groups, filter
+pushdown and column projection."""
+import os
+
+import numpy as np
+import pytest
+
+from conftest import RUN_NUMBER, newProcessor
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def partFiles(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.parquet'))
+
+
+def frames(processor):
+    return (processor.dd.compute().reset_index(drop=True),
+            processor.ddMicrobunches.compute().reset_index(drop=True))
+
+
+def test_round_trip(readProcessor, tmp_path):
+    readProcessor.storeDataframes(path=str(tmp_path) + os.sep)
+    reader = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    reader.runNumber = RUN_NUMBER
+    reader.readDataframes()
+    for stored, read in zip(frames(readProcessor), frames(reader)):
+        assert list(read.columns) == list(stored.columns)
+        assert read.dtypes.equals(stored.dtypes)
+        assert read.equals(stored)
+
+
+def test_codecs_and_row_groups(readProcessor, tmp_path):
+    codecs = (readProcessor.PARQUET_CODEC, readProcessor.PARQUET_INT_CODEC, readProcessor.PARQUET_ROW_GROUP_SIZE)
+    try:
+        readProcessor.PARQUET_CODEC = 'gzip'
+        readProcessor.PARQUET_INT_CODEC = 'zstd'
+        readProcessor.PARQUET_ROW_GROUP_SIZE = 1000
+        readProcessor.storeDataframes('codecs', path=str(tmp_path) + os.sep)
+    finally:
+        readProcessor.PARQUET_CODEC, readProcessor.PARQUET_INT_CODEC, readProcessor.PARQUET_ROW_GROUP_SIZE = codecs
+
+    metadata = pq.read_metadata(partFiles(str(tmp_path / 'codecs_el'))[0])
+    assert metadata.num_row_groups > 1
+    assert all(metadata.row_group(i).num_rows <= 1000 for i in range(metadata.num_row_groups))
+    rowGroup = metadata.row_group(0)
+    compression = {rowGroup.column(i).path_in_schema: rowGroup.column(i).compression
+                   for i in range(rowGroup.num_columns)}
+    assert compression['dldTime'] == 'GZIP'
+    assert compression['dldMicrobunchId'] == 'ZSTD'
+    assert rowGroup.column(0).statistics.has_min_max
+
+
+def test_filters_are_pushed_down(readProcessor, tmp_path):
+    readProcessor.PARQUET_ROW_GROUP_SIZE, rowGroupSize = 1000, readProcessor.PARQUET_ROW_GROUP_SIZE
+    try:
+        readProcessor.storeDataframes('sorted', path=str(tmp_path) + os.sep, sortBy=['delayStage'])
+    finally:
+        readProcessor.PARQUET_ROW_GROUP_SIZE = rowGroupSize
+    electrons = readProcessor.dd.compute()
+    delay = float(np.median(electrons['delayStage']))
+    filters = [('delayStage', '>', delay), ('dldMicrobunchId', '<', 400)]
+
+    reader = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    reader.readDataframes('sorted', filters=filters)
+    expected = electrons[(electrons['delayStage'] > delay) & (electrons['dldMicrobunchId'] < 400)]
+    result = reader.dd.compute()
+    assert len(result) == len(expected)
+    assert np.array_equal(np.sort(result['dldTime'].values), np.sort(expected['dldTime'].values))
+
+    # the row groups below the delay are skipped by the reader, from their statistics
+    skipped = total = 0
+    for fileName in partFiles(str(tmp_path / 'sorted_el')):
+        metadata = pq.read_metadata(fileName)
+        column = metadata.schema.names.index('delayStage')
+        for i in range(metadata.num_row_groups):
+            total += 1
+            skipped += metadata.row_group(i).column(column).statistics.max <= delay
+    assert 0 < skipped < total
+
+
+def test_list_shaped_filters(readProcessor, tmp_path):
+    """ Filters read from json or a configuration are lists instead of tuples."""
+    readProcessor.storeDataframes('lists', path=str(tmp_path) + os.sep)
+    electrons = readProcessor.dd.compute()
+    reader = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    reader.readDataframes('lists', filters=[['dldTime', '>', 640]])
+    assert len(reader.dd) == (electrons['dldTime'] > 640).sum()
+    reader.readDataframes('lists', filters=[[['dldTime', '>', 640]], [['dldMicrobunchId', '<', 100]]])
+    assert len(reader.dd) == ((electrons['dldTime'] > 640) | (electrons['dldMicrobunchId'] < 100)).sum()
+
+
+def test_column_projection(readProcessor, tmp_path):
+    readProcessor.storeDataframes('projection', path=str(tmp_path) + os.sep)
+    reader = newProcessor(readProcessor.DATA_RAW_DIR, tmp_path)
+    reader.readDataframes('projection', columns=['dldTime'], filters=[('dldMicrobunchId', '>', 100)])
+    assert set(reader.dd.columns) == {'dldTime', 'dldMicrobunchId'}
+    assert reader.dd['dldMicrobunchId'].min().compute() > 100
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+""" The modes of readData against the default, eager, dataframes."""
+import types
+
+import numpy as np
+import psutil
+
+from conftest import RUN_NUMBER, newProcessor
+
+
+def frame(dataframe, columns=None):
+    """ Computed dataframe, with a default index, and its columns in the given order."""
+    dataframe = dataframe.compute().reset_index(drop=True)
+    return dataframe if columns is None else dataframe[columns]
+
+
+def assertSameDataframes(processor, eager):
+    for dataframe, expected in [(processor.dd, eager.dd), (processor.ddMicrobunches, eager.ddMicrobunches)]:
+        expected = frame(expected)
+        result = frame(dataframe, list(expected.columns))
+        assert result.dtypes.equals(expected.dtypes)
+        assert result.equals(expected)
+
+
+def test_streaming(processor, readProcessor, rawPath):
+    processor.N_CORES = 4
+    processor.readData(RUN_NUMBER, path=rawPath, streaming=True)
+    assert processor.electronOffsets is None
+    assert processor.dd.npartitions == 4
+    assertSameDataframes(processor, readProcessor)
+
+
+def test_lazy(processor, readProcessor, rawPath):
+    processor.N_CORES = 4
+    processor.readData(RUN_NUMBER, path=rawPath, lazy=True)
+    assert not isinstance(processor.dldTime, np.ndarray)
+    assert processor.numOfElectrons == readProcessor.numOfElectrons
+    assert np.array_equal(processor.electronOffsets, readProcessor.electronOffsets)
+    assertSameDataframes(processor, readProcessor)
+
+
+def test_normalized(processor, readProcessor, rawPath):
+    processor.readData(RUN_NUMBER, path=rawPath, normalized=True)
+    columns = list(readProcessor.dd.columns)
+    assert set(processor.dd.columns) < set(columns)
+    assert {'macroBunchPulseId', 'dldMicrobunchId'} <= set(processor.dd.columns)
+    assert 'bam' in processor.microbunchTables and 'delayStage' in processor.microbunchTables
+
+    # the slow channels are joined from the microbunch tables
+    processor.joinColumns(columns)
+    expected = frame(readProcessor.dd)
+    result = frame(processor.dd, columns)
+    assert result.dtypes.equals(expected.dtypes)
+    assert result.equals(expected)
+
+    # the tables are built again when reading the stored dataframes
+    processor.readData(RUN_NUMBER, path=rawPath, normalized=True)
+    processor.storeDataframes(path=processor.DATA_PARQUET_DIR)
+    reader = newProcessor(rawPath, processor.DATA_PARQUET_DIR)
+    reader.readDataframes('run{}'.format(RUN_NUMBER))
+    reader.joinColumns(columns)
+    assert frame(reader.dd, columns).equals(expected)
+
+
+def availableMemory(monkeypatch, available, cpus):
+    """ Fix the memory and the CPUs seen by planPartitions."""
+    monkeypatch.setattr(psutil, 'virtual_memory', lambda: types.SimpleNamespace(available=available))
+    monkeypatch.setattr(psutil, 'cpu_count', lambda logical=True: cpus)
+
+
+def test_plan_partitions_for_a_memory_budget(processor, monkeypatch):
+    channelColumns = {'dldTime': 30, 'dldPosX': 30, 'bam': 500}
+    # 2 * 8 bytes for the values of the channels, and for the table of 10 electrons
+    bytesPerMacrobunch = 16 * (560 + 3 * 10)
+    processor.MEMORY_FRACTION = 0.5
+    availableMemory(monkeypatch, 2 * 250 * bytesPerMacrobunch, 4)
+    plan = processor.planPartitions(1000, channelColumns, electronsPerMacrobunch=10)
+    # 250 macrobunches fit in the budget, only for 2 workers of at least 100 macrobunches
+    assert plan == {'workers': 2, 'macrobunchesPerPartition': 125, 'rowsPerPartition': 1250,
+                    'bytesPerMacrobunch': bytesPerMacrobunch, 'memoryBudget': 250 * bytesPerMacrobunch}
+    assert processor.macrobunchRanges(1000) == [(i, i + 125) for i in range(0, 1000, 125)]
+
+    # a large budget is split between the CPUs
+    availableMemory(monkeypatch, 2 ** 40, 4)
+    plan = processor.planPartitions(1000, channelColumns, electronsPerMacrobunch=10)
+    assert (plan['workers'], plan['macrobunchesPerPartition']) == (4, 250)
+
+
+def test_auto_tune(processor, readProcessor, rawPath, monkeypatch):
+    processor.AUTO_TUNE = True
+    availableMemory(monkeypatch, 2 * 10 ** 8, 2)
+    processor.readData(RUN_NUMBER, path=rawPath)
+    plan = processor.partitionPlan
+    assert plan['macrobunchesPerPartition'] < 600
+    assert processor.dd.npartitions == int(np.ceil(readProcessor.numOfElectrons / plan['rowsPerPartition']))
+    assertSameDataframes(processor, readProcessor)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+""" The persistent index of the runs of a raw data tree."""
+import os
+
+import pytest
+
+from conftest import RUN_NUMBER, writeRun
+from utilities import runindex
+
+
+@pytest.fixture
+def indexed(tmp_path, monkeypatch):
+    """ A raw data tree with the synthetic run, its index file and the list of
+    the writes of the index."""
+    rawPath = str(tmp_path / 'raw')
+    writeRun(rawPath, num_of_macrobunches=400)
+    indexFile = str(tmp_path / 'index.json')
+    saves = []
+    saveRunIndex = runindex.save_run_index
+
+    def countedSave(index, rootpath, index_file=None):
+        saves.append(index_file)
+        saveRunIndex(index, rootpath, index_file)
+
+    monkeypatch.setattr(runindex, 'save_run_index', countedSave)
+    return rawPath, indexFile, saves
+
+
+def test_run_found_and_index_written_once(indexed):
+    rawPath, indexFile, saves = indexed
+    run = runindex.get_run_info(RUN_NUMBER, rawPath, indexFile)
+    assert run['path'] == os.path.join(os.path.abspath(rawPath), '')
+    assert len(run['files']) == 2
+    assert run['sizes'] == [os.path.getsize(f) for f in run['files']]
+    assert len(saves) == 1
+
+    # nothing changed, the index is not written again
+    assert runindex.get_run_info(RUN_NUMBER, rawPath, indexFile) == run
+    assert 'run{}'.format(RUN_NUMBER) in runindex.update_run_index(rawPath, indexFile)
+    assert len(saves) == 1
+
+    with pytest.raises(KeyError):
+        runindex.get_run_info(RUN_NUMBER + 1, rawPath, indexFile)
+    assert len(saves) == 1
+
+
+def test_files_grown_in_place(indexed):
+    rawPath, indexFile, saves = indexed
+    run = runindex.get_run_info(RUN_NUMBER, rawPath, indexFile, pulse_ids=True)
+    assert run['pulseIdInterval'] == [100000000, 100000400]
+
+    # appending to a file does not change the modification time of its directory
+    directory = os.path.dirname(run['files'][-1])
+    directoryMtime = os.stat(directory).st_mtime_ns
+    with open(run['files'][-1], 'ab') as f:
+        f.write(b'\0' * 100)
+    os.utime(directory, ns=(directoryMtime, directoryMtime))
+
+    grown = runindex.get_run_info(RUN_NUMBER, rawPath, indexFile)
+    assert grown['sizes'][-1] == run['sizes'][-1] + 100
+    assert grown['pulseIdInterval'] is None
+    assert len(saves) == 2
+    assert runindex.load_run_index(rawPath, indexFile)['runs']['run{}'.format(RUN_NUMBER)] == grown
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+""" The synthetic run generator, read back by the processor."""
+import os
+
+import h5py
+import numpy as np
+
+from conftest import MACROBUNCHES_PER_FILE, NUM_OF_MACROBUNCHES, RUN_NUMBER, writeRun
+
+
+def test_files_of_the_run(rawPath):
+    names = sorted(os.listdir(os.path.join(rawPath, 'fl1user2')))
+    assert len(names) == NUM_OF_MACROBUNCHES // MACROBUNCHES_PER_FILE
+    assert all('_run{}_'.format(RUN_NUMBER) in name for name in names)
+
+
+def test_same_seed_gives_same_files(tmp_path):
+    first = writeRun(str(tmp_path / 'first'), num_of_macrobunches=50)
+    second = writeRun(str(tmp_path / 'second'), num_of_macrobunches=50)
+    with h5py.File(first[0], 'r') as f, h5py.File(second[0], 'r') as g:
+        def compare(name, item):
+            if isinstance(item, h5py.Dataset):
+                assert np.array_equal(item[()], g[name][()], equal_nan=True)
+        f.visititems(compare)
+
+
+def test_read_by_the_processor(readProcessor):
+    processor = readProcessor
+    assert processor.pulseIdInterval[1] - processor.pulseIdInterval[0] == NUM_OF_MACROBUNCHES
+    # the default number of microbunches per macrobunch
+    assert len(processor.ddMicrobunches) == NUM_OF_MACROBUNCHES * 500
+    assert len(processor.dd) > 0
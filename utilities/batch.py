@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Batch conversion of runs to parquet dataframes.
+
+Several ``readData`` -> ``storeDataframes`` jobs run in a pool of processes.
+New jobs are only started while the estimated memory of the running ones fits
+in the available memory, runs whose dataframes already exist are skipped, and
+the progress is stored in a json state file so that an interrupted batch can
+be resumed by running it again.
+"""
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import dask
+import psutil
+
+from processor import DldFlashDataframeCreator as DldFlashProcessor
+from utilities import runindex
+
+
+def convert_run(runNumber, streaming=True, lazy=False):
+    """ Convert a run to parquet dataframes in ``DATA_PARQUET_DIR``.
+
+    This is the job executed by each process of ``convert_runs``.
+
+    :Parameters:
+        runNumber : int
+            number of the run to convert.
+        streaming : bool | True
+            passed to ``readData``.
+        lazy : bool | False
+            passed to ``readData``.
+
+    :Return:
+        runNumber : int
+            number of the converted run.
+        elapsed : float
+            conversion time in seconds.
+    """
+    t0 = time.time()
+    prc = DldFlashProcessor.DldFlashProcessor()
+    prc.runNumber = runNumber
+    # the default thread pool of dask is inherited from the parent process when
+    # forked, without its threads: the tasks would never run
+    with ThreadPoolExecutor(prc.N_CORES) as pool, dask.config.set(pool=pool):
+        prc.readData(streaming=streaming, lazy=lazy)
+        prc.storeDataframes()
+    return runNumber, time.time() - t0
+
+
+def run_outputs(runNumber, path):
+    """ Paths of the electron and microbunch dataframes of a run.
+
+    :Parameters:
+        runNumber : int
+            number of the run.
+        path : str
+            folder of the parquet dataframes.
+
+    :Return:
+        outputs : list of str
+            the '_el' and '_mb' folders written by ``storeDataframes``.
+    """
+    return [os.path.join(path, 'run{}{}'.format(runNumber, suffix)) for suffix in ('_el', '_mb')]
+
+
+def is_run_converted(runNumber, path, processor=None):
+    """ True if both the dataframes of a run exist and are not empty and, if a
+    processor is given, their manifest matches its raw files and settings (see
+    ``checkManifest``). Dataframes without manifest, e.g. converted by older
+    versions, can't be checked: they are not considered converted."""
+    if not all(os.path.isdir(output) and len(os.listdir(output)) > 0 for output in run_outputs(runNumber, path)):
+        return False
+    if processor is None:
+        return True
+    changes = processor.checkManifest(runNumber, path=path)
+    if changes is None:
+        print('WARNING: run {} has no conversion manifest, it is converted again.'.format(runNumber))
+        return False
+    if changes:
+        print('Run {} changed since its conversion: {}'.format(runNumber, ', '.join(changes)))
+    return not changes
+
+
+def _load_state(state_file):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'runs': {}}
+
+
+def _save_state(state, state_file):
+    os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_file, state_file)
+
+
+def convert_runs(runNumbers, n_workers=None, memory_fraction=0.8, memory_factor=3.0,
+                 streaming=True, lazy=False, state_file=None, overwrite=False):
+    """ Convert runs to parquet dataframes in a pool of processes.
+
+    A run is skipped if its dataframes already exist and its manifest matches
+    the current raw files and settings, unless its last conversion was
+    interrupted or failed. Otherwise the existing output is deleted and the run
+    converted again. The memory needed by a run is estimated as
+    ``memory_factor`` times the size of its raw files, and a new run is started
+    only if it fits in ``memory_fraction`` of the available memory together
+    with the running ones. At least one run is always running,
+    so that runs larger than the budget are still converted, one at a time.
+
+    :Parameters:
+        runNumbers : list of int
+            runs to convert.
+        n_workers : int | None (default to ``N_CORES``)
+            maximum number of runs converted at the same time.
+        memory_fraction : float | 0.8
+            fraction of the available memory used by the running jobs.
+        memory_factor : float | 3.0
+            estimated memory of a job, in units of the size of its raw files.
+        streaming : bool | True
+            passed to ``readData``.
+        lazy : bool | False
+            passed to ``readData``.
+        state_file : str | None (default to 'conversion_state.json' in ``DATA_PARQUET_DIR``)
+            json file where the state of the batch is stored.
+        overwrite : bool | False
+            if True, runs are converted even if their dataframes already exist.
+
+    :Return:
+        fails : dict
+            error message of each run which could not be converted.
+    """
+    prc = DldFlashProcessor.DldFlashProcessor()
+    parquet_dir = prc.DATA_PARQUET_DIR
+    if n_workers is None:
+        n_workers = prc.N_CORES
+    if state_file is None:
+        state_file = os.path.join(parquet_dir, 'conversion_state.json')
+    available_runs = runindex.update_run_index(prc.DATA_RAW_DIR)
+
+    state = _load_state(state_file)
+    fails = {}
+    queue = []
+    for run in runNumbers:
+        run_name = 'run{}'.format(run)
+        status = state['runs'].get(run_name, {}).get('status')
+        if run_name not in available_runs:
+            fails[run] = 'No run number {} in the run index'.format(run)
+        elif status not in ('running', 'failed') and not overwrite and is_run_converted(run, parquet_dir, prc):
+            print('Skipping run {}: already converted.'.format(run))
+        else:
+            for output in run_outputs(run, parquet_dir):  # remove partial or outdated output
+                shutil.rmtree(output, ignore_errors=True)
+            queue.append(run)
+    del prc
+
+    memory = {run: memory_factor * sum(available_runs['run{}'.format(run)]['sizes']) for run in queue}
+    budget = memory_fraction * psutil.virtual_memory().available
+    print('Converting {} runs with up to {} workers, memory budget {:.1f} GB'.format(
+        len(queue), n_workers, budget / 2 ** 30))
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while len(queue) > 0 or len(running) > 0:
+            # start the next runs that fit in the memory budget
+            while len(queue) > 0 and len(running) < n_workers:
+                inUse = sum(memory[run] for run in running.values())
+                if len(running) > 0 and inUse + memory[queue[0]] > budget:
+                    break
+                run = queue.pop(0)
+                state['runs']['run{}'.format(run)] = {'status': 'running'}
+                _save_state(state, state_file)
+                running[executor.submit(convert_run, run, streaming, lazy)] = run
+                print('Started run {} ({:.1f} GB estimated)'.format(run, memory[run] / 2 ** 30))
+
+            done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                run = running.pop(future)
+                try:
+                    run, elapsed = future.result()
+                    state['runs']['run{}'.format(run)] = {'status': 'done', 'time': elapsed}
+                    print('Stored dataframe for run {} in {} ({:.0f} s)'.format(run, parquet_dir, elapsed))
+                except Exception as E:
+                    fails[run] = repr(E)
+                    state['runs']['run{}'.format(run)] = {'status': 'failed', 'error': repr(E)}
+                _save_state(state, state_file)
+
+    for key, val in fails.items():
+        print('{} failed with error {}'.format(key, val))
+    return fails
@@ -13,6 +13,7 @@ from configparser import ConfigParser
 from collections import OrderedDict
 
 from processor import DldFlashDataframeCreator as DldFlashProcessor
+from utilities import runindex
 
 # ================================================================================
 """Functions for calculation of pulse energy and pulse energy density of optical laser.
@@ -296,9 +297,12 @@ def save_H5_hyperstack(data_array, filename, path=None, overwrite=True):
     print("Created file " + filepath)
 
 
-def get_available_runs(rootpath):  # TODO: store the resulting dictionary to improve performance.
+def get_available_runs(rootpath):
     """ Collects the filepaths to the available experimental run data.
 
+    The directory tree is only scanned where it changed since the last call,
+    see ``utilities.runindex``.
+
     :Parameters:
         rootpath : str
             path where to look for data (recursive in subdirectories)
@@ -308,20 +312,8 @@ def get_available_runs(rootpath):  # TODO: store the resulting dictionary to imp
             dict with run numbers as keys (e.g. 'run12345') and path where to load data from as str.
     """
 
-    available_runs = {}
-
-    for dir in os.walk(rootpath):
-        if 'fl1user2' in dir[0]:
-            try:
-                run_path = dir[0][:-8]
-                for name in dir[2]:
-                    runNumber = name.split('_')[4]
-                    if runNumber not in available_runs:
-                        available_runs[runNumber] = run_path
-            except:  # TODO: use an assertion method for more solid error tracking.
-                pass
-
-    return available_runs
+    runs = runindex.update_run_index(rootpath)
+    return {run: info['path'] for run, info in runs.items()}
 
 
 def get_path_to_run(runNumber, rootpath):
@@ -339,12 +331,7 @@ def get_path_to_run(runNumber, rootpath):
             path to where the raw data of the given run number is stored.
     """
 
-    available_runs = get_available_runs(rootpath)
-
-    try:
-        return (available_runs['run{}'.format(runNumber)])
-    except KeyError:
-        raise KeyError('No run number {} under path {}'.format(runNumber, rootpath))
+    return runindex.get_run_info(runNumber, rootpath)['path']
 
 
 # %% String operations
@@ -619,12 +606,21 @@ def read_and_binn(runNumber, *args, static_bunches=False, source='raw', save=Tru
     if source == 'raw':
         processor.readData()
     elif source == 'parquet':
-        try:
-            processor.readDataframes()
-        except:
-            print('No Parquet data found, loading raw data.')
+        # read only the columns used by the post-processing, the filters and the bins
+        columns = ['delayStage', 'bam', 'dldMicrobunchId']
+        for arg in args:
+            columns += ['dldPosX', 'dldPosY'] if arg[0] == 'dldPos' else [arg[0]]
+        changes = processor.checkManifest()
+        if changes and processor.conversionInputs(runNumber)['rawFiles'] is None:
+            # without the raw data, the stored dataframes are all there is
+            if changes != ['raw files not found']:
+                print('Raw data of run {} not found, using the stored dataframes: {}'.format(
+                    runNumber, ', '.join(changes)))
+        elif changes:  # None if converted without manifest: try to use it anyway
+            print('Converting run {} from raw data: {}'.format(runNumber, ', '.join(changes)))
             processor.readData()
             processor.storeDataframes()
+        processor.readDataframes(columns=columns)
     processor.postProcess()
     if static_bunches is True:
         processor.dd = processor.dd[processor.dd['dldMicrobunchId'] > 400]
@@ -674,7 +670,11 @@ def create_dataframes(runNumbers, *args):
         else:
             runNumbers.append(run)
     fails = {}
+    available_runs = runindex.update_run_index(DldFlashProcessor.DldFlashProcessor().DATA_RAW_DIR)
     for run in runNumbers:
+        if 'run{}'.format(run) not in available_runs:
+            fails[run] = KeyError('No run number {} in the run index'.format(run))
+            continue
         try:
             prc = DldFlashProcessor.DldFlashProcessor()
             prc.runNumber = run
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the runs available in the raw data tree.
+
+Walking a full beamtime directory on GPFS takes minutes, so the result of the
+walk is stored in a json file and updated incrementally: the listing of a
+directory is only read again when its modification time changed, i.e. when
+files or subdirectories were added, removed or renamed. Files which grow in
+place do not change the modification time of their directory: the files of a
+run are stat'ed again when the run is looked up. The pulse ID ranges of the
+files are read from the HDF5 files only when requested, and are kept until the
+size or modification time of the file changes. The json file is only written
+when the index changed.
+
+The index maps each run (e.g. 'run12345') to the path where to load it from,
+its files, their sizes and, optionally, its macrobunch ID interval.
+"""
+import hashlib
+import json
+import os
+
+import h5py
+
+_INDEX_VERSION = 1
+
+
+def default_index_file(rootpath):
+    """ Location of the index of a raw data tree.
+
+    :Parameters:
+        rootpath : str
+            path of the raw data tree.
+
+    :Return:
+        index_file : str
+            json file in ~/.hextof_processor, one per raw data tree.
+    """
+    key = hashlib.md5(os.path.abspath(rootpath).encode()).hexdigest()
+    return os.path.join(os.path.expanduser('~'), '.hextof_processor', 'run_index_{}.json'.format(key))
+
+
+def load_run_index(rootpath, index_file=None):
+    """ Load the stored index of a raw data tree, without updating it.
+
+    :Parameters:
+        rootpath : str
+            path of the raw data tree.
+        index_file : str | None (default to ``default_index_file(rootpath)``)
+            json file of the index.
+
+    :Return:
+        index : dict
+            the stored index, or an empty one if missing or outdated.
+    """
+    if index_file is None:
+        index_file = default_index_file(rootpath)
+    empty = {'version': _INDEX_VERSION, 'rootpath': os.path.abspath(rootpath), 'directories': {}, 'runs': {}}
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    if index.get('version') != _INDEX_VERSION or index.get('rootpath') != empty['rootpath']:
+        return empty
+    return index
+
+
+def save_run_index(index, rootpath, index_file=None):
+    """ Store the index of a raw data tree. Failures only print a warning,
+    as the index is a cache.
+
+    :Parameters:
+        index : dict
+            index as returned by ``update_run_index``.
+        rootpath : str
+            path of the raw data tree.
+        index_file : str | None (default to ``default_index_file(rootpath)``)
+            json file of the index.
+    """
+    if index_file is None:
+        index_file = default_index_file(rootpath)
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        print('WARNING: could not store the run index in {}: {}'.format(index_file, e))
+
+
+def _scan_directory(path, old_directories, new_directories):
+    """ Recursively list a directory, reusing the stored listing if its
+    modification time did not change."""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return
+    entry = old_directories.get(path)
+    if entry is None or entry['mtime'] != mtime:
+        old_files = {} if entry is None else entry['files']
+        entry = {'mtime': mtime, 'subdirs': [], 'files': {}}
+        try:
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir():
+                        entry['subdirs'].append(dir_entry.name)
+                    elif dir_entry.is_file():
+                        stat = dir_entry.stat()
+                        file_entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'pulseIdInterval': None}
+                        old_file = old_files.get(dir_entry.name)
+                        if old_file is not None and old_file['size'] == stat.st_size \
+                                and old_file['mtime'] == stat.st_mtime:
+                            file_entry['pulseIdInterval'] = old_file['pulseIdInterval']
+                        entry['files'][dir_entry.name] = file_entry
+        except OSError:
+            return
+        entry['subdirs'].sort()
+    new_directories[path] = entry
+    for subdir in entry['subdirs']:
+        _scan_directory(os.path.join(path, subdir), old_directories, new_directories)
+
+
+def _file_number(name):
+    """ Sorting key of the raw files: file number first, then name."""
+    for part in name.split('_'):
+        if part.startswith('file') and part[4:].isdigit():
+            return int(part[4:]), name
+    return 0, name
+
+
+def _collect_runs(directories):
+    """ Group the files of the indexed directories by run number.
+
+    As in the FLASH layout, run files are in directories named 'fl1user2',
+    and the run is loaded from the parent directory."""
+    runs = {}
+    for path in sorted(directories):
+        if 'fl1user2' not in path:
+            continue
+        run_path = path[:-8]
+        for name, file_entry in directories[path]['files'].items():
+            name_parts = name.split('_')
+            if len(name_parts) < 5:
+                continue
+            run = runs.setdefault(name_parts[4], {'path': run_path, 'directory': path, 'files': []})
+            if run['directory'] == path:
+                run['files'].append(name)
+    for run in runs.values():
+        run['files'].sort(key=_file_number)
+        run['sizes'] = [directories[run['directory']]['files'][name]['size'] for name in run['files']]
+        intervals = [directories[run['directory']]['files'][name]['pulseIdInterval'] for name in run['files']]
+        if len(intervals) > 0 and all(interval is not None for interval in intervals):
+            run['pulseIdInterval'] = [min(i[0] for i in intervals), max(i[1] for i in intervals)]
+        else:
+            run['pulseIdInterval'] = None
+        run['files'] = [os.path.join(run['directory'], name) for name in run['files']]
+    return runs
+
+
+def _file_pulse_id_interval(file_name):
+    """ Macrobunch ID interval, as [first, last + 1], of the first DAQ channel
+    found in a raw HDF5 file, or None if there is none."""
+    found = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and name.split('/')[-1] == 'index' and obj.shape[0] > 0:
+            found.append([int(obj[0]), int(obj[-1]) + 1])
+            return True
+
+    try:
+        with h5py.File(file_name, 'r') as h5_file:
+            h5_file.visititems(visit)
+    except OSError:
+        return None
+    return found[0] if len(found) > 0 else None
+
+
+def _restat_files(directories, files):
+    """ Stat again some indexed files, as files appended in place do not change
+    the modification time of their directory. The macrobunch ID interval of the
+    files which changed is read again when requested.
+
+    :Return:
+        changed : bool
+            True if the size or modification time of a file changed.
+    """
+    changed = False
+    for file_name in files:
+        file_entries = directories[os.path.dirname(file_name)]['files']
+        name = os.path.basename(file_name)
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            del file_entries[name]
+            changed = True
+            continue
+        file_entry = file_entries[name]
+        if file_entry['size'] != stat.st_size or file_entry['mtime'] != stat.st_mtime:
+            file_entries[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'pulseIdInterval': None}
+            changed = True
+    return changed
+
+
+def _read_pulse_id_intervals(directories, files):
+    """ Read the macrobunch ID interval of the indexed files which have none.
+
+    :Return:
+        changed : bool
+            True if an interval was read.
+    """
+    changed = False
+    for file_name in files:
+        file_entry = directories[os.path.dirname(file_name)]['files'][os.path.basename(file_name)]
+        if file_entry['pulseIdInterval'] is None:
+            file_entry['pulseIdInterval'] = _file_pulse_id_interval(file_name)
+            changed = True
+    return changed
+
+
+def update_run_index(rootpath, index_file=None, pulse_ids=None, stat_runs=None):
+    """ Update the index of a raw data tree, and store it if it changed.
+
+    :Parameters:
+        rootpath : str
+            path where to look for data (recursive in subdirectories)
+        index_file : str | None (default to ``default_index_file(rootpath)``)
+            json file of the index.
+        pulse_ids : list of str | None
+            runs (e.g. ['run12345']) whose macrobunch ID interval is read from
+            the files, if not already indexed.
+        stat_runs : list of str | None
+            runs whose files are stat'ed again, even if their directory did not
+            change, so that files which grew in place are indexed with their
+            current size. The runs of ``pulse_ids`` are always stat'ed again.
+
+    :Return:
+        runs : dict
+            dict with run numbers as keys (e.g. 'run12345') and dicts with the
+            'path' where to load the run from, its 'files', their 'sizes' and
+            its 'pulseIdInterval' (None if not read yet) as values.
+    """
+    index = load_run_index(rootpath, index_file)
+    directories = {}
+    _scan_directory(os.path.abspath(rootpath), index['directories'], directories)
+    changed = directories != index['directories']
+
+    runs = _collect_runs(directories)
+    pulse_ids = pulse_ids or []
+    for run_name in list(dict.fromkeys((stat_runs or []) + pulse_ids)):
+        changed |= _restat_files(directories, runs.get(run_name, {}).get('files', []))
+    if changed:
+        runs = _collect_runs(directories)
+    for run_name in pulse_ids:
+        changed |= _read_pulse_id_intervals(directories, runs.get(run_name, {}).get('files', []))
+
+    if changed:
+        index['directories'] = directories
+        index['runs'] = _collect_runs(directories)
+        save_run_index(index, rootpath, index_file)
+    return index['runs']
+
+
+def get_run_info(runNumber, rootpath, index_file=None, pulse_ids=False):
+    """ Returns the index entry of a given run number
+
+    A run which is already indexed is looked up without walking the tree again,
+    as long as its directory did not change: only its files are stat'ed again.
+
+    :Parameters:
+        runNumber : str or int
+            run number as integer or string.
+        rootpath : str
+            path where to look for data (recursive in subdirectories)
+        index_file : str | None (default to ``default_index_file(rootpath)``)
+            json file of the index.
+        pulse_ids : bool | False
+            if True, the macrobunch ID interval of the run is read, if not indexed yet.
+
+    :Return:
+        run : dict
+            'path', 'files', 'sizes' and 'pulseIdInterval' of the run.
+    """
+    run_name = 'run{}'.format(runNumber)
+    index = load_run_index(rootpath, index_file)
+    run = index['runs'].get(run_name)
+    directory = None if run is None else index['directories'].get(run['directory'])
+    try:
+        unchanged = directory is not None and os.stat(run['directory']).st_mtime == directory['mtime']
+    except OSError:
+        unchanged = False
+    if unchanged:
+        changed = _restat_files(index['directories'], run['files'])
+        if changed:
+            index['runs'] = _collect_runs(index['directories'])
+        if run_name in index['runs']:
+            if pulse_ids:
+                changed |= _read_pulse_id_intervals(index['directories'], index['runs'][run_name]['files'])
+                index['runs'] = _collect_runs(index['directories'])
+            if changed:
+                save_run_index(index, rootpath, index_file)
+            return index['runs'][run_name]
+
+    runs = update_run_index(rootpath, index_file, pulse_ids=[run_name] if pulse_ids else None,
+                            stat_runs=[run_name])
+    try:
+        return runs[run_name]
+    except KeyError:
+        raise KeyError('No run number {} under path {}'.format(runNumber, rootpath))
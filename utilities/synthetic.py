@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic runs in the layout of the FLASH DAQ files.
+
+The runs can be read by ``readData`` like real beamtime data, so that reading,
+conversion and binning can be tested and benchmarked without access to the
+FLASH storage. Each channel is an HDF5 group with an ``index`` dataset, the
+macrobunch IDs, and a ``value`` dataset, one row per macrobunch, split in
+files named as the DAQ does, e.g.
+'fl1user2/FLASH1_USER2_stream_2_run1_file1_20190101T000000.1.h5'.
+
+The electrons have a Gaussian spot on the detector over a flat background, and
+times of flight drawn from a set of Gaussian peaks, also over a flat
+background. The delay stage scans a range in steps.
+"""
+import os
+
+import h5py
+import numpy as np
+
+# DAQ addresses of the channels written by default, as in InitializeSettings.py
+DEFAULT_CHANNELS = {
+    'dld_pos_x': "/FL1/Experiment/PG/Hextof/Detector/monitor 1",
+    'dld_pos_y': "/FL1/Experiment/PG/Hextof/Detector/monitor 2",
+    'dld_time': "/FL1/Experiment/PG/Hextof/Detector/control info",
+    'dld_detector_id': "/FL1/Experiment/PG/Hextof/Detector/control info",
+    'dld_sector_id': "/FL1/Experiment/PG/Hextof/Detector/control info",
+    'dld_microbunch_id': "/FL1/Experiment/PG/Hextof/Detector/monitor 3",
+    'dld_aux_0': "/FL1/Experiment/PG/Hextof/Detector/monitor 0",
+    'dld_aux_1': "/FL1/Experiment/PG/Hextof/Detector/monitor 0",
+    'delay_stage': "/FL1/Experiment/Pump probe laser/delay line IK220.0/ENC",
+    'bam': '/FL1/Electron Diagnostic/BAM/4DBC3/electron bunch arrival time (low charge)',
+    'bunch_charge': '/FL1/Electron Diagnostic/Bunch charge/after undulator',
+    'macro_bunch_pulse_id': '/FL1/Timing/Bunch train info/set pattern.sts',
+    'optical_diode': '/FL1/Experiment/PG/SIS8300 100MHz ADC/CH9/pulse energy/TD',
+    'gmd_tunnel': '/FL1/Photon Diagnostic/GMD/Pulse resolved energy/energy tunnel',
+    'gmd_bda': '/FL1/Photon Diagnostic/GMD/Pulse resolved energy/energy BDA',
+    'time_stamp': '/FL1/Timing/time stamp/fl1user2',
+}
+
+# (center, width, relative intensity) of the time of flight peaks, in TOF steps.
+# With TOF_STEP_TO_NS = 0.00686 they are at about 640 and 655 ns.
+DEFAULT_PEAKS = ((93300, 300, 1.0), (95500, 700, 0.5))
+
+# channels with one value per electron, the others have one value per
+# macrobunch or per microbunch
+_ELECTRON_CHANNELS = ('dld_pos_x', 'dld_pos_y', 'dld_time', 'dld_detector_id', 'dld_sector_id', 'dld_microbunch_id')
+
+
+def _electron_values(name, rng, shape, hits, peaks, detector_size, num_of_microbunches, ubid_offset):
+    """ (macrobunch, electron) values of an electron channel, NaN padded after the hits."""
+    if name in ('dld_pos_x', 'dld_pos_y'):
+        values = rng.normal(detector_size / 2, detector_size / 12, shape)
+        background = rng.uniform(size=shape) < 0.2
+        values[background] = rng.uniform(0, detector_size, np.count_nonzero(background))
+        values = np.clip(np.round(values), 1, detector_size - 1)
+    elif name in ('dld_time', 'dld_detector_id', 'dld_sector_id'):
+        weights = np.array([peak[2] for peak in peaks] + [0.2 * sum(peak[2] for peak in peaks)])
+        choice = rng.choice(len(weights), size=shape, p=weights / weights.sum())
+        centers = np.array([peak[0] for peak in peaks] + [0.0])
+        widths = np.array([peak[1] for peak in peaks] + [0.0])
+        values = rng.normal(centers[choice], widths[choice])
+        low = min(peak[0] - 10 * peak[1] for peak in peaks)
+        high = max(peak[0] + 10 * peak[1] for peak in peaks)
+        background = choice == len(peaks)
+        values[background] = rng.uniform(low, high, np.count_nonzero(background))
+        values = np.round(values)
+    elif name == 'dld_microbunch_id':
+        values = (ubid_offset + rng.randint(0, num_of_microbunches, shape)).astype(np.float64)
+    else:
+        values = rng.normal(0, 1, shape)
+    values[np.arange(shape[1])[None, :] >= hits[:, None]] = np.nan
+    return values
+
+
+def _channel_values(name, rng, ids, macrobunch_index, num_of_macrobunches, num_of_microbunches, delay_range,
+                    delay_steps, start_time):
+    """ (macrobunch, value) values of a macrobunch or microbunch channel."""
+    n = len(ids)
+    if name == 'macro_bunch_pulse_id':
+        return ids[:, None].astype(np.float64)
+    elif name == 'time_stamp':  # 10 Hz
+        return start_time + macrobunch_index[:, None] / 10.
+    elif name == 'delay_stage':  # the delay is in the second column
+        step = np.minimum(macrobunch_index * delay_steps // num_of_macrobunches, delay_steps - 1)
+        delays = np.linspace(delay_range[0], delay_range[1], delay_steps)[step]
+        return np.stack([rng.normal(0, 1, n), delays + rng.normal(0, 0.001, n)], axis=1)
+    elif name in ('dld_aux_0', 'dld_aux_1'):
+        return rng.normal(0, 1, (n, 2))
+    elif name == 'bam':
+        return rng.normal(0, 0.1, (n, num_of_microbunches))
+    elif name in ('bunch_charge', 'optical_diode', 'gmd_tunnel', 'gmd_bda'):
+        return rng.normal(1, 0.1, (n, num_of_microbunches))
+    else:
+        return rng.normal(0, 1, (n, 1))
+
+
+def generate_run(rootpath, runNumber=1, num_of_macrobunches=1000, electrons_per_macrobunch=50,
+                 num_of_microbunches=500, macrobunches_per_file=500, channels=None, peaks=DEFAULT_PEAKS,
+                 detector_size=1500, delay_range=(-57., -42.), delay_steps=30, first_pulse_id=100000000,
+                 ubid_offset=5, seed=0):
+    """ Write a synthetic run in the layout of the FLASH DAQ files.
+
+    :Parameters:
+        rootpath : str
+            folder where to write the run, to be used as ``DATA_RAW_DIR``. The files
+            are written in its 'fl1user2' subfolder.
+        runNumber : int | 1
+            number of the run.
+        num_of_macrobunches : int | 1000
+            number of macrobunches of the run.
+        electrons_per_macrobunch : int | 50
+            mean number of electrons per macrobunch. The number of hits of each
+            macrobunch is Poisson distributed, in 3 times as many slots.
+        num_of_microbunches : int | 500
+            number of microbunches per macrobunch.
+        macrobunches_per_file : int | 500
+            number of macrobunches in each file.
+        channels : dict | None (default to ``DEFAULT_CHANNELS``)
+            DAQ address of each channel, with the names of the [DAQ channels] section
+            of SETTINGS.ini. Channels sharing an address are written once.
+        peaks : list of (float, float, float) | ``DEFAULT_PEAKS``
+            center, width and relative intensity of the time of flight peaks, in TOF steps.
+        detector_size : int | 1500
+            size of the detector, in pixels.
+        delay_range : (float, float) | (-57., -42.)
+            first and last position of the delay stage scan.
+        delay_steps : int | 30
+            number of positions of the delay stage scan.
+        first_pulse_id : int | 100000000
+            macrobunch ID of the first macrobunch.
+        ubid_offset : int | 5
+            offset of the microbunch IDs, as UBID_OFFSET.
+        seed : int | 0
+            seed of the random numbers, the same seed gives the same files.
+
+    :Return:
+        files : list of str
+            paths of the written files.
+    """
+    if channels is None:
+        channels = DEFAULT_CHANNELS
+    rng = np.random.RandomState(seed)
+    folder = os.path.join(rootpath, 'fl1user2')
+    os.makedirs(folder, exist_ok=True)
+    slots = max(1, 3 * electrons_per_macrobunch)
+    start_time = 1.5e9
+
+    # each address is written once, with the values of its first channel
+    addresses = {}
+    for name, address in channels.items():
+        addresses.setdefault(address, name)
+
+    files = []
+    for file_number, first in enumerate(range(0, num_of_macrobunches, macrobunches_per_file)):
+        macrobunch_index = np.arange(first, min(first + macrobunches_per_file, num_of_macrobunches))
+        ids = first_pulse_id + macrobunch_index
+        hits = np.minimum(rng.poisson(electrons_per_macrobunch, len(ids)), slots)
+        file_name = os.path.join(folder, 'FLASH1_USER2_stream_2_run{}_file{}_20190101T000000.1.h5'.format(
+            runNumber, file_number + 1))
+        with h5py.File(file_name, 'w') as h5_file:
+            for address, name in addresses.items():
+                if name in _ELECTRON_CHANNELS:
+                    values = _electron_values(name, rng, (len(ids), slots), hits, peaks, detector_size,
+                                              num_of_microbunches, ubid_offset)
+                else:
+                    values = _channel_values(name, rng, ids, macrobunch_index, num_of_macrobunches,
+                                             num_of_microbunches, delay_range, delay_steps, start_time)
+                group = h5_file.create_group(address)
+                group.create_dataset('index', data=ids)
+                group.create_dataset('value', data=values)
+        files.append(file_name)
+    return files